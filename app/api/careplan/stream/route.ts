@@ -29,10 +29,13 @@ export async function GET(request: NextRequest) {
     
     // Connect to the Python backend's streaming endpoint
     const backendUrl = `${BACKEND_URL}?streamId=${streamId}`;
+    // EventSource sends Last-Event-ID on reconnect; forwarding it lets the backend resume the stream
+    const lastEventId = request.headers.get('Last-Event-ID');
     const backendResponse = await fetch(backendUrl, {
       method: 'GET',
       headers: {
         'Accept': 'text/event-stream',
+        ...(lastEventId ? { 'Last-Event-ID': lastEventId } : {}),
       },
     });
     
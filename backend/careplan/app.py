@@ -6,14 +6,21 @@ Flask app that interfaces with Perplexity's Sonar Reasoning Pro API to generate
 """
 
 import os
-import json
-import uuid
 import time
 import sys
+import threading
 from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 from perplexity_client import get_perplexity_client
+from stream_store import get_stream_store, generation_key, worker_id, StreamCapacityError
+from stream_jobs import GenerationJobRegistry, format_sse_event, parse_last_event_id, accepts_gzip, gzip_sse_messages, CARE_PLAN_STREAM_GZIP
+from care_plan_patch import CarePlanPatchEncoder, resolve_event_mode
+from serialization import dumps_bytes
+from checkpoint_store import get_checkpoint_store
+from batch_jobs import get_batch_runner
+from health import HealthMonitor, UpstreamUnavailableError, CIRCUIT_CLOSED
+from metrics import REGISTRY as metrics_registry, PROMETHEUS_CONTENT_TYPE
 
 # Load environment variables
 load_dotenv()
@@ -26,8 +33,14 @@ CARE_PLAN_SERVER_PORT = int(os.environ.get('CARE_PLAN_SERVER_PORT', 5001))
 app = Flask(__name__)
 CORS(app)  # Allow cross-origin requests
 
-# Store active streams
-active_streams = {}
+# Streaming sessions between initiate-stream and stream (see CARE_PLAN_STREAM_STORE)
+stream_store = get_stream_store()
+
+# Generations running (or recently finished) in this process, resumable by event ID
+generation_jobs = GenerationJobRegistry()
+
+# Per-stage progress of every generation, so failed stages can be re-run (None if CARE_PLAN_CHECKPOINT_STORE=off)
+checkpoint_store = get_checkpoint_store()
 
 # Validate API key
 if not SONAR_API_KEY:
@@ -46,22 +59,50 @@ except Exception as e:
     traceback.print_exc() # Print full traceback for detailed debugging
     sys.exit(1)
 
+# Upstream health, probed in the background (see CARE_PLAN_HEALTH_PROBE_INTERVAL); its circuit breaker is shared with the client
+health_monitor = HealthMonitor(perplexity_client.probe_upstream, perplexity_client.circuit_breaker)
+health_monitor.start()
+
 @app.route('/api/healthcheck', methods=['GET'])
 def healthcheck():
-    """Basic healthcheck endpoint"""
-    return jsonify({"status": "ok", "message": "Care Plan API is running"}), 200
+    """Basic healthcheck endpoint; reports the cached upstream health but stays 200 while this process runs"""
+    upstream = health_monitor.status()
+    if upstream["healthy"] is False or upstream.get("circuit", CIRCUIT_CLOSED) != CIRCUIT_CLOSED:
+        status = "degraded"
+    else:
+        status = "ok" if upstream["healthy"] else "unknown"
+    return jsonify({"status": status, "message": "Care Plan API is running", "upstream": upstream}), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """Prometheus metrics of this process: per-stage latency, upstream timings and failures"""
+    return Response(metrics_registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
 
 @app.route('/api/careplan/test', methods=['POST'])
 def test_connection():
     """Test endpoint to verify the backend is running and API key is available"""
     try:
-        # Verify the API key by making a minimal request to Perplexity
-        # This will use the client's _validate_api_key method indirectly
-        get_perplexity_client()
+        # The latest probe of the Perplexity API; a missing or stale one is refreshed in the background
+        upstream = health_monitor.status()
+        if upstream["healthy"] is None:
+            return jsonify({
+                "status": "unknown",
+                "message": "The Perplexity API has not been probed yet",
+                "upstream": upstream,
+                "timestamp": time.time()
+            })
+        if not upstream["healthy"]:
+            return jsonify({
+                "status": "error",
+                "message": f"Connection to Perplexity API failed: {upstream['error']}",
+                "upstream": upstream,
+                "timestamp": time.time()
+            }), 503
         
         return jsonify({
             "status": "success",
             "message": "Connection to Perplexity API successful",
+            "upstream": upstream,
             "timestamp": time.time()
         })
     except Exception as e:
@@ -77,53 +118,116 @@ def test_connection():
 def initiate_stream():
     """Start a streaming session and return a stream ID"""
     try:
-        # Generate a random stream ID
-        stream_id = str(uuid.uuid4())
-        
-        # Store the patient data for this stream
-        active_streams[stream_id] = {
-            "patient_data": request.json,
-            "created_at": time.time()
-        }
+        try:
+            patient_data = dict(request.json, event_mode=resolve_event_mode(request.json.get("event_mode")))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Refused at once while the circuit breaker has found the Perplexity API down
+        health_monitor.ensure_available()
+
+        # Store the patient data for this stream; refused when too many generations are in flight. A request
+        # identical to one still generating gets that stream ID, and its stream replays the events sent so far
+        stream_id = stream_store.create(patient_data, generation_key(patient_data))
         
         # Return the stream ID
         return jsonify({"stream_id": stream_id})
         
+    except StreamCapacityError as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    except UpstreamUnavailableError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-def stream_generator(stream_id):
-    """Generate a stream of events for the care plan generation process"""
+def prepare_generation(stream_id, patient_data):
+    """Start the checkpoint of a generation and return the resume arguments for stream_full_care_plan"""
+    if checkpoint_store is None:
+        return {}
+
+    stage_outputs, stage_status = {}, {}
+    rerun_of = patient_data.get("rerun_of")
+    if rerun_of:
+        previous_checkpoint = checkpoint_store.load(rerun_of)
+        if previous_checkpoint is None:
+            raise ValueError(f"Checkpoint of stream {rerun_of} is no longer available")
+        stage_outputs, stage_status = previous_checkpoint["stage_outputs"], previous_checkpoint["stage_status"]
+
+    stages_to_run = patient_data.get("stages_to_run")
+    patient_inputs = {key: patient_data[key] for key in ("patient_form_data", "care_environment", "focus_areas")}
+    checkpoint_store.create(
+        stream_id, patient_inputs, stages_to_run or [stage_config["name"] for stage_config in perplexity_client.STAGES_CONFIG],
+        stage_outputs, stage_status, rerun_of
+    )
+    return {
+        "stage_outputs": stage_outputs,
+        "stages_to_run": stages_to_run,
+        "on_stage_finished": lambda stage_name, status, stage_json_output: checkpoint_store.record_stage(stream_id, stage_name, status, stage_json_output)
+    }
+
+# Payloads every stream sends, encoded once
+START_PAYLOAD = dumps_bytes({'type': 'start', 'content': 'Starting care plan generation'})
+DONE_PAYLOAD = b"[DONE]"
+INVALID_STREAM_EVENT = format_sse_event(None, dumps_bytes({'type': 'error', 'content': 'Invalid stream ID'}))
+
+def unservable_stream_event(stream_id):
+    """The error sent for a stream this worker has no job for: unknown, or generated by another worker"""
+    claimed_by = stream_store.claimed_by(stream_id)
+    if claimed_by is None or claimed_by == worker_id():
+        return INVALID_STREAM_EVENT
+    # Without sticky routing, a reconnect or a client sharing the stream can reach a worker other than the one generating it
+    return format_sse_event(None, dumps_bytes({'type': 'error', 'content': 'Stream is generated by another worker, stream requests must be routed by streamId'}))
+
+def generate_stream_events(stream_id, patient_data, cancel_token=None):
+    """Generate the SSE payloads of one care plan generation, stopping early once cancel_token is cancelled"""
     try:
-        if stream_id not in active_streams:
-            yield f"data: {json.dumps({'type': 'error', 'content': 'Invalid stream ID'})}\n\n"
-            return
-            
-        patient_data = active_streams[stream_id]["patient_data"]
-        
         # Send SSE events as the stream progresses
-        yield f"data: {json.dumps({'type': 'start', 'content': 'Starting care plan generation'})}\n\n"
+        yield START_PAYLOAD
         
         # Use the Perplexity client to stream the care plan generation
-        for chunk in perplexity_client.stream_full_care_plan_sequentially(patient_data["patient_form_data"], patient_data["care_environment"], patient_data["focus_areas"]):
+        resume_arguments = prepare_generation(stream_id, patient_data)
+        patch_encoder = CarePlanPatchEncoder(perplexity_client.merge_engine) if patient_data.get("event_mode") == "patch" else None
+        for chunk in perplexity_client.stream_full_care_plan(patient_data["patient_form_data"], patient_data["care_environment"], patient_data["focus_areas"], cancel_token=cancel_token, **resume_arguments):
+            if chunk["type"] == "full_care_plan_complete" and checkpoint_store is not None:
+                checkpoint_store.record_care_plan(stream_id, chunk["care_plan"])
             # Forward the chunk to the client
-            yield f"data: {json.dumps(chunk)}\n\n"
-        
-        # Clean up the stream
-        if stream_id in active_streams:
-            del active_streams[stream_id]
+            if patch_encoder is None:
+                yield dumps_bytes(chunk)
+                continue
+            for event in patch_encoder.encode(chunk):
+                yield dumps_bytes(event)
             
         # Signal the end of the stream
-        yield "data: [DONE]\n\n"
+        yield DONE_PAYLOAD
         
     except Exception as e:
         print(f"Stream error: {str(e)}")
-        yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
-        yield "data: [DONE]\n\n"
-        
-        # Clean up on error
-        if stream_id in active_streams:
-            del active_streams[stream_id]
+        yield dumps_bytes({'type': 'error', 'content': str(e)})
+        yield DONE_PAYLOAD
+
+def start_generation_thread(job, patient_data):
+    """Run a generation in the background; the stream session is released once it ends"""
+    threading.Thread(
+        target=job.run,
+        args=(generate_stream_events(job.stream_id, patient_data, job.cancel_token), lambda: stream_store.release(job.stream_id)),
+        name=f"careplan-generation-{job.stream_id[:8]}",
+        daemon=True
+    ).start()
+
+def stream_generator(stream_id, last_event_id=0):
+    """Stream the events of a generation, starting it on the first request and resuming after last_event_id on reconnects"""
+    job = generation_jobs.get_or_start(stream_id, stream_store.claim, start_generation_thread)
+    if job is None:
+        yield unservable_stream_event(stream_id)
+        return
+
+    # The generation keeps running if this client disconnects, until CARE_PLAN_STREAM_DISCONNECT_GRACE passes without another
+    job.attach()
+    try:
+        for event_id, payload in job.buffer.follow(last_event_id):
+            yield format_sse_event(event_id, payload)
+    finally:
+        job.detach()
 
 @app.route('/api/careplan/stream', methods=['GET'])
 def stream_route():
@@ -133,20 +237,111 @@ def stream_route():
         if not stream_id:
             return jsonify({"error": "No stream ID provided"}), 400
             
+        # EventSource sends Last-Event-ID when it reconnects
+        last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('lastEventId'))
+
+        headers = {
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            'Connection': 'keep-alive'
+        }
+        messages = stream_generator(stream_id, last_event_id)
+        if CARE_PLAN_STREAM_GZIP:
+            headers['Vary'] = 'Accept-Encoding'
+            if accepts_gzip(request.headers.get('Accept-Encoding')):
+                headers['Content-Encoding'] = 'gzip'
+                messages = gzip_sse_messages(messages)
+
         # Create a streaming response
         return Response(
-            stream_with_context(stream_generator(stream_id)),
+            stream_with_context(messages),
             mimetype='text/event-stream',
-            headers={
-                'Cache-Control': 'no-cache',
-                'X-Accel-Buffering': 'no',
-                'Connection': 'keep-alive'
-            }
+            headers=headers
         )
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/careplan/rerun-stages', methods=['POST'])
+def rerun_stages():
+    """Re-run the failed (or the given) stages of a previous generation against its checkpoint; returns a new stream ID"""
+    try:
+        if checkpoint_store is None:
+            return jsonify({"error": "Checkpoints are disabled"}), 404
+
+        previous_stream_id = request.json.get("stream_id")
+        checkpoint = checkpoint_store.load(previous_stream_id) if previous_stream_id else None
+        if checkpoint is None:
+            return jsonify({"error": "No checkpoint for this stream ID"}), 404
+
+        try:
+            stages_to_run = perplexity_client.select_stages_to_rerun(checkpoint["stage_status"], request.json.get("stages"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if not stages_to_run:
+            return jsonify({"error": "Every stage completed, nothing to re-run"}), 400
+        try:
+            event_mode = resolve_event_mode(request.json.get("event_mode"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Streamed like any other session through /api/careplan/stream
+        health_monitor.ensure_available()
+        stream_id = stream_store.create(dict(checkpoint["patient_data"], rerun_of=previous_stream_id, stages_to_run=stages_to_run, event_mode=event_mode))
+        return jsonify({"stream_id": stream_id, "stages": stages_to_run})
+
+    except StreamCapacityError as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    except UpstreamUnavailableError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(e.retry_after)}
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/careplan/checkpoint/<stream_id>', methods=['GET'])
+def get_checkpoint(stream_id):
+    """Stage statuses and care plan saved for a generation"""
+    checkpoint = checkpoint_store.load(stream_id) if checkpoint_store is not None else None
+    if checkpoint is None:
+        return jsonify({"error": "No checkpoint for this stream ID"}), 404
+    return jsonify({key: checkpoint[key] for key in ("stream_id", "rerun_of", "stage_status", "care_plan", "updated_at")})
+
+@app.route('/api/careplan/batch', methods=['POST'])
+def submit_batch():
+    """Queue care plan generation for many patients; returns a job ID"""
+    try:
+        # Records may leave out care_environment and focus_areas to use the batch-wide values
+        records = [
+            dict({"care_environment": request.json.get("care_environment", ""), "focus_areas": request.json.get("focus_areas", [])}, **record)
+            if isinstance(record, dict) else record
+            for record in request.json.get("records") or []
+        ]
+        job = get_batch_runner().submit(records)
+        return jsonify({"job_id": job.job_id, "total": len(records)}), 202
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/careplan/batch/<job_id>', methods=['GET'])
+def get_batch(job_id):
+    """Status, progress and throughput of a batch job"""
+    job = get_batch_runner().get(job_id)
+    if job is None:
+        return jsonify({"error": "No batch job with this ID"}), 404
+    return jsonify(job.metrics())
+
+@app.route('/api/careplan/batch/<job_id>/results', methods=['GET'])
+def get_batch_results(job_id):
+    """NDJSON results of a batch job written so far, one line per patient in completion order"""
+    job = get_batch_runner().get(job_id)
+    if job is None:
+        return jsonify({"error": "No batch job with this ID"}), 404
+    if not os.path.exists(job.output_path):
+        return Response("", mimetype='application/x-ndjson')
+    with open(job.output_path, encoding='utf-8') as f:
+        return Response(f.read(), mimetype='application/x-ndjson')
+
 if __name__ == '__main__':
     print(f"Starting Care Plan Generator backend on port {CARE_PLAN_SERVER_PORT}")
     print(f"API Key: {'CONFIGURED' if SONAR_API_KEY else 'MISSING'}")
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Care Plan Generator ASGI Entry Point
+-----------------------------------
+Serves /api/careplan/stream from the asyncio engine so that an open SSE connection costs a
+coroutine rather than a worker thread. Every other route is delegated to the Flask app.
+
+Run with:
+    uvicorn asgi:application --host 0.0.0.0 --port 5001
+"""
+
+import asyncio
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from app import app as flask_app, stream_store, generation_jobs, checkpoint_store, prepare_generation, unservable_stream_event, START_PAYLOAD, DONE_PAYLOAD
+from stream_jobs import format_sse_event, parse_last_event_id, accepts_gzip, SSEGzipEncoder, CARE_PLAN_STREAM_GZIP
+from care_plan_patch import CarePlanPatchEncoder
+from serialization import dumps_bytes
+from async_perplexity_client import get_async_perplexity_client
+
+flask_asgi_app = WsgiToAsgi(flask_app)
+
+SSE_HEADERS = [
+    (b"content-type", b"text/event-stream"),
+    (b"cache-control", b"no-cache"),
+    (b"x-accel-buffering", b"no"),
+    (b"connection", b"keep-alive"),
+    (b"access-control-allow-origin", b"*"),
+]
+
+async def generate_stream_events(stream_id, patient_data, cancel_token=None):
+    """Async counterpart of app.generate_stream_events; yields the same SSE payloads"""
+    try:
+        yield START_PAYLOAD
+
+        async_client = get_async_perplexity_client()
+        resume_arguments = await asyncio.to_thread(prepare_generation, stream_id, patient_data)
+        patch_encoder = CarePlanPatchEncoder(async_client.merge_engine) if patient_data.get("event_mode") == "patch" else None
+        async for chunk in async_client.astream_full_care_plan(patient_data["patient_form_data"], patient_data["care_environment"], patient_data["focus_areas"], cancel_token=cancel_token, **resume_arguments):
+            if chunk["type"] == "full_care_plan_complete" and checkpoint_store is not None:
+                await asyncio.to_thread(checkpoint_store.record_care_plan, stream_id, chunk["care_plan"])
+            if patch_encoder is None:
+                yield dumps_bytes(chunk)
+                continue
+            for event in patch_encoder.encode(chunk):
+                yield dumps_bytes(event)
+
+        yield DONE_PAYLOAD
+
+    except Exception as e:
+        print(f"Stream error: {str(e)}")
+        yield dumps_bytes({'type': 'error', 'content': str(e)})
+        yield DONE_PAYLOAD
+
+async def stream_generator(stream_id, last_event_id=0):
+    """Async counterpart of app.stream_generator; generations run as tasks on the event loop"""
+    loop = asyncio.get_running_loop()
+
+    def start_generation_task(job, patient_data):
+        # Called from the worker thread below, so hand the task over to the loop
+        def create_task():
+            job.task = loop.create_task(job.arun(generate_stream_events(job.stream_id, patient_data, job.cancel_token), lambda: stream_store.release(job.stream_id)))
+        loop.call_soon_threadsafe(create_task)
+
+    # The store may do blocking SQLite or Redis I/O, keep it off the event loop
+    job = await asyncio.to_thread(generation_jobs.get_or_start, stream_id, stream_store.claim, start_generation_task)
+    if job is None:
+        yield await asyncio.to_thread(unservable_stream_event, stream_id)
+        return
+
+    job.attach()
+    try:
+        async for event_id, payload in job.buffer.afollow(last_event_id):
+            yield format_sse_event(event_id, payload)
+    finally:
+        job.detach()
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def stream_route(scope, receive, send):
+    """SSE endpoint for streaming care plan generation"""
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    stream_id = query.get("streamId", [None])[0]
+    headers = dict(scope.get("headers", []))
+    last_event_id = parse_last_event_id(headers.get(b"last-event-id", b"").decode("latin-1") or query.get("lastEventId", [None])[0])
+    if not stream_id:
+        body = dumps_bytes({"error": "No stream ID provided"})
+        await send({"type": "http.response.start", "status": 400, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": body})
+        return
+
+    response_headers = SSE_HEADERS
+    gzip_encoder = None
+    if CARE_PLAN_STREAM_GZIP:
+        response_headers = SSE_HEADERS + [(b"vary", b"Accept-Encoding")]
+        if accepts_gzip(headers.get(b"accept-encoding", b"").decode("latin-1")):
+            response_headers.append((b"content-encoding", b"gzip"))
+            gzip_encoder = SSEGzipEncoder()
+    await send({"type": "http.response.start", "status": 200, "headers": response_headers})
+    # Sending to a client that went away does not fail, so its disconnect is awaited alongside each event
+    events = stream_generator(stream_id, last_event_id)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        while True:
+            next_event = asyncio.ensure_future(events.__anext__())
+            await asyncio.wait({next_event, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_event.done():
+                next_event.cancel()
+                await asyncio.wait({next_event})
+                return
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                break
+            if gzip_encoder is not None:
+                event = gzip_encoder.encode(event)
+            await send({"type": "http.response.body", "body": event, "more_body": True})
+        await send({"type": "http.response.body", "body": gzip_encoder.close() if gzip_encoder is not None else b""})
+    finally:
+        disconnected.cancel()
+        await events.aclose()
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await get_async_perplexity_client().aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(scope, receive, send)
+    elif scope["type"] == "http" and scope["method"] == "GET" and scope["path"] == "/api/careplan/stream":
+        await stream_route(scope, receive, send)
+    else:
+        await flask_asgi_app(scope, receive, send)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Async Perplexity Client Module
+-----------------------------
+asyncio-native variant of the Perplexity client. Streams the same stage events as
+PerplexityClient, but over httpx so an idle generation only costs a suspended coroutine
+instead of a blocked worker thread.
+"""
+
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+from typing import Dict, List, Any, Optional, AsyncGenerator, Callable, Tuple, Union
+
+from perplexity_client import PerplexityClient, StageFinishedCallback, PERPLEXITY_POOL_MAXSIZE, PERPLEXITY_CONNECT_RETRIES
+from stream_parser import StageResponseParser
+from stage_scheduler import StageScheduler, StageJob, CallBatch, CompletionCall
+from cancellation import CancellationToken, GenerationCancelled, check_cancelled, on_cancel, asleep
+import metrics
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - only needed when the ASGI server is used
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+class AsyncPerplexityClient(PerplexityClient):
+    """
+    Client for Perplexity's Sonar Reasoning Pro API built on httpx.AsyncClient.
+    Prompt building, delta parsing, stage flows, scheduling and merging are shared with PerplexityClient;
+    only the upstream calls and the tasks running them concurrently are its own.
+    """
+
+    def __init__(self, api_key: Optional[str] = None, **client_options: Any):
+        """Accepts the same options as PerplexityClient; the pool size and connect retries also configure httpx."""
+        if httpx is None:
+            raise ImportError("httpx is required for AsyncPerplexityClient. Install it with: pip install httpx")
+        super().__init__(api_key, **client_options)
+        self._pool_maxsize = client_options.get("pool_maxsize", PERPLEXITY_POOL_MAXSIZE)
+        self._connect_retries = client_options.get("connect_retries", PERPLEXITY_CONNECT_RETRIES)
+        self._async_http_client: Optional["httpx.AsyncClient"] = None
+
+    def _get_async_http_client(self) -> "httpx.AsyncClient":
+        """
+        Lazily creates the shared httpx client. It is created on first use so that it binds to
+        the event loop of the ASGI server rather than whichever loop happened to import us.
+        httpx retries connection errors only, matching the sync client's retry policy. As in the sync
+        client, the upstream limiter bounds concurrency and the pool only how many idle connections are kept.
+        """
+        if self._async_http_client is None:
+            self._async_http_client = httpx.AsyncClient(
+                headers=self._get_headers(),
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=self._pool_maxsize),
+                transport=httpx.AsyncHTTPTransport(retries=self._connect_retries),
+                timeout=httpx.Timeout(180.0),
+            )
+        return self._async_http_client
+
+    async def aclose(self) -> None:
+        """Closes every pooled connection held by the async client."""
+        if self._async_http_client is not None:
+            await self._async_http_client.aclose()
+            self._async_http_client = None
+        self.close()
+
+    def _upstream_aslot(self, payload: Dict[str, Any], cancel_token: Optional[CancellationToken] = None):
+        """Async counterpart of PerplexityClient._upstream_slot."""
+        if self.upstream_limiter is None:
+            return contextlib.nullcontext()
+        return self.upstream_limiter.aacquire(self._estimate_tokens(payload), cancel_token)
+
+    @contextlib.asynccontextmanager
+    async def _ainterrupt_on_cancel(self, cancel_token: Optional[CancellationToken]):
+        """
+        Interrupts the awaits of the block (e.g. a read from a stalled stream) when cancel_token is cancelled,
+        by cancelling the current task, and raises GenerationCancelled in place of the CancelledError.
+        """
+        if cancel_token is None:
+            yield
+            return
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        interrupted = False
+        active = True
+
+        def interrupt() -> None:
+            # Runs on the loop, so it cannot race with the block exiting
+            nonlocal interrupted
+            if active:
+                interrupted = True
+                task.cancel()
+
+        try:
+            with on_cancel(cancel_token, lambda: loop.call_soon_threadsafe(interrupt)):
+                yield
+        except asyncio.CancelledError:
+            if not interrupted:
+                raise
+            # Withdraw our cancel request so asyncio.timeout() and TaskGroup do not see the task as cancelled.
+            # Task.uncancel() is new in Python 3.11; earlier versions keep no cancel count to withdraw.
+            if hasattr(task, "uncancel"):
+                task.uncancel()
+            raise GenerationCancelled(cancel_token.reason)
+        finally:
+            active = False
+
+    @contextlib.asynccontextmanager
+    async def _aopen_upstream_stream(self, payload: Dict[str, Any], stage_name: str, cancel_token: Optional[CancellationToken] = None):
+        """Async counterpart of PerplexityClient._open_upstream_stream."""
+        attempt = 0
+        while True:
+            async with self._upstream_aslot(payload, cancel_token):
+                check_cancelled(cancel_token)
+                async with self._get_async_http_client().stream("POST", self.chat_endpoint, content=self._encode_payload(payload)) as response:
+                    metrics.UPSTREAM_REQUESTS.inc(stage=stage_name, status=response.status_code)
+                    delay = self._upstream_retry_delay(response.status_code, response.headers.get('Retry-After'), attempt)
+                    if delay is None:
+                        async with self._ainterrupt_on_cancel(cancel_token):
+                            yield response
+                        return
+            logger.warning(f"Perplexity answered {response.status_code} for {stage_name}, retrying in {delay:.1f}s ({attempt + 1}/{self.upstream_retries})")
+            await asleep(cancel_token, delay)
+            attempt += 1
+
+    async def _astream_completion(self, payload: Dict[str, Any], stage_name: str, result: Dict[str, Any],
+                                  event_fields: Optional[Dict[str, Any]] = None,
+                                  cancel_token: Optional[CancellationToken] = None) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        Async counterpart of PerplexityClient._stream_completion. Async generators cannot return a value,
+        so the parsed response (or None if the call failed) is stored in result["value"].
+        """
+        result["value"] = None
+        event_fields = event_fields or {}
+        stage_response = StageResponseParser(emit_partials=self.partial_json_events)
+        coalescer, markdown_stream = self._new_reasoning_streams()
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = self.response_cache.make_key(payload)
+            # The disk tier does blocking SQLite I/O, keep it off the event loop
+            cached_response_text = await asyncio.to_thread(self.response_cache.get, cache_key)
+            if cached_response_text is not None:
+                logger.info(f"Response cache hit for {stage_name} ({cache_key[:12]})")
+                metrics.RESPONSE_CACHE_HITS.inc(stage=stage_name)
+                for event in self._replay_cached_response(cached_response_text, stage_name, event_fields, stage_response):
+                    yield event
+                result["value"] = stage_response
+                return
+
+        sub_schema_for_stage = payload["response_format"]["json_schema"]["schema"]
+        stream_done = False
+        call_metrics = metrics.UpstreamCallMetrics(stage_name)
+
+        try:
+            logger.info(f"Requesting Perplexity for {stage_name}. Sub-schema properties: {list(sub_schema_for_stage.get('properties', {}).keys())}")
+            # The upstream slot is held for the whole streamed response, as in the sync client
+            async with self._aopen_upstream_stream(payload, stage_name, cancel_token) as response:
+                call_metrics.response_started()
+                if response.status_code != 200:
+                    error_body = (await response.aread()).decode('utf-8', errors='replace')
+                    error_msg = f"Perplexity API Error for {stage_name}: {response.status_code} - {error_body}"
+                    logger.error(error_msg)
+                    call_metrics.failed("http_status")
+                    yield {"type": "error", "stage_name": stage_name, "content": error_msg, **event_fields}
+                    return
+
+                # As in the sync client, read to the end so the connection goes back to the pool
+                async for line_text in response.aiter_lines():
+                    call_metrics.response_bytes += len(line_text)
+                    check_cancelled(cancel_token)
+                    if not line_text or stream_done:
+                        continue
+                    parse_started = time.perf_counter()
+                    delta_content = self._parse_stream_line(line_text, stage_name)
+                    if delta_content is None:
+                        stream_done = True
+                        continue
+                    if delta_content:
+                        reasoning_delta = stage_response.feed(delta_content)
+                        reasoning_events = self._reasoning_events(stage_name, reasoning_delta, coalescer, markdown_stream, event_fields)
+                        partial_events = self._partial_json_events(stage_name, stage_response, event_fields)
+                        call_metrics.delta_parsed(parse_started, reasoning_delta, stage_response.json_started)
+                        for event in reasoning_events + partial_events:
+                            yield event
+            stage_response.close()
+            for event in self._reasoning_events(stage_name, "", coalescer, markdown_stream, event_fields, final=True):
+                yield event
+            for event in self._partial_json_events(stage_name, stage_response, event_fields):
+                yield event
+
+            call_metrics.finished()
+            logger.info(f"Stream complete for {stage_name}. Accumulated response length: {len(stage_response.text)}")
+        except GenerationCancelled:
+            logger.info(f"Cancelled the upstream call of {stage_name}")
+            call_metrics.failed("cancelled")
+            return
+        except httpx.HTTPError as e:
+            error_msg = f"RequestException during {stage_name}: {str(e)}"
+            logger.error(error_msg)
+            call_metrics.failed("connection")
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_failure()
+            # Reasoning that arrived before the failure is still sent
+            for event in self._reasoning_events(stage_name, "", coalescer, markdown_stream, event_fields, final=True):
+                yield event
+            yield {"type": "error", "stage_name": stage_name, "content": error_msg, **event_fields}
+            return
+        except Exception as e_generic:
+            error_msg = f"Generic Exception during {stage_name} API call: {str(e_generic)}"
+            logger.exception(f"Generic exception in {stage_name}:")
+            call_metrics.failed("exception")
+            for event in self._reasoning_events(stage_name, "", coalescer, markdown_stream, event_fields, final=True):
+                yield event
+            yield {"type": "error", "stage_name": stage_name, "content": error_msg, **event_fields}
+            return
+
+        if cache_key is not None and stream_done and stage_response.json_output:
+            await asyncio.to_thread(self.response_cache.set, cache_key, stage_response.text)
+        result["value"] = stage_response
+
+    async def _astream_stage(self, stage_idx: int, stage_config: Dict[str, Any], patient_form_data: Dict[str, Any],
+                             care_environment: str, focus_areas: List[str], current_care_plan: Dict[str, Any],
+                             result: Dict[str, Any], cancel_token: Optional[CancellationToken] = None) -> AsyncGenerator[Dict[str, Any], None]:
+        """Async counterpart of PerplexityClient._stream_stage; the stage JSON is stored in result["value"]."""
+        result["value"] = None
+        with contextlib.closing(self._stage_flow(stage_idx, stage_config, patient_form_data, care_environment, focus_areas, current_care_plan, cancel_token)) as flow:
+            reply = None
+            while True:
+                try:
+                    item = flow.send(reply)
+                except StopIteration as stop:
+                    result["value"] = stop.value
+                    return
+                reply = None
+                if isinstance(item, CompletionCall):
+                    completion_result: Dict[str, Any] = {}
+                    async for event in self._astream_completion(item.payload, item.stage_name, completion_result, item.event_fields, cancel_token):
+                        yield event
+                    reply = completion_result["value"]
+                elif isinstance(item, CallBatch):
+                    def stream_call(call: CompletionCall, call_result: Dict[str, Any]) -> AsyncGenerator[Dict[str, Any], None]:
+                        return self._astream_completion(call.payload, call.stage_name, call_result, call.event_fields, cancel_token)
+                    async with contextlib.aclosing(self._arun_concurrently(item, stream_call)) as runs:
+                        async for kind, value in runs:
+                            if kind == "event":
+                                yield value
+                            else:
+                                item.finish(*value)
+                else:
+                    yield item
+
+    async def _arun_concurrently(self, work: Union[StageScheduler, CallBatch],
+                                 make_stream: Callable[[Any, Dict[str, Any]], AsyncGenerator[Dict[str, Any], None]]) -> AsyncGenerator[Tuple[str, Any], None]:
+        """
+        Async counterpart of PerplexityClient._run_concurrently, with one task per stream. Async generators
+        cannot return a value, so make_stream(job, result) stores it in result["value"].
+        """
+        stream_queue: asyncio.Queue = asyncio.Queue() # (kind, value)
+        stream_slots = asyncio.Semaphore(work.max_concurrency)
+
+        async def run_stream(key: Any, job: Any) -> None:
+            result: Dict[str, Any] = {"value": None}
+            try:
+                async with stream_slots:
+                    async for event in make_stream(job, result):
+                        await stream_queue.put(("event", event))
+            except Exception as e:
+                await stream_queue.put(("event", work.error_event(key, e)))
+            finally:
+                await stream_queue.put(("done", (key, result["value"])))
+
+        running_tasks: Dict[Any, "asyncio.Task"] = {}
+        try:
+            while True:
+                for key, job in work.start():
+                    running_tasks[key] = asyncio.ensure_future(run_stream(key, job))
+                if not running_tasks:
+                    return
+                kind, item = await stream_queue.get()
+                if kind == "done":
+                    running_tasks.pop(item[0], None)
+                yield kind, item
+        finally:
+            # Only has work to do if the consumer stopped iterating early
+            for task in running_tasks.values():
+                task.cancel()
+
+    async def astream_full_care_plan(self, patient_form_data: Dict[str, Any], care_environment: str, focus_areas: List[str],
+                                     stage_outputs: Optional[Dict[str, Dict[str, Any]]] = None, stages_to_run: Optional[List[str]] = None,
+                                     on_stage_finished: Optional[StageFinishedCallback] = None,
+                                     cancel_token: Optional[CancellationToken] = None) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        Async counterpart of PerplexityClient.stream_full_care_plan. on_stage_finished may block (e.g. to write
+        a checkpoint), so it runs in a worker thread.
+        """
+        stage_scheduler = self._schedule_stages(stage_outputs, stages_to_run, cancel_token)
+        yield {"type": "overall_generation_start"}
+
+        def stream_stage(job: StageJob, stage_result: Dict[str, Any]) -> AsyncGenerator[Dict[str, Any], None]:
+            return self._astream_stage(job.stage_idx, job.stage_config, patient_form_data, care_environment, focus_areas, job.current_care_plan, stage_result, cancel_token)
+
+        async with contextlib.aclosing(self._arun_concurrently(stage_scheduler, stream_stage)) as runs:
+            async for kind, item in runs:
+                if kind == "event":
+                    yield item
+                    continue
+                stage_name, stage_json_output = item
+                status = stage_scheduler.finish(stage_name, stage_json_output)
+                if on_stage_finished is not None:
+                    await asyncio.to_thread(on_stage_finished, stage_name, status, stage_json_output or None)
+        yield stage_scheduler.final_event()
+
+
+_async_client_lock = threading.Lock()
+
+def get_async_perplexity_client() -> AsyncPerplexityClient:
+    # The response cache, upstream limiter, circuit breaker and merge engine are the process-wide ones
+    # get_perplexity_client() uses too, so both clients count against the same limits; only the httpx pool is its own
+    if not hasattr(get_async_perplexity_client, 'instance'):
+        with _async_client_lock:
+            if not hasattr(get_async_perplexity_client, 'instance'):
+                get_async_perplexity_client.instance = AsyncPerplexityClient()
+    return get_async_perplexity_client.instance
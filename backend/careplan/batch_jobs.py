@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Batch Jobs Module
+----------------
+Generates care plans for many patients at once, e.g. a whole unit census overnight. Jobs are
+queued and their records processed by a pool of worker threads through a Perplexity client
+whose upstream calls share one concurrency and rate limit. Each job writes one NDJSON line per
+patient and tracks its progress and throughput.
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+from typing import Dict, List, Any, Optional
+
+from perplexity_client import PerplexityClient
+from rate_limiter import UpstreamLimiter, get_default_upstream_limiter, PERPLEXITY_ADAPTIVE_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# Batch configuration
+CARE_PLAN_BATCH_WORKERS = int(os.environ.get('CARE_PLAN_BATCH_WORKERS', 4))
+CARE_PLAN_BATCH_MAX_UPSTREAM_CONCURRENCY = int(os.environ.get('CARE_PLAN_BATCH_MAX_UPSTREAM_CONCURRENCY', 8))
+CARE_PLAN_BATCH_REQUESTS_PER_MINUTE = float(os.environ.get('CARE_PLAN_BATCH_REQUESTS_PER_MINUTE', 50))
+CARE_PLAN_BATCH_OUTPUT_DIR = os.environ.get('CARE_PLAN_BATCH_OUTPUT_DIR', 'batch_results')
+CARE_PLAN_BATCH_MAX_RECORDS = int(os.environ.get('CARE_PLAN_BATCH_MAX_RECORDS', 1000))
+# Seconds a finished job stays queryable before it is forgotten (its NDJSON file is kept)
+CARE_PLAN_BATCH_JOB_TTL = float(os.environ.get('CARE_PLAN_BATCH_JOB_TTL', 24 * 60 * 60))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+
+# Outcome of one record: a full plan, a plan missing the stages that reported errors, or no plan
+RESULT_SUCCEEDED = "succeeded"
+RESULT_PARTIAL = "partial"
+RESULT_FAILED = "failed"
+
+class BatchJob:
+    """One submitted batch: its records, NDJSON output file and progress counters."""
+
+    def __init__(self, records: List[Dict[str, Any]], output_dir: str):
+        self.job_id = str(uuid.uuid4())
+        self.records = records
+        self.output_path = os.path.join(output_dir, f"{self.job_id}.ndjson")
+        self.status = JOB_QUEUED
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.succeeded = 0
+        self.partial = 0
+        self.failed = 0
+        self.upstream_errors = 0
+        self.plan_seconds_total = 0.0
+        self._lock = threading.Lock()
+
+    def record_result(self, result: Dict[str, Any]) -> None:
+        """Appends one patient's result to the output file and updates the counters."""
+        with self._lock:
+            with open(self.output_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result) + "\n")
+            if result["status"] == RESULT_SUCCEEDED:
+                self.succeeded += 1
+            elif result["status"] == RESULT_PARTIAL:
+                self.partial += 1
+            else:
+                self.failed += 1
+            self.upstream_errors += len(result["errors"])
+            self.plan_seconds_total += result["duration_seconds"]
+            if self.succeeded + self.partial + self.failed == len(self.records):
+                self.status = JOB_COMPLETED
+                self.finished_at = time.time()
+                logger.info(f"Batch job {self.job_id} finished: {self.succeeded} succeeded, {self.partial} partial, {self.failed} failed")
+
+    def mark_started(self) -> None:
+        with self._lock:
+            if self.started_at is None:
+                self.started_at = time.time()
+                self.status = JOB_RUNNING
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            processed = self.succeeded + self.partial + self.failed
+            end = self.finished_at or time.time()
+            elapsed = end - self.started_at if self.started_at else 0.0
+            return {
+                "job_id": self.job_id,
+                "status": self.status,
+                "total": len(self.records),
+                "processed": processed,
+                "succeeded": self.succeeded,
+                "partial": self.partial,
+                "failed": self.failed,
+                "progress": processed / len(self.records),
+                "upstream_errors": self.upstream_errors,
+                "queued_seconds": (self.started_at or time.time()) - self.submitted_at,
+                "elapsed_seconds": elapsed,
+                "plans_per_minute": processed * 60 / elapsed if elapsed else 0.0,
+                "mean_plan_seconds": self.plan_seconds_total / processed if processed else 0.0,
+                "output_path": self.output_path,
+            }
+
+class BatchRunner:
+    """
+    FIFO queue of (job, record index) work items served by a fixed pool of worker threads, started on
+    the first submit. All workers share one client, whose limiter caps the upstream calls of every running
+    job together; it is a sub-limit of the process limiter, so batch calls also count against the
+    interactive ones and back off with them. Finished jobs are forgotten job_ttl seconds after they finished.
+    """
+
+    def __init__(self, client: Optional[PerplexityClient] = None, workers: int = CARE_PLAN_BATCH_WORKERS,
+                 output_dir: str = CARE_PLAN_BATCH_OUTPUT_DIR, max_records: int = CARE_PLAN_BATCH_MAX_RECORDS,
+                 job_ttl: float = CARE_PLAN_BATCH_JOB_TTL):
+        self.client = client or PerplexityClient(
+            upstream_limiter=UpstreamLimiter(CARE_PLAN_BATCH_MAX_UPSTREAM_CONCURRENCY, CARE_PLAN_BATCH_REQUESTS_PER_MINUTE,
+                                             adaptive=PERPLEXITY_ADAPTIVE_CONCURRENCY, parent=get_default_upstream_limiter())
+        )
+        self.workers = max(1, workers)
+        self.output_dir = output_dir
+        self.max_records = max_records
+        self.job_ttl = job_ttl
+        self._queue: queue.Queue = queue.Queue() # (job, record index)
+        self._jobs: Dict[str, BatchJob] = {}
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+    def submit(self, records: List[Dict[str, Any]]) -> BatchJob:
+        """Queues a job. Each record needs patient_form_data, care_environment and focus_areas. Raises ValueError for bad input."""
+        if not records:
+            raise ValueError("A batch needs at least one record")
+        if len(records) > self.max_records:
+            raise ValueError(f"A batch can hold at most {self.max_records} records")
+        for index, record in enumerate(records):
+            if not isinstance(record, dict) or not isinstance(record.get("patient_form_data"), dict):
+                raise ValueError(f"Record {index} has no patient_form_data object")
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        job = BatchJob(records, self.output_dir)
+        with self._lock:
+            self._evict_finished()
+            self._jobs[job.job_id] = job
+            self._start_workers()
+        for index in range(len(records)):
+            self._queue.put((job, index))
+        logger.info(f"Queued batch job {job.job_id} with {len(records)} records")
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        with self._lock:
+            self._evict_finished()
+            return self._jobs.get(job_id)
+
+    def _evict_finished(self) -> None:
+        # Caller holds the lock
+        cutoff = time.time() - self.job_ttl
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished_at is not None and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def _start_workers(self) -> None:
+        # Caller holds the lock
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"careplan-batch-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self) -> None:
+        while True:
+            job, index = self._queue.get()
+            try:
+                job.mark_started()
+                job.record_result(self._generate(job.records[index], index))
+            except Exception:
+                logger.exception(f"Batch job {job.job_id} could not record result {index}:")
+            finally:
+                self._queue.task_done()
+
+    def _generate(self, record: Dict[str, Any], index: int) -> Dict[str, Any]:
+        started = time.time()
+        care_plan = None
+        errors = []
+        try:
+            for event in self.client.stream_full_care_plan(record["patient_form_data"], record.get("care_environment", ""), record.get("focus_areas", [])):
+                if event["type"] == "error":
+                    errors.append({"stage_name": event.get("stage_name"), "content": event.get("content")})
+                elif event["type"] == "full_care_plan_complete":
+                    care_plan = event["care_plan"]
+        except Exception as e:
+            logger.exception(f"Batch record {index} failed:")
+            errors.append({"stage_name": None, "content": str(e)})
+        if not care_plan:
+            status = RESULT_FAILED
+        else:
+            status = RESULT_PARTIAL if errors else RESULT_SUCCEEDED
+        return {
+            "index": index,
+            "status": status,
+            "care_plan": care_plan,
+            "errors": errors,
+            "duration_seconds": time.time() - started,
+        }
+
+_runner_lock = threading.Lock()
+
+def get_batch_runner() -> BatchRunner:
+    if not hasattr(get_batch_runner, 'instance'):
+        with _runner_lock:
+            if not hasattr(get_batch_runner, 'instance'):
+                get_batch_runner.instance = BatchRunner()
+    return get_batch_runner.instance
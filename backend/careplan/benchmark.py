@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Benchmark
+---------
+Drives the care plan backend with concurrent streaming generations and reports
+time-to-first-event, per-stage latency, event throughput and server memory per stream.
+
+By default it starts mock_sonar_server.py and the backend itself, so no API credit is spent:
+
+    python benchmark.py --streams 50 --concurrency 25
+    python benchmark.py --server asgi --mock-args "--tokens-per-second 100 --error-rate 0.05"
+
+Point --url at a backend that is already running to measure it instead (memory is then only
+reported with --server-pid).
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import socket
+import tempfile
+import argparse
+import contextlib
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Optional, Tuple
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SAMPLE_PATIENT_FORM_DATA = {
+    "patient_full_name": "Benchmark Patient",
+    "patient_age": 72,
+    "patient_gender": "Female",
+    "patient_admission_date": "2026-01-05",
+    "allergies": ["Penicillin"],
+    "vital_bp": "148/92", "vital_pulse": "104", "vital_resp_rate": "24", "vital_temp": "98.4", "vital_o2sat": "90%",
+    "primary_diagnosis_text": "Acute decompensated heart failure (HFrEF, EF 30%)",
+    "secondaryDiagnoses": ["Type 2 diabetes mellitus", "Chronic kidney disease stage 3"],
+    "medications": [{"med_n_name": "Furosemide", "med_n_dosage": "40 mg", "med_n_route": "IV", "med_n_frequency": "BID"}],
+    "last_imaging_summary": "Chest X-ray: bilateral pleural effusions, cardiomegaly",
+}
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile, None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+def read_rss_bytes(pid: int) -> Optional[int]:
+    """Resident set size of a process (Linux /proc only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+class MemorySampler:
+    """Samples a process's RSS in the background and keeps the peak."""
+
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.baseline = read_rss_bytes(pid)
+        self.peak = self.baseline
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            rss = read_rss_bytes(self.pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def __enter__(self) -> "MemorySampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+
+def run_stream(base_url: str, index: int, timeout: float) -> Dict[str, Any]:
+    """Runs one generation through initiate-stream and stream, timing its events."""
+    url = urlsplit(base_url)
+    result: Dict[str, Any] = {"index": index, "ok": False, "events": 0, "error_events": 0, "stages": {}}
+    # A distinct MRN per stream keeps the response cache from answering repeated patients
+    body = json.dumps({
+        "patient_form_data": dict(SAMPLE_PATIENT_FORM_DATA, patient_mrn=f"BENCH-{index}-{time.time_ns()}"),
+        "care_environment": "Inpatient cardiac step-down unit",
+        "focus_areas": ["fluid balance", "medication adherence"],
+    })
+    stage_started: Dict[str, float] = {}
+    started = time.perf_counter()
+    connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+    try:
+        connection.request("POST", "/api/careplan/initiate-stream", body=body, headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        initiated = json.loads(response.read() or b"{}")
+        if response.status != 200:
+            result["error"] = f"initiate-stream answered {response.status}: {initiated.get('error')}"
+            return result
+
+        connection.request("GET", f"/api/careplan/stream?streamId={initiated['stream_id']}")
+        response = connection.getresponse()
+        if response.status != 200:
+            result["error"] = f"stream answered {response.status}"
+            return result
+
+        for raw_line in response:
+            if not raw_line.startswith(b"data: "):
+                continue
+            now = time.perf_counter()
+            payload = raw_line[len(b"data: "):].strip()
+            result["events"] += 1
+            result.setdefault("first_event", now - started)
+            if payload == b"[DONE]":
+                result["ok"] = True
+                break
+            event = json.loads(payload)
+            event_type = event.get("type")
+            if event_type == "reasoning_text_chunk":
+                result.setdefault("first_reasoning", now - started)
+            elif event_type == "stage_start":
+                stage_started[event["stage_name"]] = now
+            elif event_type == "stage_json_chunk" and event.get("stage_name") in stage_started:
+                result["stages"][event["stage_name"]] = now - stage_started[event["stage_name"]]
+            elif event_type == "error":
+                result["error_events"] += 1
+        result["duration"] = time.perf_counter() - started
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        connection.close()
+    return result
+
+def summarize(results: List[Dict[str, Any]], wall_seconds: float, concurrency: int,
+              memory: Optional[MemorySampler]) -> Dict[str, Any]:
+    def distribution(values: List[float]) -> Dict[str, Optional[float]]:
+        return {"p50": percentile(values, 0.5), "p99": percentile(values, 0.99), "max": max(values) if values else None}
+
+    completed = [result for result in results if result["ok"]]
+    stage_names = sorted({stage_name for result in completed for stage_name in result["stages"]})
+    total_events = sum(result["events"] for result in results)
+    summary = {
+        "streams": len(results),
+        "completed": len(completed),
+        "failed": len(results) - len(completed),
+        "error_events": sum(result["error_events"] for result in results),
+        "errors": sorted({result["error"] for result in results if result.get("error")}),
+        "wall_seconds": wall_seconds,
+        "time_to_first_event": distribution([result["first_event"] for result in results if "first_event" in result]),
+        "time_to_first_reasoning": distribution([result["first_reasoning"] for result in results if "first_reasoning" in result]),
+        "stream_duration": distribution([result["duration"] for result in completed]),
+        "stage_latency": {stage_name: distribution([result["stages"][stage_name] for result in completed if stage_name in result["stages"]])
+                          for stage_name in stage_names},
+        "events": total_events,
+        "events_per_second": total_events / wall_seconds if wall_seconds else 0.0,
+    }
+    if memory is not None and memory.baseline is not None and memory.peak is not None:
+        summary["memory"] = {
+            "baseline_bytes": memory.baseline,
+            "peak_bytes": memory.peak,
+            # Peak growth over the streams open at once
+            "per_stream_bytes": (memory.peak - memory.baseline) / min(concurrency, len(results)),
+        }
+    return summary
+
+def print_summary(summary: Dict[str, Any]) -> None:
+    def ms(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value * 1000:.0f} ms"
+
+    print(f"\nStreams: {summary['completed']}/{summary['streams']} completed in {summary['wall_seconds']:.1f}s, "
+          f"{summary['error_events']} error events")
+    for error in summary["errors"]:
+        print(f"  failure: {error}")
+    for label, key in (("Time to first event", "time_to_first_event"), ("Time to first reasoning", "time_to_first_reasoning"),
+                       ("Stream duration", "stream_duration")):
+        print(f"{label + ':':26} p50 {ms(summary[key]['p50']):>10}   p99 {ms(summary[key]['p99']):>10}")
+    print("Stage latency:")
+    for stage_name, latency in summary["stage_latency"].items():
+        print(f"  {stage_name:36} p50 {ms(latency['p50']):>10}   p99 {ms(latency['p99']):>10}")
+    print(f"Events: {summary['events']} ({summary['events_per_second']:.0f}/s)")
+    if "memory" in summary:
+        memory = summary["memory"]
+        print(f"Server RSS: {memory['baseline_bytes'] / 2**20:.1f} MiB -> {memory['peak_bytes'] / 2**20:.1f} MiB peak, "
+              f"~{memory['per_stream_bytes'] / 2**10:.0f} KiB per concurrent stream")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for_http(host: str, port: int, path: str, method: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=2)
+            connection.request(method, path)
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Nothing answered on {host}:{port} within {timeout:.0f}s")
+            time.sleep(0.2)
+
+def spawn_servers(server: str, mock_args: List[str], concurrency: int, work_dir: str) -> Tuple[List[subprocess.Popen], str]:
+    """Starts the mock Sonar server and the backend pointed at it; returns both processes (backend last) and the backend URL."""
+    mock_port, backend_port = free_port(), free_port()
+    processes = []
+    mock = subprocess.Popen([sys.executable, os.path.join(BACKEND_DIR, "mock_sonar_server.py"), "--port", str(mock_port)] + mock_args,
+                            stdout=subprocess.DEVNULL)
+    processes.append(mock)
+    env = dict(
+        os.environ,
+        SONAR_API_KEY=os.environ.get("SONAR_API_KEY", "mock-key"),
+        PERPLEXITY_BASE_URL=f"http://127.0.0.1:{mock_port}",
+        # Headroom, since a session is released just after its [DONE] and the next stream may already be initiating
+        CARE_PLAN_MAX_CONCURRENT_GENERATIONS=os.environ.get("CARE_PLAN_MAX_CONCURRENT_GENERATIONS", str(max(20, 2 * concurrency))),
+        PYTHONPATH=BACKEND_DIR,
+    )
+    if server == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "asgi:application", "--host", "127.0.0.1", "--port", str(backend_port),
+                   "--log-level", "warning"]
+    else:
+        # app.py's __main__ runs Flask's debug reloader, which would hide the serving process's memory
+        command = [sys.executable, "-c", f"import app; app.app.run(host='127.0.0.1', port={backend_port}, threaded=True)"]
+    # Started in work_dir so the SQLite stores and batch files of the run stay out of the source tree
+    processes.append(subprocess.Popen(command, env=env, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    try:
+        wait_for_http("127.0.0.1", mock_port, "/", "GET")
+        wait_for_http("127.0.0.1", backend_port, "/api/healthcheck", "GET")
+    except RuntimeError:
+        for process in processes:
+            process.terminate()
+        raise
+    return processes, f"http://127.0.0.1:{backend_port}"
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the care plan backend with concurrent streaming generations")
+    parser.add_argument("--streams", type=int, default=20, help="Generations to run")
+    parser.add_argument("--concurrency", type=int, default=10, help="Generations open at once")
+    parser.add_argument("--url", help="Base URL of a running backend; by default a mock-backed one is started")
+    parser.add_argument("--server-pid", type=int, help="PID of the backend at --url, to report its memory")
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask", help="Backend to start when --url is not given")
+    parser.add_argument("--mock-args", default="", help="Options passed to mock_sonar_server.py, e.g. \"--tokens-per-second 100\"")
+    parser.add_argument("--timeout", type=float, default=600, help="Socket timeout per stream, in seconds")
+    parser.add_argument("--json", dest="json_path", help="Also write the summary to this file")
+    args = parser.parse_args()
+
+    processes: List[subprocess.Popen] = []
+    try:
+        if args.url:
+            base_url, server_pid = args.url, args.server_pid
+        else:
+            work_dir = tempfile.mkdtemp(prefix="careplan-benchmark-")
+            processes, base_url = spawn_servers(args.server, shlex.split(args.mock_args), args.concurrency, work_dir)
+            server_pid = processes[-1].pid
+            print(f"Started mock Sonar server and {args.server} backend ({base_url}, files in {work_dir})")
+
+        memory = MemorySampler(server_pid) if server_pid else None
+        print(f"Running {args.streams} generations, {args.concurrency} at a time...")
+        started = time.perf_counter()
+        with memory or contextlib.nullcontext():
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                results = list(executor.map(lambda index: run_stream(base_url, index, args.timeout), range(args.streams)))
+        summary = summarize(results, time.perf_counter() - started, args.concurrency, memory)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+    print_summary(summary)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Cancellation Module
+------------------
+Cancellation tokens shared between a generation job and the client producing its events. The job
+cancels the token once nobody is listening any more; the client checks it between stages and while
+waiting for an upstream slot or a retry, closes the response of an upstream call in flight, and stops
+with GenerationCancelled.
+"""
+
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# How often async waits look at their token again
+ASYNC_CANCEL_POLL_SECONDS = 0.05
+
+class GenerationCancelled(Exception):
+    """Raised inside a generation whose CancellationToken was cancelled."""
+
+class CancellationToken:
+    """A one-way flag, safe to set from any thread."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], None]] = []
+        self.reason = ""
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "") -> bool:
+        """Cancels the token; returns False if it already was."""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Cancellation callback failed:")
+        return True
+
+    def add_callback(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Calls callback, in the thread that cancels the token, once it is cancelled (at once if it already is).
+        Returns a function removing the callback again.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                def remove() -> None:
+                    with self._lock:
+                        if callback in self._callbacks:
+                            self._callbacks.remove(callback)
+                return remove
+        callback()
+        return lambda: None
+
+    def sleep(self, seconds: float) -> None:
+        """Sleeps for seconds, raising GenerationCancelled as soon as the token is cancelled."""
+        if self._event.wait(seconds):
+            raise GenerationCancelled(self.reason)
+
+def check_cancelled(token: Optional[CancellationToken]) -> None:
+    """Raises GenerationCancelled if token (which may be None) was cancelled."""
+    if token is not None and token.cancelled:
+        raise GenerationCancelled(token.reason)
+
+def is_cancelled(token: Optional[CancellationToken]) -> bool:
+    return token is not None and token.cancelled
+
+@contextmanager
+def on_cancel(token: Optional[CancellationToken], callback: Callable[[], None]) -> Iterator[None]:
+    """Calls callback if token (which may be None) is cancelled while the block runs."""
+    if token is None:
+        yield
+        return
+    remove = token.add_callback(callback)
+    try:
+        yield
+    finally:
+        remove()
+
+async def asleep(token: Optional[CancellationToken], seconds: float) -> None:
+    """Async counterpart of CancellationToken.sleep; notices the cancellation within ASYNC_CANCEL_POLL_SECONDS."""
+    if token is None:
+        await asyncio.sleep(seconds)
+        return
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + seconds
+    while True:
+        check_cancelled(token)
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(remaining, ASYNC_CANCEL_POLL_SECONDS))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Care Plan Patch Module
+---------------------
+The "patch" event mode of a stream. Instead of each stage's JSON (stage_json_chunk) and the
+whole care plan again at the end (full_care_plan_complete), the client receives RFC 6902 JSON
+Patch operations taking its copy of the plan from one merge to the next, and a checksum of the
+final plan to verify the copy against. The checksum hashes the RFC 8785 (JCS) canonical JSON of
+the plan, which browsers can reproduce from the parsed plan.
+"""
+
+import os
+import re
+import json
+import math
+import hashlib
+from decimal import Decimal
+from typing import Dict, List, Any, Optional
+from merge_engine import MergeEngine
+import serialization
+
+# How care plan contents are streamed: "full" (stage JSON and the whole final plan) or "patch"
+CARE_PLAN_EVENT_MODE = os.environ.get('CARE_PLAN_EVENT_MODE', 'full')
+EVENT_MODES = ("full", "patch")
+
+# A str holding a surrogate holds a lone one; JSON.stringify escapes those
+LONE_SURROGATE = re.compile('[\ud800-\udfff]')
+
+def _escape_pointer_token(key: str) -> str:
+    return key.replace('~', '~0').replace('/', '~1')
+
+def _diff(old: Any, new: Any, pointer: str, operations: List[Dict[str, Any]]) -> None:
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                operations.append({"op": "remove", "path": pointer + "/" + _escape_pointer_token(key)})
+        for key, value in new.items():
+            child_pointer = pointer + "/" + _escape_pointer_token(key)
+            if key in old:
+                _diff(old[key], value, child_pointer, operations)
+            else:
+                operations.append({"op": "add", "path": child_pointer, "value": value})
+        return
+    if isinstance(old, list) and isinstance(new, list):
+        common = min(len(old), len(new))
+        for index in range(common):
+            _diff(old[index], new[index], f"{pointer}/{index}", operations)
+        # Removed from the end, so the indices of the elements still to remove do not shift
+        for index in range(len(old) - 1, common - 1, -1):
+            operations.append({"op": "remove", "path": f"{pointer}/{index}"})
+        for index in range(common, len(new)):
+            operations.append({"op": "add", "path": f"{pointer}/{index}", "value": new[index]})
+        return
+    # 1, 1.0 and True compare equal but are different JSON
+    if type(old) is not type(new) or old != new:
+        operations.append({"op": "replace", "path": pointer, "value": new})
+
+def make_patch(old: Any, new: Any) -> List[Dict[str, Any]]:
+    """
+    JSON Patch operations turning the JSON value old into new: objects are compared key by key and arrays
+    element by element (no moves), anything else that differs is replaced. Values are shared with new.
+    """
+    operations: List[Dict[str, Any]] = []
+    _diff(old, new, "", operations)
+    return operations
+
+def _canonical_number(value: Any) -> str:
+    """A number as ECMAScript's Number.prototype.toString() writes it, i.e. as the IEEE 754 double JSON.parse makes of it."""
+    if isinstance(value, int) and abs(value) <= 2 ** 53:
+        return str(value)
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"{value} is not a JSON number")
+    if value == 0:
+        return "0"
+    # repr() gives the shortest digits that round-trip, as ECMAScript does; only the notation differs
+    _, digit_tuple, exponent = Decimal(repr(abs(value))).as_tuple()
+    digits = "".join(map(str, digit_tuple)).rstrip("0")
+    exponent += len(digit_tuple) - len(digits)
+    k, n = len(digits), exponent + len(digits)
+    if k <= n <= 21:
+        number = digits + "0" * (n - k)
+    elif 0 < n <= 21:
+        number = digits[:n] + "." + digits[n:]
+    elif -6 < n <= 0:
+        number = "0." + "0" * -n + digits
+    else:
+        number = digits[0] + ("." + digits[1:] if k > 1 else "") + f"e{n - 1:+d}"
+    return ("-" if value < 0 else "") + number
+
+def _canonical_string(value: str) -> str:
+    # json escapes exactly what JSON.stringify does: quote, backslash and control characters
+    return LONE_SURROGATE.sub(lambda match: f"\\u{ord(match.group()):04x}", json.dumps(value, ensure_ascii=False))
+
+def canonical_json(value: Any) -> str:
+    """
+    The RFC 8785 (JCS) serialization of a JSON value: no whitespace, object keys sorted by their UTF-16
+    code units, strings and numbers written as JSON.stringify writes them (so 1.0 is 1).
+    """
+    if value is None:
+        return "null"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if isinstance(value, str):
+        return _canonical_string(value)
+    if isinstance(value, (int, float)):
+        return _canonical_number(value)
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(canonical_json(element) for element in value) + "]"
+    if isinstance(value, dict):
+        keys = sorted(value, key=lambda key: key.encode('utf-16-be', 'surrogatepass'))
+        return "{" + ",".join(_canonical_string(key) + ":" + canonical_json(value[key]) for key in keys) + "}"
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def care_plan_checksum(care_plan: Dict[str, Any]) -> str:
+    """"sha256:" and the hex SHA-256 of the UTF-8 encoded canonical_json() of the care plan."""
+    return "sha256:" + hashlib.sha256(canonical_json(care_plan).encode('utf-8')).hexdigest()
+
+def resolve_event_mode(requested: Optional[str]) -> str:
+    """The event mode a stream asked for, CARE_PLAN_EVENT_MODE if none. Raises ValueError for unknown modes."""
+    event_mode = requested or CARE_PLAN_EVENT_MODE
+    if event_mode not in EVENT_MODES:
+        raise ValueError(f"Invalid event mode '{event_mode}', expected one of {EVENT_MODES}")
+    return event_mode
+
+class CarePlanPatchEncoder:
+    """
+    Rewrites the events of one generation for the patch mode. Each stage_json_chunk is merged into a
+    care plan of its own with the client's merge engine and replaced by a care_plan_patch event
+    ({"type", "stage_name", "patch"}) holding the changes since the previous one. full_care_plan_complete
+    becomes a last patch to the final plan, if it still differs (e.g. stages kept from a checkpoint on a
+    re-run), and a full_care_plan_complete carrying only its "checksum". stage_json_partial events are
+    dropped, as the patches carry the same values; other events pass unchanged.
+    """
+
+    def __init__(self, merge_engine: MergeEngine):
+        self._builder = merge_engine.new_care_plan()
+        # What the client holds: a copy, as the builder changes its care plan in place
+        self._sent: Dict[str, Any] = {}
+
+    def _patch_event(self, care_plan: Dict[str, Any], event_fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        patch = make_patch(self._sent, care_plan)
+        if not patch:
+            return None
+        event = {"type": "care_plan_patch", **event_fields, "patch": patch}
+        self._sent = serialization.loads(serialization.dumps_bytes(care_plan))
+        return event
+
+    def encode(self, event: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """The events to send in place of event."""
+        if event["type"] == "stage_json_chunk":
+            if not event["json_data"]:
+                return []
+            care_plan = self._builder.merge(event["stage_name"], event["json_data"])
+            patch_event = self._patch_event(care_plan, {"stage_name": event["stage_name"]})
+            return [patch_event] if patch_event is not None else []
+        if event["type"] == "stage_json_partial":
+            return []
+        if event["type"] == "full_care_plan_complete":
+            patch_event = self._patch_event(event["care_plan"], {})
+            complete_event = {"type": "full_care_plan_complete", "checksum": care_plan_checksum(event["care_plan"])}
+            return [patch_event, complete_event] if patch_event is not None else [complete_event]
+        return [event]
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Checkpoint Store Module
+----------------------
+Persists the progress of each care plan generation: the patient input, every stage's status
+and JSON output, and the assembled care plan. A plan whose stages failed can then be
+completed by re-running only those stages against the checkpoint.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import tempfile
+import logging
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Checkpoint configuration
+CARE_PLAN_CHECKPOINT_STORE = os.environ.get('CARE_PLAN_CHECKPOINT_STORE', 'sqlite')
+# Kept out of the working directory (and so out of the source tree) unless configured otherwise
+CARE_PLAN_CHECKPOINT_SQLITE_PATH = os.environ.get('CARE_PLAN_CHECKPOINT_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'careplan_checkpoints.db'))
+CARE_PLAN_CHECKPOINT_DIR = os.environ.get('CARE_PLAN_CHECKPOINT_DIR', os.path.join(tempfile.gettempdir(), 'careplan_checkpoints'))
+CARE_PLAN_CHECKPOINT_TTL = float(os.environ.get('CARE_PLAN_CHECKPOINT_TTL', 7 * 24 * 60 * 60))
+CHECKPOINT_STORE_BACKENDS = ("sqlite", "json", "off")
+
+STAGE_STATUS_PENDING = "pending"
+
+class CheckpointStore(ABC):
+    """
+    A checkpoint is a JSON document:
+    {"stream_id", "patient_data", "rerun_of", "stage_status": {stage: status}, "stage_outputs": {stage: json},
+     "care_plan", "updated_at"}
+    Stage statuses are "pending" until the stage finishes, then the status reported by the client.
+    Checkpoints are deleted ttl_seconds after their last update.
+    """
+
+    def __init__(self, ttl_seconds: float = CARE_PLAN_CHECKPOINT_TTL):
+        self.ttl_seconds = ttl_seconds
+
+    @abstractmethod
+    def load(self, stream_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def save(self, checkpoint: Dict[str, Any]) -> None:
+        ...
+
+    def create(self, stream_id: str, patient_data: Dict[str, Any], stage_names: List[str],
+               stage_outputs: Optional[Dict[str, Dict[str, Any]]] = None,
+               stage_status: Optional[Dict[str, str]] = None, rerun_of: Optional[str] = None) -> Dict[str, Any]:
+        """Starts the checkpoint of a generation; stage_names are the stages it is about to run."""
+        stage_status = dict(stage_status or {})
+        stage_status.update({stage_name: STAGE_STATUS_PENDING for stage_name in stage_names})
+        checkpoint = {
+            "stream_id": stream_id,
+            "patient_data": patient_data,
+            "rerun_of": rerun_of,
+            "stage_status": stage_status,
+            "stage_outputs": dict(stage_outputs or {}),
+            "care_plan": None,
+        }
+        self.save(checkpoint)
+        return checkpoint
+
+    def record_stage(self, stream_id: str, stage_name: str, status: str, stage_json_output: Optional[Dict[str, Any]]) -> None:
+        checkpoint = self.load(stream_id)
+        if checkpoint is None:
+            logger.warning(f"No checkpoint for stream {stream_id}, not recording {stage_name}")
+            return
+        checkpoint["stage_status"][stage_name] = status
+        if stage_json_output:
+            checkpoint["stage_outputs"][stage_name] = stage_json_output
+        self.save(checkpoint)
+
+    def record_care_plan(self, stream_id: str, care_plan: Dict[str, Any]) -> None:
+        checkpoint = self.load(stream_id)
+        if checkpoint is None:
+            return
+        checkpoint["care_plan"] = care_plan
+        self.save(checkpoint)
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """Checkpoints in a SQLite file, shared by every worker on the host."""
+
+    def __init__(self, sqlite_path: str = CARE_PLAN_CHECKPOINT_SQLITE_PATH, **options: Any):
+        super().__init__(**options)
+        self.sqlite_path = sqlite_path
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "stream_id TEXT PRIMARY KEY, checkpoint TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.sqlite_path, timeout=5)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def load(self, stream_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with self._connect() as connection:
+                row = connection.execute(
+                    "SELECT checkpoint FROM checkpoints WHERE stream_id = ? AND updated_at >= ?",
+                    (stream_id, time.time() - self.ttl_seconds)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Checkpoint read failed: {str(e)}")
+            return None
+        return json.loads(row[0]) if row else None
+
+    def save(self, checkpoint: Dict[str, Any]) -> None:
+        now = time.time()
+        checkpoint["updated_at"] = now
+        try:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO checkpoints (stream_id, checkpoint, updated_at) VALUES (?, ?, ?)",
+                    (checkpoint["stream_id"], json.dumps(checkpoint), now)
+                )
+                connection.execute("DELETE FROM checkpoints WHERE updated_at < ?", (now - self.ttl_seconds,))
+        except sqlite3.Error as e:
+            # A lost checkpoint only costs a full regeneration later; never fail the stream over it
+            logger.warning(f"Checkpoint write failed: {str(e)}")
+
+class JSONCheckpointStore(CheckpointStore):
+    """One JSON file per checkpoint in a directory."""
+
+    def __init__(self, directory: str = CARE_PLAN_CHECKPOINT_DIR, **options: Any):
+        super().__init__(**options)
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, stream_id: str) -> Optional[str]:
+        try:
+            # Stream IDs are UUIDs; anything else must not become a file path
+            return os.path.join(self.directory, f"{uuid.UUID(stream_id)}.json")
+        except ValueError:
+            return None
+
+    def load(self, stream_id: str) -> Optional[Dict[str, Any]]:
+        path = self._path(stream_id)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Checkpoint read failed: {str(e)}")
+            return None
+        if time.time() - checkpoint.get("updated_at", 0) > self.ttl_seconds:
+            return None
+        return checkpoint
+
+    def save(self, checkpoint: Dict[str, Any]) -> None:
+        path = self._path(checkpoint["stream_id"])
+        if path is None:
+            return
+        checkpoint["updated_at"] = time.time()
+        is_new = not os.path.exists(path)
+        temp_path = f"{path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(checkpoint, f)
+            os.replace(temp_path, path) # Readers never see a half-written checkpoint
+            if is_new:
+                self._purge_expired(checkpoint["updated_at"])
+        except OSError as e:
+            logger.warning(f"Checkpoint write failed: {str(e)}")
+
+    def _purge_expired(self, now: float) -> None:
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json") and now - entry.stat().st_mtime > self.ttl_seconds:
+                os.remove(entry.path)
+
+def get_checkpoint_store(backend: str = CARE_PLAN_CHECKPOINT_STORE) -> Optional[CheckpointStore]:
+    """Returns the checkpoint store configured by CARE_PLAN_CHECKPOINT_STORE, or None if checkpoints are off."""
+    if backend == "off":
+        return None
+    if backend == "sqlite":
+        return SQLiteCheckpointStore()
+    if backend == "json":
+        return JSONCheckpointStore()
+    raise ValueError(f"Invalid checkpoint store '{backend}', expected one of {CHECKPOINT_STORE_BACKENDS}")
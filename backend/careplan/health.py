@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Health Module
+------------
+Upstream health of the Perplexity API as seen by this process. A background prober sends a
+minimal completion on a schedule and caches the outcome, which /api/healthcheck and
+/api/careplan/test read without ever waiting for a probe. A circuit breaker, fed by the
+probes and by the outcome of every upstream call, opens after consecutive failures so new
+generations are refused at once rather than each waiting out the stage timeouts.
+"""
+
+import os
+import time
+import logging
+import threading
+from typing import Dict, Any, Optional, Callable
+
+logger = logging.getLogger(__name__)
+
+# Health configuration (0 turns the background prober, or the circuit breaker, off)
+CARE_PLAN_HEALTH_PROBE_INTERVAL = float(os.environ.get('CARE_PLAN_HEALTH_PROBE_INTERVAL', 60))
+CARE_PLAN_HEALTH_TTL = float(os.environ.get('CARE_PLAN_HEALTH_TTL', 120))
+CARE_PLAN_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CARE_PLAN_CIRCUIT_FAILURE_THRESHOLD', 5))
+CARE_PLAN_CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CARE_PLAN_CIRCUIT_RESET_TIMEOUT', 30))
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+class UpstreamUnavailableError(Exception):
+    """Raised instead of starting a generation while the circuit breaker is open."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"The Perplexity API is unavailable, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class UpstreamProbeError(ValueError):
+    """A failed health probe; status_code is the upstream answer's status, None if the API could not be reached."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+def is_upstream_failure(status_code: int) -> bool:
+    """Whether an upstream answer means calls cannot succeed: server errors and a rejected API key. 429 only asks to slow down."""
+    return status_code >= 500 or status_code in (401, 403)
+
+class CircuitBreaker:
+    """
+    Counts consecutive upstream failures. After failure_threshold of them the circuit opens and
+    allow_request() refuses new work; once reset_timeout has passed it lets one trial through
+    (half open), and the next success closes the circuit while a failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = CARE_PLAN_CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CARE_PLAN_CIRCUIT_RESET_TIMEOUT):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._state = CIRCUIT_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0 # When the circuit opened, or when the last half-open trial was let through
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow_request(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if self._state == CIRCUIT_CLOSED:
+                return True
+            if now - self._opened_at < self.reset_timeout:
+                return False
+            # A trial whose outcome never got reported (e.g. answered from the cache) is replaced after reset_timeout
+            self._state = CIRCUIT_HALF_OPEN
+            self._opened_at = now
+            logger.info("Circuit breaker half open, letting a trial request through")
+            return True
+
+    def retry_after(self) -> int:
+        """Seconds until the circuit lets a request through again (at least 1)."""
+        with self._lock:
+            remaining = self._opened_at + self.reset_timeout - time.monotonic() if self._state != CIRCUIT_CLOSED else 0
+        return max(1, int(remaining + 0.999))
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != CIRCUIT_CLOSED:
+                logger.info("Circuit breaker closed, the Perplexity API answers again")
+            self._state = CIRCUIT_CLOSED
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == CIRCUIT_CLOSED and self._failures < self.failure_threshold:
+                return
+            if self._state != CIRCUIT_OPEN:
+                logger.warning(f"Circuit breaker open after {self._failures} consecutive upstream failures")
+            # Each failure while open (e.g. of a probe) restarts the wait for the next trial
+            self._state = CIRCUIT_OPEN
+            self._opened_at = time.monotonic()
+
+    def record_response(self, status_code: int) -> None:
+        """Reports an upstream answer; 429 and other client errors leave the breaker as it is."""
+        if status_code < 400:
+            self.record_success()
+        elif is_upstream_failure(status_code):
+            self.record_failure()
+
+class HealthMonitor:
+    """
+    Runs probe (a callable raising on failure) every probe_interval seconds in a daemon thread and caches
+    its outcome. A failure carrying an upstream status_code (UpstreamProbeError) is judged by the circuit
+    breaker like any answer, so a 429 does not open it; any other one counts as a failure. status() only reads the cache: a missing result or one older than ttl starts a probe in
+    another thread (so the cache stays fresh without the prober, probe_interval 0) and is reported meanwhile
+    as unknown or stale. Only one probe runs at a time.
+    """
+
+    def __init__(self, probe: Callable[[], Any], circuit_breaker: Optional[CircuitBreaker] = None,
+                 probe_interval: float = CARE_PLAN_HEALTH_PROBE_INTERVAL, ttl: float = CARE_PLAN_HEALTH_TTL):
+        self.probe = probe
+        self.circuit_breaker = circuit_breaker
+        self.probe_interval = probe_interval
+        self.ttl = ttl
+        self._result: Optional[Dict[str, Any]] = None
+        self._checked_at = 0.0 # time.monotonic() of the cached result
+        self._probe_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Starts the background prober, unless probe_interval is 0 or it already runs."""
+        if self.probe_interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="careplan-health-prober", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self.refresh()
+            interval = self.probe_interval
+            if self.circuit_breaker is not None and self.circuit_breaker.state != CIRCUIT_CLOSED:
+                # Probe as often as the breaker would let a trial through, so it closes as soon as the API is back
+                interval = min(interval, self.circuit_breaker.reset_timeout)
+            self._stopped.wait(interval)
+
+    def refresh(self) -> Dict[str, Any]:
+        """Probes now, or waits for the probe already running, and returns its result."""
+        requested = time.monotonic()
+        with self._probe_lock:
+            if self._result is not None and self._checked_at >= requested:
+                return self._result
+            return self._probe()
+
+    def _probe(self) -> Dict[str, Any]:
+        # Called with _probe_lock held
+        started = time.monotonic()
+        status_code = None
+        try:
+            self.probe()
+            healthy, error = True, None
+        except Exception as e:
+            healthy, error = False, str(e)
+            status_code = getattr(e, "status_code", None)
+            logger.warning(f"Upstream health probe failed: {error}")
+        if self.circuit_breaker is not None:
+            if healthy:
+                self.circuit_breaker.record_success()
+            elif status_code is not None:
+                self.circuit_breaker.record_response(status_code)
+            else:
+                self.circuit_breaker.record_failure()
+        self._checked_at = time.monotonic()
+        self._result = {
+            "healthy": healthy,
+            "error": error,
+            "checked_at": time.time(),
+            "latency_seconds": round(self._checked_at - started, 3),
+        }
+        return self._result
+
+    def _refresh_in_background(self) -> None:
+        if not self._probe_lock.acquire(blocking=False):
+            return # A probe is already running
+        def probe_and_release() -> None:
+            try:
+                self._probe()
+            finally:
+                self._probe_lock.release()
+        try:
+            threading.Thread(target=probe_and_release, name="careplan-health-refresh", daemon=True).start()
+        except Exception:
+            self._probe_lock.release()
+            raise
+
+    def status(self) -> Dict[str, Any]:
+        """
+        The cached probe result plus the circuit state and whether the result is stale (older than ttl);
+        healthy is None until the first probe finished. Never waits for a probe.
+        """
+        result = self._result
+        stale = result is None or time.monotonic() - self._checked_at > self.ttl
+        if stale:
+            self._refresh_in_background()
+        if result is None:
+            status = {"healthy": None, "error": None, "checked_at": None, "latency_seconds": None, "age_seconds": None}
+        else:
+            status = dict(result, age_seconds=round(time.time() - result["checked_at"], 3))
+        status["stale"] = stale
+        if self.circuit_breaker is not None:
+            status["circuit"] = self.circuit_breaker.state
+        return status
+
+    def ensure_available(self) -> None:
+        """Raises UpstreamUnavailableError while the circuit breaker refuses new generations."""
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow_request():
+            raise UpstreamUnavailableError(self.circuit_breaker.retry_after())
+
+_default_breaker_lock = threading.Lock()
+
+def get_default_circuit_breaker() -> Optional[CircuitBreaker]:
+    """
+    Returns the circuit breaker shared by every client and health monitor of the process;
+    None if CARE_PLAN_CIRCUIT_FAILURE_THRESHOLD is 0.
+    """
+    if CARE_PLAN_CIRCUIT_FAILURE_THRESHOLD <= 0:
+        return None
+    if not hasattr(get_default_circuit_breaker, 'instance'):
+        with _default_breaker_lock:
+            if not hasattr(get_default_circuit_breaker, 'instance'):
+                get_default_circuit_breaker.instance = CircuitBreaker()
+    return get_default_circuit_breaker.instance
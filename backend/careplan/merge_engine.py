@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Merge Engine Module
+------------------
+Merges stage outputs into a care plan along the property paths each stage generates
+(properties_to_generate_or_update, '*' stepping into every array element), using ADPIE_SCHEMA
+to tell arrays of objects, which are merged element by element, from values that are replaced.
+Elements are matched by index, or by a key field where one is configured.
+
+Stages rank in STAGES_CONFIG order, and a stage never overwrites what a later stage wrote, so
+whole or partial stage results can be merged in any order (e.g. as parallel stages finish) and
+give the same care plan as merging them in order. The length of an array of objects is set by
+the latest stage whose output contains the whole array (e.g. stage 2 for each diagnosis' goals);
+earlier stages only fill in its existing elements.
+"""
+
+from typing import Dict, List, Any, Optional, Sequence, Tuple, Union
+
+PathStep = Union[str, int]
+Path = Tuple[PathStep, ...]
+
+def _child_schema(schema_node: Optional[Dict[str, Any]], step: PathStep) -> Optional[Dict[str, Any]]:
+    if schema_node is None:
+        return None
+    if isinstance(step, int) or step == "*":
+        items = schema_node.get("items")
+        return items if isinstance(items, dict) else None
+    properties = schema_node.get("properties")
+    return properties.get(step) if isinstance(properties, dict) else None
+
+def _is_object_list(schema_node: Optional[Dict[str, Any]], value: List[Any]) -> bool:
+    if schema_node is not None and schema_node.get("type") == "array":
+        items = schema_node.get("items")
+        return isinstance(items, dict) and items.get("type") == "object"
+    return bool(value) and all(isinstance(element, dict) for element in value)
+
+def _schema_path(path: Sequence[PathStep]) -> Tuple[str, ...]:
+    return tuple("*" if isinstance(step, int) else step for step in path)
+
+def _match_key_value(element: Any, key_name: str) -> Optional[str]:
+    if not isinstance(element, dict) or element.get(key_name) is None:
+        return None
+    return str(element[key_name]).strip().casefold()
+
+class MergeEngine:
+    """
+    Merge rules compiled from a schema and a stages config. match_keys maps the dotted schema path of an
+    array of objects (e.g. "aiAgents") to the field its elements are matched by; elements without that
+    field fall back to matching by index, and unmatched ones are appended.
+    """
+
+    def __init__(self, schema: Dict[str, Any], stages_config: List[Dict[str, Any]], match_keys: Optional[Dict[str, str]] = None):
+        self.schema = schema
+        self.match_keys = {tuple(path.split('.')): key_name for path, key_name in (match_keys or {}).items()}
+        self._stage_ranks = {stage_config["name"]: rank for rank, stage_config in enumerate(stages_config)}
+        self._stage_paths = {
+            stage_config["name"]: [tuple(path.split('.')) for path in stage_config["properties_to_generate_or_update"]]
+            for stage_config in stages_config
+        }
+
+    def new_care_plan(self, care_plan: Optional[Dict[str, Any]] = None) -> "CarePlanBuilder":
+        return CarePlanBuilder(self, care_plan)
+
+    def stage_rank(self, stage_name: str) -> int:
+        if stage_name not in self._stage_ranks:
+            raise ValueError(f"Unknown stage '{stage_name}'")
+        return self._stage_ranks[stage_name]
+
+    def stage_paths(self, stage_name: str) -> List[Tuple[str, ...]]:
+        self.stage_rank(stage_name)
+        return self._stage_paths[stage_name]
+
+    def schema_at(self, path: Sequence[PathStep]) -> Optional[Dict[str, Any]]:
+        schema_node: Optional[Dict[str, Any]] = self.schema
+        for step in path:
+            schema_node = _child_schema(schema_node, step)
+        return schema_node
+
+class CarePlanBuilder:
+    """
+    A care plan being assembled by a MergeEngine. Merging never modifies the stage outputs: objects and
+    arrays of objects are rebuilt in care_plan as they are merged, other values are shared with the output.
+    """
+
+    def __init__(self, engine: MergeEngine, care_plan: Optional[Dict[str, Any]] = None):
+        self.engine = engine
+        self.care_plan: Dict[str, Any] = care_plan if care_plan is not None else {}
+        self._value_ranks: Dict[Path, int] = {} # Path of a replaced value -> rank of the stage that wrote it
+        self._length_ranks: Dict[Path, int] = {} # Path of an array of objects -> rank of the stage that set its length
+        # Elements past the length of an array, kept in case a later stage makes it longer again
+        self._cut_off: Dict[Path, Dict[int, Any]] = {}
+
+    def merge(self, stage_name: str, stage_output: Dict[str, Any]) -> Dict[str, Any]:
+        """Merges a stage's whole output and returns the care plan."""
+        return self.merge_partial(stage_name, (), stage_output)
+
+    def merge_partial(self, stage_name: str, path: Sequence[PathStep], value: Any) -> Dict[str, Any]:
+        """
+        Merges value, the part of a stage's output found at path (keys and array indices, as in
+        stage_json_partial events), and returns the care plan. Only the parts of value on the stage's
+        property paths are merged; a path outside all of them is ignored.
+        """
+        rank = self.engine.stage_rank(stage_name)
+        path = tuple(path)
+        pattern = _schema_path(path)
+        for target in self.engine.stage_paths(stage_name):
+            if len(pattern) < len(target) and target[:len(pattern)] == pattern:
+                # value is an ancestor of the targeted property: follow the rest of the path through it
+                node = self._node_at(path, target[len(pattern)], rank, len(path) + 1)
+                self._merge_along(node, value, target[len(pattern):], path, self.engine.schema_at(path), rank)
+            elif path and pattern[:len(target)] == target:
+                # value is the targeted property or lies inside it
+                parent, key = self._node_at(path[:-1], path[-1], rank, len(target)), path[-1]
+                if isinstance(key, int):
+                    # An element of an array matched by key may sit at another index in the care plan
+                    key_name = self.engine.match_keys.get(pattern[:-1])
+                    key = self._element_index(parent, value, key, key_name)
+                    parent = self._slot(parent, path[:-1], key, rank, len(path) - 1 >= len(target), key_name)
+                self._merge_value(parent, key, value, path[:-1] + (key,), self.engine.schema_at(path), rank)
+                break
+        return self.care_plan
+
+    def _node_at(self, path: Path, next_step: PathStep, rank: int, authored_depth: int) -> Any:
+        """
+        The object or array at path in the care plan, created if missing (an array if next_step is one of
+        its elements). Arrays at authored_depth or deeper are written by the stage itself.
+        """
+        node: Any = self.care_plan
+        for depth, step in enumerate(path):
+            child_step = path[depth + 1] if depth + 1 < len(path) else next_step
+            if isinstance(step, int):
+                node = self._slot(node, path[:depth], step, rank, depth >= authored_depth, None)
+            node = self._child_container(node, step, list if (isinstance(child_step, int) or child_step == "*") else dict)
+        return node
+
+    def _merge_along(self, node: Any, value: Any, steps: Tuple[str, ...], path: Path,
+                     schema_node: Optional[Dict[str, Any]], rank: int) -> None:
+        """Merges value (the output at path) into node (the care plan at path) along the remaining target steps."""
+        step, remaining = steps[0], steps[1:]
+        if step == "*":
+            if not isinstance(value, list) or not isinstance(node, list):
+                return
+            element_schema = _child_schema(schema_node, step)
+            key_name = self.engine.match_keys.get(_schema_path(path))
+            for position, element in enumerate(value):
+                index = self._element_index(node, element, position, key_name)
+                container = self._slot(node, path, index, rank, False, key_name)
+                if not remaining:
+                    self._merge_value(container, index, element, path + (index,), element_schema, rank)
+                elif isinstance(element, dict):
+                    self._merge_along(self._child_container(container, index, dict), element, remaining,
+                                      path + (index,), element_schema, rank)
+            return
+
+        if not isinstance(value, dict) or step not in value or not isinstance(node, dict):
+            return
+        child_schema = _child_schema(schema_node, step)
+        if not remaining:
+            self._merge_value(node, step, value[step], path + (step,), child_schema, rank)
+            return
+        child = self._child_container(node, step, list if remaining[0] == "*" else dict)
+        self._merge_along(child, value[step], remaining, path + (step,), child_schema, rank)
+
+    def _merge_value(self, container: Union[Dict[Any, Any], List[Any]], key: PathStep, value: Any, path: Path,
+                     schema_node: Optional[Dict[str, Any]], rank: int) -> None:
+        """Merges value into container[key]: objects key by key, arrays of objects element by element, anything else replaced."""
+        if isinstance(value, dict):
+            existing = self._child_container(container, key, dict)
+            for child_key, child_value in value.items():
+                self._merge_value(existing, child_key, child_value, path + (child_key,), _child_schema(schema_node, child_key), rank)
+            return
+
+        if isinstance(value, list) and _is_object_list(schema_node, value):
+            existing = self._child_container(container, key, list)
+            key_name = self.engine.match_keys.get(_schema_path(path))
+            if key_name is None and rank >= self._length_ranks.get(path, -1):
+                self._length_ranks[path] = rank
+                self._resize(existing, path, len(value))
+            element_schema = _child_schema(schema_node, "*")
+            for position, element in enumerate(value):
+                index = self._element_index(existing, element, position, key_name)
+                self._merge_value(self._slot(existing, path, index, rank, True, key_name), index, element,
+                                  path + (index,), element_schema, rank)
+            return
+
+        if rank >= self._value_ranks.get(path, -1):
+            container[key] = value
+            self._value_ranks[path] = rank
+
+    def _child_container(self, container: Union[Dict[Any, Any], List[Any]], key: PathStep, container_type: type) -> Any:
+        """container[key], replaced by an empty container_type if it is not one."""
+        child = container.get(key) if isinstance(container, dict) else container[key]
+        if not isinstance(child, container_type):
+            child = container[key] = container_type()
+        return child
+
+    def _slot(self, node: List[Any], path: Path, index: int, rank: int, authored: bool, key_name: Optional[str]) -> Union[List[Any], Dict[int, Any]]:
+        """
+        Where element index of the array node (at path) is kept: node itself, grown if needed, or the
+        cut-off elements of node when a stage ranked above this one has set a shorter length. An element
+        written by the stage that owns the array shows it is at least index + 1 long.
+        """
+        if index < len(node):
+            return node
+        length_rank = self._length_ranks.get(path)
+        if key_name is None and length_rank is not None:
+            if not authored or rank < length_rank:
+                return self._cut_off.setdefault(path, {})
+        if key_name is None and authored:
+            self._length_ranks[path] = rank
+        self._resize(node, path, index + 1)
+        return node
+
+    def _resize(self, node: List[Any], path: Path, length: int) -> None:
+        """Cuts node down to length, or grows it with the elements cut off earlier (empty objects where there are none)."""
+        cut_off = self._cut_off.get(path)
+        if len(node) > length:
+            cut_off = self._cut_off.setdefault(path, {})
+            for index in range(length, len(node)):
+                cut_off[index] = node[index]
+            del node[length:]
+        while len(node) < length:
+            node.append(cut_off.pop(len(node), {}) if cut_off else {})
+
+    def _element_index(self, node: List[Any], element: Any, position: int, key_name: Optional[str]) -> int:
+        """Index in node of the element matching element (position in its own array); len(node) to append it."""
+        if key_name is None:
+            return position
+        match_value = _match_key_value(element, key_name)
+        if match_value is None:
+            return position
+        for index, existing in enumerate(node):
+            if _match_key_value(existing, key_name) == match_value:
+                return index
+        return len(node)
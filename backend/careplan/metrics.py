@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Metrics Module
+-------------
+Counters and histograms of the care plan pipeline (per-stage latency, upstream timings,
+response sizes, parse/merge time and failures), rendered in the Prometheus text exposition
+format for the /metrics endpoint. Metrics are kept per process.
+"""
+
+import time
+import bisect
+import threading
+from typing import Dict, List, Any, Optional, Tuple, Sequence
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+PROCESSING_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class _Metric:
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    """Monotonically increasing value per label combination."""
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: Any) -> float:
+        with self._lock:
+            return self._values.get(self._label_values(labels), 0)
+
+    def _render_samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                for key, value in sorted(self._values.items())]
+
+class Histogram(_Metric):
+    """Distribution of observed values per label combination, in cumulative buckets."""
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], List[float]] = {} # label values -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._label_values(labels)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[bucket_index] += 1
+            series[-1] += value
+
+    def count(self, **labels: Any) -> int:
+        with self._lock:
+            series = self._series.get(self._label_values(labels))
+            return int(sum(series[:-1])) if series else 0
+
+    def _render_samples(self) -> List[str]:
+        lines = []
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += bucket_count
+                le = f'le="{_format_value(upper_bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {_format_value(cumulative)}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_DURATION = REGISTRY.register(Histogram(
+    "careplan_stage_duration_seconds", "Wall time of a stage from stage_start to its result, by outcome.", ["stage", "status"]))
+STAGE_MERGE_SECONDS = REGISTRY.register(Histogram(
+    "careplan_stage_merge_seconds", "Time spent merging a stage's output into a care plan.", ["stage"], PROCESSING_BUCKETS))
+JSON_EXTRACTION_FAILURES = REGISTRY.register(Counter(
+    "careplan_json_extraction_failures_total", "Stage responses (or fan-out sub-responses) without usable JSON.", ["stage"]))
+SCHEMA_GAPS = REGISTRY.register(Counter(
+    "careplan_schema_gaps_total", "Paths a stage left missing or invalid in its part of the care plan.", ["stage"]))
+SCHEMA_REPAIRED_PATHS = REGISTRY.register(Counter(
+    "careplan_schema_repaired_paths_total", "Schema gaps filled by repair requests.", ["stage"]))
+GENERATIONS_CANCELLED = REGISTRY.register(Counter(
+    "careplan_generations_cancelled_total", "Generations cancelled because no client was connected to their stream any more."))
+
+UPSTREAM_REQUESTS = REGISTRY.register(Counter(
+    "careplan_upstream_requests_total", "Upstream answers by HTTP status, retried ones included.", ["stage", "status"]))
+UPSTREAM_ERRORS = REGISTRY.register(Counter(
+    "careplan_upstream_errors_total", "Upstream calls that failed: http_status, connection, exception or cancelled.", ["stage", "kind"]))
+UPSTREAM_TIME_TO_FIRST_BYTE = REGISTRY.register(Histogram(
+    "careplan_upstream_time_to_first_byte_seconds", "Time from starting an upstream call (queueing and retries included) to its response headers.", ["stage"]))
+UPSTREAM_TIME_TO_FIRST_THINK_TOKEN = REGISTRY.register(Histogram(
+    "careplan_upstream_time_to_first_think_token_seconds", "Time from starting an upstream call to its first reasoning text.", ["stage"]))
+UPSTREAM_TIME_TO_FIRST_JSON_TOKEN = REGISTRY.register(Histogram(
+    "careplan_upstream_time_to_first_json_token_seconds", "Time from starting an upstream call to the start of its JSON answer.", ["stage"]))
+UPSTREAM_DURATION = REGISTRY.register(Histogram(
+    "careplan_upstream_duration_seconds", "Time from starting an upstream call to the end of its stream.", ["stage"]))
+UPSTREAM_RESPONSE_BYTES = REGISTRY.register(Counter(
+    "careplan_upstream_response_bytes_total", "Bytes of streamed upstream responses.", ["stage"]))
+UPSTREAM_DELTAS = REGISTRY.register(Counter(
+    "careplan_upstream_deltas_total", "Content deltas received from upstream.", ["stage"]))
+UPSTREAM_PARSE_SECONDS = REGISTRY.register(Histogram(
+    "careplan_upstream_parse_seconds", "Time spent decoding and parsing the deltas of one upstream call.", ["stage"], PROCESSING_BUCKETS))
+RESPONSE_CACHE_HITS = REGISTRY.register(Counter(
+    "careplan_response_cache_hits_total", "Upstream calls answered from the response cache.", ["stage"]))
+
+def observe_stage(stage_name: str, seconds: float, stage_json_output: Optional[Dict[str, Any]]) -> None:
+    STAGE_DURATION.observe(seconds, stage=stage_name, status="completed" if stage_json_output else "failed")
+
+class UpstreamCallMetrics:
+    """Collects the timings of one streamed upstream call as it progresses and records them when it ends."""
+
+    def __init__(self, stage_name: str):
+        self.stage_name = stage_name
+        self.started = time.perf_counter()
+        self.response_bytes = 0
+        self.deltas = 0
+        self.parse_seconds = 0.0
+        self._seen_think = False
+        self._seen_json = False
+
+    def response_started(self) -> None:
+        UPSTREAM_TIME_TO_FIRST_BYTE.observe(time.perf_counter() - self.started, stage=self.stage_name)
+
+    def delta_parsed(self, parse_started: float, reasoning_delta: str, json_started: bool) -> None:
+        """Call after a delta went through the parser; parse_started is the perf_counter() taken before decoding it."""
+        now = time.perf_counter()
+        self.deltas += 1
+        self.parse_seconds += now - parse_started
+        if reasoning_delta and not self._seen_think:
+            self._seen_think = True
+            UPSTREAM_TIME_TO_FIRST_THINK_TOKEN.observe(now - self.started, stage=self.stage_name)
+        if json_started and not self._seen_json:
+            self._seen_json = True
+            UPSTREAM_TIME_TO_FIRST_JSON_TOKEN.observe(now - self.started, stage=self.stage_name)
+
+    def finished(self) -> None:
+        UPSTREAM_DURATION.observe(time.perf_counter() - self.started, stage=self.stage_name)
+        UPSTREAM_RESPONSE_BYTES.inc(self.response_bytes, stage=self.stage_name)
+        UPSTREAM_DELTAS.inc(self.deltas, stage=self.stage_name)
+        UPSTREAM_PARSE_SECONDS.observe(self.parse_seconds, stage=self.stage_name)
+
+    def failed(self, kind: str) -> None:
+        UPSTREAM_ERRORS.inc(stage=self.stage_name, kind=kind)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Mock Sonar Server
+----------------
+Local stand-in for Perplexity's /chat/completions, for load testing and benchmarking the
+backend without spending API credit. Streamed answers look like sonar-reasoning-pro's: a
+<think> block of reasoning followed by JSON that matches the request's response_format
+schema, sent as SSE deltas at a configurable token rate. Upstream failures (overload
+answers, dropped connections, malformed lines and truncated JSON) can be injected at
+configurable rates.
+
+    python mock_sonar_server.py --port 8910 --tokens-per-second 150
+    PERPLEXITY_BASE_URL=http://127.0.0.1:8910 python app.py
+"""
+
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, Optional
+
+CHARS_PER_TOKEN = 4
+
+REASONING_SENTENCES = [
+    "Assessment:",
+    "The patient presents with findings consistent with the primary diagnosis [1].",
+    "Step 1: Review the vital signs and the trend of the most recent labs.",
+    "Rationale: Early recognition of decompensation reduces readmission risk [2].",
+    "Considerations:",
+    "- Medication reconciliation is needed before discharge.",
+    "- Risk for fall related to orthostatic hypotension as evidenced by dizziness on standing.",
+    "Step 2: Prioritize the nursing diagnoses using ADPIE and NANDA terminology.",
+    "Evidence: Current guidelines support daily weights and fluid restriction [3].",
+    "Planning:",
+    "Goals should be measurable, time-bound and agreed with the patient.",
+]
+
+class MockOptions:
+    """Behaviour of the mock server; every rate is a probability per request."""
+
+    def __init__(self, tokens_per_second: float = 200, min_chunk_tokens: int = 1, max_chunk_tokens: int = 6,
+                 think_tokens: int = 300, first_token_delay: float = 0.3, error_rate: float = 0.0,
+                 error_status: int = 429, retry_after: Optional[float] = 1.0, disconnect_rate: float = 0.0,
+                 malformed_line_rate: float = 0.0, truncated_json_rate: float = 0.0, seed: Optional[int] = None):
+        self.tokens_per_second = tokens_per_second
+        self.min_chunk_tokens = max(1, min_chunk_tokens)
+        self.max_chunk_tokens = max(self.min_chunk_tokens, max_chunk_tokens)
+        self.think_tokens = think_tokens
+        self.first_token_delay = first_token_delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.disconnect_rate = disconnect_rate
+        self.malformed_line_rate = malformed_line_rate
+        self.truncated_json_rate = truncated_json_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+    def chance(self, rate: float) -> bool:
+        with self.random_lock:
+            return self.random.random() < rate
+
+    def randint(self, low: int, high: int) -> int:
+        with self.random_lock:
+            return self.random.randint(low, high)
+
+def example_for_schema(schema: Dict[str, Any], name: str = "value") -> Any:
+    """A value matching a JSON schema node, with plausible text for strings and two elements per array."""
+    if "enum" in schema:
+        return schema["enum"][0]
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        schema_type = schema_type[0]
+    if schema_type == "object":
+        return {key: example_for_schema(value, key) for key, value in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        items = schema.get("items", {"type": "string"})
+        return [example_for_schema(items, name) for _ in range(2)]
+    if schema_type in ("number", "integer"):
+        return 0.8
+    if schema_type == "boolean":
+        return False
+    # Quotes, braces and escapes exercise the client's incremental JSON parsing
+    return f"Mock {name.replace('_', ' ')}: monitor \"as ordered\" {{daily}} \\ reassess in 24h"
+
+def reasoning_text(think_tokens: int) -> str:
+    sentences = []
+    length = 0
+    while length < think_tokens * CHARS_PER_TOKEN:
+        sentence = REASONING_SENTENCES[len(sentences) % len(REASONING_SENTENCES)]
+        sentences.append(sentence)
+        length += len(sentence) + 1
+    return "\n".join(sentences)
+
+class MockSonarHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    options = MockOptions()
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        if self.path.rstrip('/') != "/chat/completions":
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            self._send_json(400, {"error": {"message": "Request body is not JSON"}})
+            return
+
+        options = self.options
+        if options.chance(options.error_rate):
+            headers = {"Retry-After": str(options.retry_after)} if options.retry_after is not None else {}
+            self._send_json(options.error_status, {"error": {"message": "Mock overload", "code": options.error_status}}, headers)
+            return
+
+        schema = payload.get("response_format", {}).get("json_schema", {}).get("schema", {"type": "object", "properties": {}})
+        json_text = json.dumps(example_for_schema(schema), indent=2)
+        if options.chance(options.truncated_json_rate):
+            json_text = json_text[:len(json_text) // 2]
+        content = f"<think>\n{reasoning_text(options.think_tokens)}\n</think>\n{json_text}"
+
+        if not payload.get("stream"):
+            self._send_json(200, self._completion(payload, {"message": {"role": "assistant", "content": content}, "finish_reason": "stop"}))
+            return
+        self._stream(payload, content)
+
+    def _completion(self, payload: Dict[str, Any], choice: Dict[str, Any], completion_id: str = "") -> Dict[str, Any]:
+        return {
+            "id": completion_id or str(uuid.uuid4()),
+            "model": payload.get("model", "sonar-reasoning-pro"),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "choices": [dict(index=0, **choice)],
+        }
+
+    def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, payload: Dict[str, Any], content: str) -> None:
+        options = self.options
+        completion_id = str(uuid.uuid4())
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        disconnect_at = len(content) // 2 if options.chance(options.disconnect_rate) else None
+        malformed_at = options.randint(0, len(content)) if options.chance(options.malformed_line_rate) else None
+        time.sleep(options.first_token_delay)
+        started = time.monotonic()
+        sent_tokens = 0
+        position = 0
+        try:
+            while position < len(content):
+                if disconnect_at is not None and position >= disconnect_at:
+                    # Drop the connection without the terminating chunk, like a reset upstream
+                    self.close_connection = True
+                    return
+                if malformed_at is not None and position >= malformed_at:
+                    self._write_chunk(b'data: {"choices": [{"delta": {"content": "unterminated\n\n')
+                    malformed_at = None
+                chunk_tokens = options.randint(options.min_chunk_tokens, options.max_chunk_tokens)
+                delta = content[position:position + chunk_tokens * CHARS_PER_TOKEN]
+                position += len(delta)
+                chunk = self._completion(payload, {"delta": {"role": "assistant", "content": delta}, "finish_reason": None}, completion_id)
+                self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+
+                sent_tokens += chunk_tokens
+                if options.tokens_per_second > 0:
+                    ahead = sent_tokens / options.tokens_per_second - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+            completion_tokens = len(content) // CHARS_PER_TOKEN
+            prompt_tokens = sum(len(message.get("content", "")) for message in payload.get("messages", [])) // CHARS_PER_TOKEN
+            final_chunk = self._completion(payload, {"delta": {}, "finish_reason": "stop"}, completion_id)
+            final_chunk["usage"] = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+            self._write_chunk(f"data: {json.dumps(final_chunk)}\n\n".encode('utf-8'))
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+def make_server(host: str, port: int, options: MockOptions) -> ThreadingHTTPServer:
+    handler = type("ConfiguredMockSonarHandler", (MockSonarHandler,), {"options": options})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local mock of the Perplexity Sonar /chat/completions API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8910)
+    parser.add_argument("--tokens-per-second", type=float, default=200, help="Streaming rate per response, 0 for as fast as possible")
+    parser.add_argument("--min-chunk-tokens", type=int, default=1, help="Smallest delta, in tokens of ~4 characters")
+    parser.add_argument("--max-chunk-tokens", type=int, default=6, help="Largest delta, in tokens of ~4 characters")
+    parser.add_argument("--think-tokens", type=int, default=300, help="Length of the <think> block")
+    parser.add_argument("--first-token-delay", type=float, default=0.3, help="Seconds before the first delta")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of error answers, negative to leave it out")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="Share of streams dropped halfway")
+    parser.add_argument("--malformed-line-rate", type=float, default=0.0, help="Share of streams with one non-JSON data line")
+    parser.add_argument("--truncated-json-rate", type=float, default=0.0, help="Share of answers whose JSON is cut in half")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    options = MockOptions(
+        tokens_per_second=args.tokens_per_second, min_chunk_tokens=args.min_chunk_tokens, max_chunk_tokens=args.max_chunk_tokens,
+        think_tokens=args.think_tokens, first_token_delay=args.first_token_delay, error_rate=args.error_rate,
+        error_status=args.error_status, retry_after=args.retry_after if args.retry_after >= 0 else None,
+        disconnect_rate=args.disconnect_rate, malformed_line_rate=args.malformed_line_rate,
+        truncated_json_rate=args.truncated_json_rate, seed=args.seed
+    )
+    server = make_server(args.host, args.port, options)
+    print(f"Mock Sonar server listening on http://{args.host}:{args.port}/chat/completions")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
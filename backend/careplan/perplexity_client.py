@@ -6,35 +6,212 @@ Handles interactions with the Perplexity API for the care plan generator
 """
 
 import os
-import json
-import re
+import copy
+import functools
+import contextlib
+import time
+import queue
+import socket
 import logging
+import threading
 import requests
-from typing import Dict, List, Any, Optional, Generator, Union, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from response_cache import ResponseCache, get_default_response_cache
+from stream_parser import StageResponseParser
+from reasoning_formatter import format_reasoning_markdown, ReasoningMarkdownStream
+from merge_engine import MergeEngine
+from schema_validator import StageSchemaValidator, Path, json_pointer, parse_json_pointer
+from schema_repair import StageRepair
+from stage_scheduler import StageScheduler, StageJob, CallBatch, CompletionCall, STAGE_STATUS_COMPLETED
+from cancellation import CancellationToken, GenerationCancelled, check_cancelled, is_cancelled, on_cancel
+import serialization
+import metrics
+from rate_limiter import UpstreamLimiter, get_default_upstream_limiter, parse_retry_after, RETRYABLE_STATUS_CODES
+from health import CircuitBreaker, UpstreamProbeError, get_default_circuit_breaker
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, List, Any, Optional, Generator, Tuple, Callable, Union
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Helper for deep merging dictionaries
-def deep_merge(source, destination):
+# Connection pool configuration (shared by every request made through the client)
+PERPLEXITY_POOL_CONNECTIONS = int(os.environ.get('PERPLEXITY_POOL_CONNECTIONS', 4))
+PERPLEXITY_POOL_MAXSIZE = int(os.environ.get('PERPLEXITY_POOL_MAXSIZE', 32))
+PERPLEXITY_POOL_BLOCK = os.environ.get('PERPLEXITY_POOL_BLOCK', '0') not in ('0', 'false', 'False')
+PERPLEXITY_CONNECT_RETRIES = int(os.environ.get('PERPLEXITY_CONNECT_RETRIES', 3))
+PERPLEXITY_RETRY_BACKOFF = float(os.environ.get('PERPLEXITY_RETRY_BACKOFF', 0.5))
+
+# Upstream API location (point it at a local mock server for testing) and how often 429/5xx answers are retried
+PERPLEXITY_BASE_URL = os.environ.get('PERPLEXITY_BASE_URL', 'https://api.perplexity.ai')
+PERPLEXITY_UPSTREAM_RETRIES = int(os.environ.get('PERPLEXITY_UPSTREAM_RETRIES', 3))
+
+# Health probe: a one-token completion of the cheapest model, checking the API is reachable and accepts the key
+PERPLEXITY_HEALTH_PROBE_MODEL = os.environ.get('PERPLEXITY_HEALTH_PROBE_MODEL', 'sonar')
+PERPLEXITY_HEALTH_PROBE_TIMEOUT = float(os.environ.get('PERPLEXITY_HEALTH_PROBE_TIMEOUT', 10))
+
+# Stage scheduling: run stages whose depends_on are satisfied concurrently
+PERPLEXITY_PARALLEL_STAGES = os.environ.get('PERPLEXITY_PARALLEL_STAGES', '1') not in ('0', 'false', 'False')
+PERPLEXITY_MAX_PARALLEL_STAGES = int(os.environ.get('PERPLEXITY_MAX_PARALLEL_STAGES', 3))
+
+# Fan-out of the per-goal stages: "off", "diagnosis" (one request per nursing diagnosis) or "goal" (one per goal)
+PERPLEXITY_STAGE_FAN_OUT = os.environ.get('PERPLEXITY_STAGE_FAN_OUT', 'off')
+PERPLEXITY_FAN_OUT_CONCURRENCY = int(os.environ.get('PERPLEXITY_FAN_OUT_CONCURRENCY', 4))
+FAN_OUT_MODES = ("off", "diagnosis", "goal")
+
+# Emit stage_json_partial events as top-level fields and array elements of a stage's JSON complete
+PERPLEXITY_PARTIAL_JSON_EVENTS = os.environ.get('PERPLEXITY_PARTIAL_JSON_EVENTS', '1') not in ('0', 'false', 'False')
+# Emit reasoning_markdown_chunk events with the formatted Markdown of each reasoning paragraph as it completes
+PERPLEXITY_STREAM_REASONING_MARKDOWN = os.environ.get('PERPLEXITY_STREAM_REASONING_MARKDOWN', '0') not in ('0', 'false', 'False')
+# Reasoning deltas are held back and sent as one reasoning_text_chunk once this many milliseconds passed since
+# the first held one or this many characters are held; 0 turns a limit off, both 0 sends every delta as it comes
+PERPLEXITY_REASONING_COALESCE_MS = float(os.environ.get('PERPLEXITY_REASONING_COALESCE_MS', 50))
+PERPLEXITY_REASONING_COALESCE_CHARS = int(os.environ.get('PERPLEXITY_REASONING_COALESCE_CHARS', 1024))
+
+# Prompt context: serialize compactly, projected to each stage's context_paths, with long strings shortened (0 keeps them whole)
+PERPLEXITY_COMPACT_CONTEXT = os.environ.get('PERPLEXITY_COMPACT_CONTEXT', '1') not in ('0', 'false', 'False')
+PERPLEXITY_CONTEXT_MAX_STRING_CHARS = int(os.environ.get('PERPLEXITY_CONTEXT_MAX_STRING_CHARS', 800))
+
+# Schema repair: validate each stage's merged output and ask for just the paths it left missing or invalid,
+# at most this many paths per repair request and this many repair requests per stage
+PERPLEXITY_SCHEMA_REPAIR = os.environ.get('PERPLEXITY_SCHEMA_REPAIR', '1') not in ('0', 'false', 'False')
+PERPLEXITY_REPAIR_MAX_PATHS = int(os.environ.get('PERPLEXITY_REPAIR_MAX_PATHS', 5))
+PERPLEXITY_REPAIR_MAX_REQUESTS = int(os.environ.get('PERPLEXITY_REPAIR_MAX_REQUESTS', 4))
+
+# on_stage_finished(stage_name, status, stage JSON or None)
+StageFinishedCallback = Callable[[str, str, Optional[Dict[str, Any]]], None]
+
+# Cached responses are replayed as reasoning_text_chunk events of this many characters
+CACHE_REPLAY_CHUNK_CHARS = 256
+
+class SchemaPathError(ValueError):
+    """Raised when a STAGES_CONFIG property path does not resolve against ADPIE_SCHEMA."""
+
+def build_sub_schema(schema: Dict[str, Any], properties_to_target: List[str], stage_specific_required: List[str]) -> Dict[str, Any]:
+    """
+    Builds the JSON schema for a stage from dotted property paths into `schema` ('*' steps into array items).
+    Nodes along a path keep only their type and the targeted children; the node a path ends at is copied in full.
+    Raises SchemaPathError for a path that does not resolve.
+    """
+    sub_schema: Dict[str, Any] = {"type": "object", "properties": {}}
+
+    for prop_path_str in properties_to_target:
+        path_parts = prop_path_str.split('.')
+        source_node = schema
+        target_node = sub_schema
+        for i, part_name in enumerate(path_parts):
+            is_last_part = (i == len(path_parts) - 1)
+            if part_name == "*":
+                if source_node.get("type") != "array" or not isinstance(source_node.get("items"), dict):
+                    raise SchemaPathError(f"Schema path '{prop_path_str}': '{'.'.join(path_parts[:i])}' is not an array")
+                source_node = source_node["items"]
+                child_container, child_key = target_node, "items"
+            else:
+                source_properties = source_node.get("properties")
+                if not isinstance(source_properties, dict) or part_name not in source_properties:
+                    raise SchemaPathError(f"Schema path '{prop_path_str}': '{'.'.join(path_parts[:i + 1])}' not found in schema")
+                source_node = source_properties[part_name]
+                child_container, child_key = target_node.setdefault("properties", {}), part_name
+
+            if is_last_part:
+                child_container[child_key] = copy.deepcopy(source_node)
+            else:
+                target_node = child_container.setdefault(child_key, {"type": source_node.get("type")})
+
+    sub_schema_required = {req_path_str.split('.')[0] for req_path_str in stage_specific_required}
+    sub_schema_required &= set(sub_schema["properties"])
+    if sub_schema_required:
+        sub_schema["required"] = sorted(sub_schema_required)
+    return sub_schema
+
+def project_context(data: Dict[str, Any], paths: List[str]) -> Dict[str, Any]:
+    """
+    Returns the parts of `data` named by dotted paths ('*' steps into every element of an array, keeping
+    positions so indices still line up with the full plan). Missing paths are skipped. Values are shared
+    with `data`, not copied.
+    """
+    projected: Dict[str, Any] = {}
+    for path in paths:
+        projected = _project_path(data, projected, path.split('.'))
+    return projected
+
+def _project_path(source: Any, target: Any, path_parts: List[str]) -> Any:
+    if not path_parts:
+        return source
+    part_name, remaining_parts = path_parts[0], path_parts[1:]
+    if part_name == "*":
+        if not isinstance(source, list):
+            return target
+        if not isinstance(target, list):
+            target = [{} for _ in source]
+        for i, element in enumerate(source):
+            target[i] = _project_path(element, target[i], remaining_parts)
+        return target
+    if not isinstance(source, dict) or part_name not in source:
+        return target
+    if not isinstance(target, dict):
+        target = {}
+    target[part_name] = _project_path(source[part_name], target.get(part_name), remaining_parts)
+    return target
+
+def abort_response(response: requests.Response) -> None:
+    """
+    Closes a streamed response from another thread. Closing alone does not wake a read blocked on the
+    socket, so the socket is shut down first and the read fails at once.
+    """
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is not None:
+        with contextlib.suppress(OSError):
+            sock.shutdown(socket.SHUT_RDWR)
+    response.close()
+
+def shorten_long_strings(value: Any, max_chars: int) -> Any:
+    """Returns a copy of value with every string longer than max_chars cut down to its first max_chars characters."""
+    if isinstance(value, str):
+        if len(value) > max_chars:
+            return value[:max_chars] + f"... [{len(value) - max_chars} more characters omitted]"
+        return value
+    if isinstance(value, dict):
+        return {key: shorten_long_strings(item, max_chars) for key, item in value.items()}
+    if isinstance(value, list):
+        return [shorten_long_strings(item, max_chars) for item in value]
+    return value
+
+class ReasoningCoalescer:
     """
-    Deeply merges source dict into destination dict.
-    Arrays are typically replaced, unless specific logic is added.
+    Batches the reasoning deltas of one upstream call. add() returns the text to send now, "" while it is
+    held back; limits are only checked when a delta (reasoning or not) arrives, so the stream itself is
+    the clock. flush() returns whatever is still held, at the end of a call.
     """
-    for key, value in source.items():
-        if isinstance(value, dict):
-            # get node or create one
-            node = destination.setdefault(key, {})
-            deep_merge(value, node)
-        elif isinstance(value, list):
-            # For lists, decide on strategy: replace, extend, or item-wise merge
-            # For nursingDiagnoses goals/interventions, we'll handle item-wise merge specifically.
-            # For most other lists, replacement is simpler.
-            destination[key] = value # Default: replace
-        else:
-            destination[key] = value
-    return destination
+
+    def __init__(self, max_delay: float, max_chars: int):
+        self.max_delay = max_delay
+        self.max_chars = max_chars
+        self._held: List[str] = []
+        self._held_chars = 0
+        self._held_since = 0.0
+
+    def add(self, reasoning_delta: str) -> str:
+        if self.max_delay <= 0 and self.max_chars <= 0:
+            return reasoning_delta
+        if reasoning_delta:
+            if not self._held:
+                self._held_since = time.monotonic()
+            self._held.append(reasoning_delta)
+            self._held_chars += len(reasoning_delta)
+        if not self._held:
+            return ""
+        if (self.max_chars > 0 and self._held_chars >= self.max_chars) or \
+           (self.max_delay > 0 and time.monotonic() - self._held_since >= self.max_delay):
+            return self.flush()
+        return ""
+
+    def flush(self) -> str:
+        text = "".join(self._held)
+        self._held = []
+        self._held_chars = 0
+        return text
 
 class PerplexityClient:
     """
@@ -280,6 +457,21 @@ class PerplexityClient:
       "required": ["patientData", "clinicalData", "nursingDiagnoses", "recommendedAssessmentsList", "next_steps"]
     }
 
+    # Parts of the accumulated plan that stages after the first read, as dotted paths ('*' for array items)
+    ASSESSMENT_CONTEXT_PATHS = [
+        "patientData", "clinicalData",
+        "assessment_subjective_chief_complaint", "assessment_subjective_hpi",
+        "assessment_subjective_goals", "assessment_subjective_other",
+        "assessment_objective_vitals_summary", "assessment_objective_physical_exam",
+        "assessment_objective_diagnostics", "assessment_objective_meds_reviewed", "assessment_objective_other"
+    ]
+    GOALS_CONTEXT_PATHS = [
+        "nursingDiagnoses.*.diagnosis_nanda", "nursingDiagnoses.*.diagnosis_related_to",
+        "nursingDiagnoses.*.diagnosis_evidence", "nursingDiagnoses.*.diagnosis_is_risk", "nursingDiagnoses.*.diagnosis_risk_factors",
+        "nursingDiagnoses.*.goals.*.goal_description", "nursingDiagnoses.*.goals.*.goal_target_date",
+        "nursingDiagnoses.*.goals.*.goal_outcomes"
+    ]
+
     STAGES_CONFIG = [
         {
             "name": "stage_1_assessment_setup",
@@ -299,11 +491,9 @@ class PerplexityClient:
                 "recommendedAssessmentsList",  # New list of assessments
                 "nursingDiagnoses",  # Shell: diagnosis_nanda, related_to, evidence, is_risk, risk_factors
                 "aiAgents"  # Initial agent details and assessment contribution
-                "recommendedAssessmentsList", # New list of assessments
-                "nursingDiagnoses", # Shell: diagnosis_nanda, related_to, evidence, is_risk, risk_factors
-                "aiAgents" # Initial agent details and assessment contribution
             ],
-            "required_for_this_stage_output": ["patientData", "clinicalData", "assessment_subjective_chief_complaint", "nursingDiagnoses", "recommendedAssessmentsList", "aiAgents"]
+            "required_for_this_stage_output": ["patientData", "clinicalData", "assessment_subjective_chief_complaint", "nursingDiagnoses", "recommendedAssessmentsList", "aiAgents"],
+            "depends_on": []
         },
         {
             "name": "stage_2_diagnosis_goals",
@@ -320,7 +510,9 @@ class PerplexityClient:
                 "nursingDiagnoses.*.goals", # This will generate the goals array under each diagnosis
                 "aiAgents" # Update with planning contribution
             ],
-            "required_for_this_stage_output": ["nursingDiagnoses"] # Expecting goals to be filled
+            "required_for_this_stage_output": ["nursingDiagnoses"], # Expecting goals to be filled
+            "depends_on": ["stage_1_assessment_setup"],
+            "context_paths": ASSESSMENT_CONTEXT_PATHS + ["recommendedAssessmentsList", "nursingDiagnoses", "aiAgents"]
         },
         {
             "name": "stage_3_interventions",
@@ -336,7 +528,10 @@ class PerplexityClient:
                 "nursingDiagnoses.*.goals.*.interventions", # Interventions are now under goals
                 "aiAgents" # Update with implementation contribution
             ],
-            "required_for_this_stage_output": ["nursingDiagnoses"] # Expecting interventions under goals to be filled
+            "required_for_this_stage_output": ["nursingDiagnoses"], # Expecting interventions under goals to be filled
+            "depends_on": ["stage_2_diagnosis_goals"],
+            "context_paths": ASSESSMENT_CONTEXT_PATHS + GOALS_CONTEXT_PATHS + ["aiAgents"],
+            "fan_out": True # Each goal's interventions can be generated by an independent request
         },
         {
             "name": "stage_4_evaluation_criteria", # Renamed and repurposed
@@ -351,7 +546,10 @@ class PerplexityClient:
                 "nursingDiagnoses.*.goals.*.evaluation", # Evaluation is now an object under goals
                 "aiAgents" # Update with evaluation contribution
             ],
-            "required_for_this_stage_output": ["nursingDiagnoses"] # Expecting evaluation under goals to be filled
+            "required_for_this_stage_output": ["nursingDiagnoses"], # Expecting evaluation under goals to be filled
+            "depends_on": ["stage_2_diagnosis_goals"], # Evaluation criteria follow from the goals, not the interventions
+            "context_paths": ASSESSMENT_CONTEXT_PATHS + GOALS_CONTEXT_PATHS + ["aiAgents"],
+            "fan_out": True
         },
         {
             "name": "stage_5_summary_admin_coordination", # Combined coordination here
@@ -371,67 +569,204 @@ class PerplexityClient:
                 "notification_title", "notification_message",
                 "notification_detail_1", "notification_detail_2"
             ],
-            "required_for_this_stage_output": ["interdisciplinaryPlan", "overall_plan_summary", "next_steps", "aiAgents"]
+            "required_for_this_stage_output": ["interdisciplinaryPlan", "overall_plan_summary", "next_steps", "aiAgents"],
+            "depends_on": ["stage_2_diagnosis_goals"], # Coordination/admin fields only need the assessment, diagnoses and goals
+            "context_paths": [
+                "patientData", "clinicalData", "assessment_subjective_chief_complaint", "assessment_objective_vitals_summary",
+                "nursingDiagnoses.*.diagnosis_nanda", "nursingDiagnoses.*.goals.*.goal_description",
+                "nursingDiagnoses.*.goals.*.goal_target_date", "aiAgents"
+            ]
         }
     ]
 
-    def __init__(self, api_key: Optional[str] = None):
+    # Arrays of objects whose elements are matched across stages by a field instead of by index,
+    # as dotted schema paths, e.g. {"aiAgents": "name"}. Keyed elements keep the order they were first merged in.
+    MERGE_MATCH_KEYS: Dict[str, str] = {}
+
+    def __init__(self, api_key: Optional[str] = None,
+                 pool_connections: int = PERPLEXITY_POOL_CONNECTIONS,
+                 pool_maxsize: int = PERPLEXITY_POOL_MAXSIZE,
+                 pool_block: bool = PERPLEXITY_POOL_BLOCK,
+                 connect_retries: int = PERPLEXITY_CONNECT_RETRIES,
+                 retry_backoff: float = PERPLEXITY_RETRY_BACKOFF,
+                 parallel_stages: bool = PERPLEXITY_PARALLEL_STAGES,
+                 max_parallel_stages: int = PERPLEXITY_MAX_PARALLEL_STAGES,
+                 fan_out_mode: str = PERPLEXITY_STAGE_FAN_OUT,
+                 fan_out_concurrency: int = PERPLEXITY_FAN_OUT_CONCURRENCY,
+                 partial_json_events: bool = PERPLEXITY_PARTIAL_JSON_EVENTS,
+                 stream_reasoning_markdown: bool = PERPLEXITY_STREAM_REASONING_MARKDOWN,
+                 reasoning_coalesce_ms: float = PERPLEXITY_REASONING_COALESCE_MS,
+                 reasoning_coalesce_chars: int = PERPLEXITY_REASONING_COALESCE_CHARS,
+                 compact_context: bool = PERPLEXITY_COMPACT_CONTEXT,
+                 context_max_string_chars: int = PERPLEXITY_CONTEXT_MAX_STRING_CHARS,
+                 schema_repair: bool = PERPLEXITY_SCHEMA_REPAIR,
+                 repair_max_paths: int = PERPLEXITY_REPAIR_MAX_PATHS,
+                 repair_max_requests: int = PERPLEXITY_REPAIR_MAX_REQUESTS,
+                 base_url: str = PERPLEXITY_BASE_URL,
+                 upstream_retries: int = PERPLEXITY_UPSTREAM_RETRIES,
+                 response_cache: Optional[ResponseCache] = None,
+                 upstream_limiter: Optional[UpstreamLimiter] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 health_probe_model: str = PERPLEXITY_HEALTH_PROBE_MODEL,
+                 health_probe_timeout: float = PERPLEXITY_HEALTH_PROBE_TIMEOUT):
         self.api_key = api_key or os.environ.get('SONAR_API_KEY')
         if not self.api_key:
             raise ValueError("API key not provided and SONAR_API_KEY environment variable not set")
             
-        self.base_url = "https://api.perplexity.ai"
+        self.base_url = base_url.rstrip('/')
         self.chat_endpoint = f"{self.base_url}/chat/completions"
+        self.parallel_stages = parallel_stages
+        self.max_parallel_stages = max(1, max_parallel_stages)
+        if fan_out_mode not in FAN_OUT_MODES:
+            raise ValueError(f"Invalid fan-out mode '{fan_out_mode}', expected one of {FAN_OUT_MODES}")
+        self.fan_out_mode = fan_out_mode
+        self.fan_out_concurrency = max(1, fan_out_concurrency)
+        self.partial_json_events = partial_json_events
+        self.stream_reasoning_markdown = stream_reasoning_markdown
+        self.reasoning_coalesce_ms = reasoning_coalesce_ms
+        self.reasoning_coalesce_chars = reasoning_coalesce_chars
+        self.compact_context = compact_context
+        self.context_max_string_chars = context_max_string_chars
+        self.schema_repair = schema_repair
+        self.repair_max_paths = max(1, repair_max_paths)
+        self.repair_max_requests = max(0, repair_max_requests)
+        self.response_cache = response_cache if response_cache is not None else get_default_response_cache()
+        self.upstream_limiter = upstream_limiter if upstream_limiter is not None else get_default_upstream_limiter()
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else get_default_circuit_breaker()
+        self.health_probe_model = health_probe_model
+        self.health_probe_timeout = health_probe_timeout
+        self.upstream_retries = max(0, upstream_retries)
+        self.retry_backoff = retry_backoff
+        self.merge_engine = self._merge_engine
+
+        # One adapter (and therefore one urllib3 PoolManager) is shared by every thread, so
+        # TCP+TLS connections to the API are kept alive and reused across stages and requests.
+        # Only connection errors are retried: the request never reached the server, so
+        # retrying a POST there is safe.
+        # The pool does not bound concurrency, the upstream limiter (PERPLEXITY_MAX_CONCURRENT_REQUESTS) does:
+        # without pool_block, a call finding every pooled connection busy opens an extra one, closed after
+        # use, instead of waiting for a free one with no timeout that stage timeouts or cancellation could cut.
+        retry = Retry(
+            total=connect_retries, connect=connect_retries, read=0, redirect=0, status=0,
+            backoff_factor=retry_backoff, raise_on_status=False
+        )
+        self._adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+            pool_block=pool_block, max_retries=retry
+        )
+        self._thread_local = threading.local()
+
+    def _get_session(self) -> requests.Session:
+        """
+        Returns the calling thread's session. Sessions hold per-request state (cookies, hooks)
+        that is not safe to share between Flask worker threads, so each thread gets its own,
+        but all of them are mounted on the same pooled adapter.
+        """
+        session = getattr(self._thread_local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self._get_headers())
+            session.mount("https://", self._adapter)
+            session.mount("http://", self._adapter)
+            self._thread_local.session = session
+        return session
+
+    def close(self) -> None:
+        """Closes every pooled connection held by the client."""
+        self._adapter.close()
         
     def _format_reasoning_as_markdown(self, reasoning_text: str) -> str:
-        if not reasoning_text:
-            return ""
-        markdown = reasoning_text.replace('\r\n', '\n')
-        markdown = re.sub(r'^(Assessment|Diagnosis|Planning|Implementation|Evaluation|Conclusion|Summary):$', r'## \1:', markdown, flags=re.MULTILINE)
-        markdown = re.sub(r'^(Step\s*\d+):', r'### \1:', markdown, flags=re.MULTILINE)
-        markdown = re.sub(r'^(Rationale|Evidence|Considerations):$', r'#### \1:', markdown, flags=re.MULTILINE)
-        keywords_to_bold = [
-            'ADPIE', 'NANDA', 'CHF', 'Congestive Heart Failure', 'Hypertension', 'Diabetes',
-            'Assessment', 'Diagnosis', 'Planning', 'Implementation', 'Evaluation',
-            'Goal', 'Outcome', 'Intervention', 'Rationale', 'Evidence', 'Risk for', 'Related to', 'As evidenced by'
-        ]
-        for keyword in keywords_to_bold:
-            markdown = re.sub(r'\b(' + re.escape(keyword) + r')\b', r'**\1**', markdown, flags=re.IGNORECASE)
-        markdown = re.sub(r'(\[\s*(?:S\d+|\d+|[A-Za-z]+)\s*\])', r'*\1*', markdown)
-        markdown = re.sub(r'^\s*-\s+(.*)', r'* \1', markdown, flags=re.MULTILINE)
-        markdown = re.sub(r'^\s*\*\s+(.*)', r'* \1', markdown, flags=re.MULTILINE)
-        markdown = re.sub(r'^\s*(\d+\.)\s+(.*)', r'\1 \2', markdown, flags=re.MULTILINE)
-        markdown = re.sub(r'^\s*>\s*(.*)', r'> \1', markdown, flags=re.MULTILINE)
-        blocks = markdown.split('\n\n')
-        processed_blocks = []
-        for block in blocks:
-            if not (block.startswith('* ') or block.startswith('#') or block.startswith('>') or re.match(r'^\d+\.\s', block)):
-                block = block.replace('\n', ' ')
-            processed_blocks.append(block.strip())
-        markdown = '\n\n'.join(processed_blocks)
-        return markdown.strip()
+        return format_reasoning_markdown(reasoning_text)
         
-    def _validate_api_key(self) -> bool:
-        headers = self._get_headers()
+    def probe_upstream(self) -> bool:
+        """
+        Checks the API is reachable and accepts the key with a one-token completion, bypassing the upstream
+        limiter so a busy process still gets its answer. Raises UpstreamProbeError (a ValueError) if it does not.
+        """
         payload = {
-            "model": "sonar-reasoning-pro",
-            "messages": [{"role": "user", "content": "Hello"}],
-            "max_tokens": 8000 
+            "model": self.health_probe_model,
+            "messages": [{"role": "user", "content": "ping"}],
+            "max_tokens": 1
         }
+        try:
+            response = self._get_session().post(self.chat_endpoint, data=self._encode_payload(payload), timeout=self.health_probe_timeout)
+        except requests.RequestException as e:
+            raise UpstreamProbeError(f"Perplexity API unreachable: {str(e)}")
+        if response.status_code != 200:
+            raise UpstreamProbeError(f"Perplexity API answered {response.status_code}: {response.text[:200]}", response.status_code)
+        return True
+
+    def _validate_api_key(self) -> bool:
         try:
             logger.info("Validating API key...")
-            response = requests.post(self.chat_endpoint, headers=headers, json=payload, timeout=15)
-            if response.status_code != 200:
-                error_msg = f"API key validation failed: {response.status_code} - {response.text}"
-                logger.error(error_msg)
-                raise ValueError(error_msg)
+            self.probe_upstream()
             logger.info("API key validated successfully")
             return True
-        except requests.RequestException as e:
-            error_msg = f"Error validating API key: {str(e)}"
+        except ValueError as e:
+            error_msg = f"API key validation failed: {str(e)}"
             logger.error(error_msg)
             raise ValueError(error_msg)
     
+    def _estimate_tokens(self, payload: Dict[str, Any]) -> int:
+        """Upper bound of the tokens a call uses: its prompt (~4 characters per token) plus max_tokens of output."""
+        prompt_chars = sum(len(message["content"]) for message in payload["messages"])
+        return prompt_chars // 4 + payload.get("max_tokens", 0)
+
+    def _upstream_slot(self, payload: Dict[str, Any], cancel_token: Optional[CancellationToken] = None):
+        """Context manager held around each upstream call; a no-op unless the client has an upstream_limiter."""
+        if self.upstream_limiter is None:
+            return contextlib.nullcontext()
+        return self.upstream_limiter.acquire(self._estimate_tokens(payload), cancel_token)
+
+    def _upstream_retry_delay(self, status_code: int, retry_after_header: Optional[str], attempt: int) -> Optional[float]:
+        """
+        Reports an upstream answer to the limiter and the circuit breaker. Returns the seconds to wait before retrying the call,
+        or None if the answer is final (success, a non-retryable error or out of retries).
+        """
+        retry_after = parse_retry_after(retry_after_header)
+        if self.upstream_limiter is not None:
+            self.upstream_limiter.record_response(status_code, retry_after)
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_response(status_code)
+        if status_code not in RETRYABLE_STATUS_CODES or attempt >= self.upstream_retries:
+            return None
+        return retry_after if retry_after is not None else self.retry_backoff * 2 ** attempt
+
+    @contextlib.contextmanager
+    def _open_upstream_stream(self, payload: Dict[str, Any], stage_name: str, cancel_token: Optional[CancellationToken] = None):
+        """
+        Posts a streamed call and yields the response, holding its upstream slot until the caller is done
+        reading it. 429/5xx answers are retried after Retry-After (or an exponential backoff); nothing has
+        streamed yet at that point, so the POST is safe to repeat. The last answer is yielded whatever its status.
+        Raises GenerationCancelled if cancel_token is cancelled while the call waits for its slot or a retry. Once
+        the response is yielded, cancelling closes it, so a stalled stream is abandoned too: the read fails and
+        the error is replaced by GenerationCancelled.
+        """
+        attempt = 0
+        while True:
+            with self._upstream_slot(payload, cancel_token):
+                check_cancelled(cancel_token)
+                response = self._get_session().post(self.chat_endpoint, data=self._encode_payload(payload), stream=True, timeout=180)
+                metrics.UPSTREAM_REQUESTS.inc(stage=stage_name, status=response.status_code)
+                try:
+                    delay = self._upstream_retry_delay(response.status_code, response.headers.get('Retry-After'), attempt)
+                    if delay is None:
+                        with on_cancel(cancel_token, lambda: abort_response(response)):
+                            try:
+                                yield response
+                            except Exception:
+                                check_cancelled(cancel_token)
+                                raise
+                        return
+                finally:
+                    response.close()
+            logger.warning(f"Perplexity answered {response.status_code} for {stage_name}, retrying in {delay:.1f}s ({attempt + 1}/{self.upstream_retries})")
+            if cancel_token is not None:
+                cancel_token.sleep(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
     def _get_headers(self) -> Dict[str, str]:
         return {
             "Authorization": f"Bearer {self.api_key}",
@@ -439,291 +774,651 @@ class PerplexityClient:
         }
         
     def _get_sub_schema(self, properties_to_target: List[str], stage_specific_required: List[str]) -> Dict[str, Any]:
-        sub_schema_properties = {}
-        sub_schema_required = set()
-
-        def get_nested_property_definition(path_parts: List[str], schema_node: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-            current_node = schema_node
-            for part in path_parts:
-                if part == "*" and current_node.get("type") == "array" and "items" in current_node:
-                    current_node = current_node["items"]
-                elif "properties" in current_node and part in current_node["properties"]:
-                    current_node = current_node["properties"][part]
-                else:
-                    return None
-            return current_node
+        return build_sub_schema(self.ADPIE_SCHEMA, properties_to_target, stage_specific_required)
 
-        for prop_path_str in properties_to_target:
-            path_parts = prop_path_str.split('.')
-            current_sub_schema_level = sub_schema_properties
-            
-            for i, part_name in enumerate(path_parts):
-                is_last_part = (i == len(path_parts) - 1)
-                
-                if part_name == "*":
-                    if not isinstance(current_sub_schema_level, dict) or current_sub_schema_level.get("type") != "array":
-                        if i == 0 and path_parts[0] in self.ADPIE_SCHEMA["properties"] and self.ADPIE_SCHEMA["properties"][path_parts[0]].get("type") == "array":
-                           current_sub_schema_level = {"type": "array", "items": {"type": "object", "properties": {}}}
-                           sub_schema_properties[path_parts[0]] = current_sub_schema_level 
-                        else:
-                            logger.warning(f"Schema path error: Expected array for '*' in {prop_path_str}")
-                            break 
-                    
-                    if "items" not in current_sub_schema_level or not isinstance(current_sub_schema_level["items"], dict):
-                         current_sub_schema_level["items"] = {"type": "object", "properties": {}}
-                    
-                    if "properties" not in current_sub_schema_level["items"]:
-                        current_sub_schema_level["items"]["properties"] = {}
-                        
-                    current_sub_schema_level = current_sub_schema_level["items"]["properties"]
-                    continue
+    @classmethod
+    def _compile_stage_schemas(cls) -> None:
+        """
+        Builds every stage's sub-schema (and the variant used by fan-out sub-requests) once, together with
+        its serialized response_format and schema validator, and the merge engine, and checks that every depends_on names a known
+        stage and every context path exists in the schema. Runs at import, so a bad property path fails at
+        startup instead of mid-request. The compiled schemas are shared by all requests and must not be mutated.
+        """
+        stage_names = {stage_config["name"] for stage_config in cls.STAGES_CONFIG}
+        cls._compiled_response_formats = {}
+        cls._response_format_json = {}
+        cls._stage_validators = {}
+        for stage_config in cls.STAGES_CONFIG:
+            unknown_dependencies = set(stage_config.get("depends_on", [])) - stage_names
+            if unknown_dependencies:
+                raise ValueError(f"{stage_config['name']} depends on unknown stages: {sorted(unknown_dependencies)}")
+            build_sub_schema(cls.ADPIE_SCHEMA, stage_config.get("context_paths", []), [])
 
-                if part_name not in current_sub_schema_level:
-                    original_prop_def = get_nested_property_definition(path_parts[:i+1], self.ADPIE_SCHEMA)
-                    if not original_prop_def:
-                        logger.warning(f"Property definition not found in ADPIE_SCHEMA for: {'.'.join(path_parts[:i+1])}")
-                        break 
-
-                    current_sub_schema_level[part_name] = {"type": original_prop_def.get("type")}
-                    if original_prop_def.get("type") == "object":
-                        current_sub_schema_level[part_name]["properties"] = {}
-                    elif original_prop_def.get("type") == "array":
-                        current_sub_schema_level[part_name]["items"] = json.loads(json.dumps(original_prop_def.get("items", {"type": "string"})))
-
-                if is_last_part:
-                    full_def = get_nested_property_definition(path_parts, self.ADPIE_SCHEMA)
-                    if full_def:
-                        current_sub_schema_level[part_name] = json.loads(json.dumps(full_def))
-                    else:
-                         logger.warning(f"Could not get full definition for {prop_path_str}")
-                else:
-                    if current_sub_schema_level[part_name].get("type") == "object":
-                        current_sub_schema_level = current_sub_schema_level[part_name]["properties"]
-                    elif current_sub_schema_level[part_name].get("type") == "array":
-                        original_item_def_for_array = get_nested_property_definition(path_parts[:i+1], self.ADPIE_SCHEMA)
-                        if original_item_def_for_array and \
-                           original_item_def_for_array.get("type") == "array" and \
-                           isinstance(original_item_def_for_array.get("items"), dict) and \
-                           original_item_def_for_array["items"].get("type") == "object":
-                            current_sub_schema_level[part_name]["items"] = json.loads(json.dumps(original_item_def_for_array["items"]))
-                        else:
-                            logger.warning(f"Cannot navigate into non-object items for array path {prop_path_str} at {part_name}")
-                            break 
-                        current_sub_schema_level = current_sub_schema_level[part_name]["items"]["properties"]
-                    else: 
-                        break
+            variants = {False: stage_config["properties_to_generate_or_update"]}
+            if stage_config.get("fan_out"):
+                variants[True] = [path for path in variants[False] if path.startswith("nursingDiagnoses.")]
+            for fan_out, properties_to_target in variants.items():
+                response_format = {
+                    "type": "json_schema",
+                    "json_schema": {"schema": build_sub_schema(cls.ADPIE_SCHEMA, properties_to_target, stage_config["required_for_this_stage_output"])}
+                }
+                cls._compiled_response_formats[(stage_config["name"], fan_out)] = response_format
+                cls._response_format_json[id(response_format)] = serialization.dumps_bytes(response_format)
+
+            targets = stage_config["properties_to_generate_or_update"]
+            other_targets = [path for other in cls.STAGES_CONFIG if other is not stage_config for path in other["properties_to_generate_or_update"]]
+            excluded = [path for path in other_targets if any(path.startswith(target + ".") for target in targets)]
+            cls._stage_validators[stage_config["name"]] = StageSchemaValidator(
+                cls.ADPIE_SCHEMA, cls._compiled_response_formats[(stage_config["name"], False)]["json_schema"]["schema"],
+                targets, stage_config["required_for_this_stage_output"], excluded
+            )
+        cls._merge_engine = MergeEngine(cls.ADPIE_SCHEMA, cls.STAGES_CONFIG, cls.MERGE_MATCH_KEYS)
+
+    def _encode_payload(self, payload: Dict[str, Any]) -> bytes:
+        """
+        Serializes a chat payload for the request body. A precompiled response_format is spliced in from its
+        cached JSON instead of being re-serialized on every call.
+        """
+        response_format_json = self._response_format_json.get(id(payload.get("response_format")))
+        if response_format_json is None:
+            return serialization.dumps_bytes(payload)
+        payload_without_schema = {key: value for key, value in payload.items() if key != "response_format"}
+        return serialization.dumps_bytes(payload_without_schema)[:-1] + b',"response_format":' + response_format_json + b'}'
+
+    def _build_stage_payload(self, stage_idx: int, stage_config: Dict[str, Any], patient_form_data: Dict[str, Any],
+                             care_environment: str, focus_areas: List[str], current_care_plan: Dict[str, Any],
+                             fan_out_scope: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        base_system_prompt = (
+            "You are an expert clinical AI. Based on the full patient context and any previously generated care plan sections "
+            "provided in the user message, your task for this specific stage is to: {focus_template}. "
+            "Generate ONLY the data specified by the JSON schema provided for this stage. "
+            "Do not regenerate or include any fields that are not part of this stage's specific schema."
+        )
+        system_prompt = base_system_prompt.format(focus_template=stage_config["system_prompt_focus_template"])
+
+        if fan_out_scope:
+            # A fan-out sub-request only sees, and only answers for, a single diagnosis (or goal)
+            scoped_diagnosis = current_care_plan["nursingDiagnoses"][fan_out_scope["diagnosis_index"]]
+            scope_description = f"nursing diagnosis {fan_out_scope['diagnosis_index'] + 1} of {fan_out_scope['diagnosis_count']}"
+            if fan_out_scope.get("goal_index") is not None:
+                goal = scoped_diagnosis["goals"][fan_out_scope["goal_index"]]
+                scoped_diagnosis = dict(scoped_diagnosis, goals=[goal])
+                scope_description += f", goal {fan_out_scope['goal_index'] + 1} of {fan_out_scope['goal_count']}"
+            current_care_plan = dict(current_care_plan, nursingDiagnoses=[scoped_diagnosis])
+            system_prompt += (
+                f" This request covers only {scope_description}, which is the single entry of `nursingDiagnoses` in the context. "
+                "Return exactly one element in `nursingDiagnoses`"
+                + (" containing exactly one goal." if fan_out_scope.get("goal_index") is not None else " with one entry per goal, in the same order.")
+            )
         
-        for req_path_str in stage_specific_required:
-            req_path_parts = req_path_str.split('.')
-            if req_path_parts[0] in sub_schema_properties:
-                 sub_schema_required.add(req_path_parts[0])
+        user_message_content = {
+            "patientFormData": patient_form_data,
+            "careEnvironment": care_environment,
+            "focusAreas": focus_areas
+        }
+        if stage_idx > 0:
+            user_message_content["currentCarePlanContext"] = current_care_plan
+        user_prompt = f"Patient and Care Plan Context:\n{self._serialize_context(stage_config, user_message_content)}"
 
-        final_sub_schema = {
-            "type": "object",
-            "properties": sub_schema_properties,
+        return {
+            "model": "sonar-reasoning-pro",
+            "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
+            "max_tokens": 8000, "stream": True, "temperature": 0.2,
+            "response_format": self._compiled_response_formats[(stage_config["name"], bool(fan_out_scope))]
         }
-        if sub_schema_required:
-            final_sub_schema["required"] = sorted(list(sub_schema_required))
-        
-        return final_sub_schema
 
-    def stream_full_care_plan_sequentially(self, patient_form_data: Dict[str, Any], care_environment: str, focus_areas: List[str]) -> Generator[Dict[str, Any], None, None]:
-        current_care_plan: Dict[str, Any] = {}
-        yield {"type": "overall_generation_start"}
+    def _serialize_context(self, stage_config: Dict[str, Any], user_message_content: Dict[str, Any]) -> str:
+        """
+        Serializes the user message content. With compact_context the care plan is first projected to the
+        stage's context_paths and its long strings shortened, and the JSON is written without indentation.
+        """
+        if not self.compact_context:
+            return serialization.dumps(user_message_content, indent=True)
 
-        for stage_idx, stage_config in enumerate(self.STAGES_CONFIG):
-            stage_name = stage_config["name"]
-            accordion_title = stage_config["accordion_title"]
-            logger.info(f"Starting {stage_name} ({accordion_title})")
-            yield {"type": "stage_start", "stage_name": stage_name, "accordion_title": accordion_title, "stage_index": stage_idx}
-
-            base_system_prompt = (
-                "You are an expert clinical AI. Based on the full patient context and any previously generated care plan sections "
-                "provided in the user message, your task for this specific stage is to: {focus_template}. "
-                "Generate ONLY the data specified by the JSON schema provided for this stage. "
-                "Do not regenerate or include any fields that are not part of this stage's specific schema."
-            )
-            system_prompt = base_system_prompt.format(focus_template=stage_config["system_prompt_focus_template"])
-            
-            user_message_content = {
-                "patientFormData": patient_form_data,
-                "careEnvironment": care_environment,
-                "focusAreas": focus_areas
-            }
-            if stage_idx > 0:
-                user_message_content["currentCarePlanContext"] = current_care_plan
-            user_prompt = f"Patient and Care Plan Context:\n{json.dumps(user_message_content, indent=2)}"
+        compact_content = dict(user_message_content)
+        care_plan_context = compact_content.get("currentCarePlanContext")
+        if care_plan_context is not None:
+            if stage_config.get("context_paths") is not None:
+                care_plan_context = project_context(care_plan_context, stage_config["context_paths"])
+            if self.context_max_string_chars > 0:
+                care_plan_context = shorten_long_strings(care_plan_context, self.context_max_string_chars)
+            compact_content["currentCarePlanContext"] = care_plan_context
+        serialized = serialization.dumps(compact_content)
 
-            sub_schema_for_stage = self._get_sub_schema(
-                stage_config["properties_to_generate_or_update"],
-                stage_config["required_for_this_stage_output"]
-            )
-            
-            payload = {
-                "model": "sonar-reasoning-pro",
-                "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-                "max_tokens": 8000, "stream": True, "temperature": 0.2,
-                "response_format": {"type": "json_schema", "json_schema": {"schema": sub_schema_for_stage}}
-            }
-            
-            stage_full_response_text = ""
-            in_think_block_for_streaming = False
-            
-            try:
-                logger.info(f"Requesting Perplexity for {stage_name}. Sub-schema properties: {list(sub_schema_for_stage.get('properties', {}).keys())}")
-                response = requests.post(self.chat_endpoint, headers=self._get_headers(), json=payload, stream=True, timeout=180)
+        # The saving is only measured when debugging, as it takes serializing the whole context a second time
+        if logger.isEnabledFor(logging.DEBUG):
+            full_size = len(serialization.dumps(user_message_content, indent=True))
+            saved = full_size - len(serialized)
+            # ~4 characters per token is close enough for English prose and JSON
+            logger.debug(f"Context for {stage_config['name']}: {len(serialized)} characters instead of {full_size} (saved {saved}, ~{saved // 4} tokens)")
+        return serialized
+
+    def _parse_stream_line(self, line_text: str, stage_name: str) -> Optional[str]:
+        """
+        Returns the delta content carried by one SSE line of the upstream stream,
+        "" for lines without content and None once the [DONE] sentinel arrives.
+        """
+        if not line_text.startswith('data: '):
+            return ""
+        json_str = line_text[len('data: '):]
+        if json_str == "[DONE]":
+            return None
+        try:
+            chunk = serialization.loads(json_str)
+            return chunk.get("choices", [{}])[0].get("delta", {}).get("content", "")
+        except serialization.JSONDecodeError:
+            logger.warning(f"Skipping non-JSON line in stream for {stage_name}: {json_str}")
+            return ""
+
+    def _extract_stage_result(self, stage_name: str, stage_response: StageResponseParser) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Collects the reasoning and JSON parsed from a finished stage response.
+        Returns the events to forward to the client and the stage JSON ({} if none was found); the
+        stage_json_chunk event is sent by _stage_flow once the JSON is final.
+        """
+        markdown_reasoning = self._format_reasoning_as_markdown(stage_response.reasoning)
+        stage_json_output = stage_response.json_output
+
+        logger.info(f"Extracted reasoning for {stage_name} (len: {len(markdown_reasoning)}). JSON extracted: {'Yes' if stage_json_output else 'No'}")
+        if not stage_json_output:
+             logger.warning(f"No JSON output extracted for {stage_name}. Full response: {stage_response.text[:500]}")
+             metrics.JSON_EXTRACTION_FAILURES.inc(stage=stage_name)
+
+        events = [
+            {"type": "stage_reasoning_complete", "stage_name": stage_name, "reasoning_markdown": markdown_reasoning}
+        ]
+        return events, stage_json_output
+
+    def _stage_json_event(self, stage_name: str, stage_json_output: Dict[str, Any]) -> Dict[str, Any]:
+        return {"type": "stage_json_chunk", "stage_name": stage_name, "json_data": stage_json_output if stage_json_output else {}}
+
+    def _stage_dependencies(self) -> Dict[str, List[str]]:
+        """Returns, for every stage, all stages it depends on directly or transitively, in STAGES_CONFIG order."""
+        stage_order = [stage_config["name"] for stage_config in self.STAGES_CONFIG]
+        direct = {stage_config["name"]: stage_config.get("depends_on", []) for stage_config in self.STAGES_CONFIG}
+        dependencies = {}
+        for stage_name in stage_order:
+            found = set()
+            to_visit = list(direct[stage_name])
+            while to_visit:
+                dependency = to_visit.pop()
+                if dependency not in found:
+                    found.add(dependency)
+                    to_visit.extend(direct.get(dependency, []))
+            dependencies[stage_name] = [name for name in stage_order if name in found]
+        return dependencies
+
+    def _assemble_care_plan(self, stage_outputs: Dict[str, Dict[str, Any]], stage_names: List[str]) -> Dict[str, Any]:
+        """
+        Builds a care plan from the given stages' outputs. The merge engine ranks stages by STAGES_CONFIG,
+        so the result does not depend on the order they finished in, and the outputs are left untouched.
+        """
+        builder = self.merge_engine.new_care_plan()
+        for stage_name in stage_names:
+            if stage_outputs.get(stage_name):
+                merge_started = time.perf_counter()
+                builder.merge(stage_name, stage_outputs[stage_name])
+                metrics.STAGE_MERGE_SECONDS.observe(time.perf_counter() - merge_started, stage=stage_name)
+        return builder.care_plan
+
+    def _plan_fan_out(self, stage_config: Dict[str, Any], current_care_plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Returns one scope per sub-request for a fan-out stage, or [] when the stage runs as a single request."""
+        if self.fan_out_mode == "off" or not stage_config.get("fan_out"):
+            return []
+        diagnoses = current_care_plan.get("nursingDiagnoses")
+        if not isinstance(diagnoses, list):
+            return []
+
+        scopes = []
+        for diag_idx, diagnosis in enumerate(diagnoses):
+            goals = diagnosis.get("goals") if isinstance(diagnosis, dict) else None
+            if not isinstance(goals, list) or not goals:
+                continue # Nothing to generate for a diagnosis without goals
+            if self.fan_out_mode == "goal":
+                for goal_idx in range(len(goals)):
+                    scopes.append({"diagnosis_index": diag_idx, "diagnosis_count": len(diagnoses), "goal_index": goal_idx, "goal_count": len(goals)})
+            else:
+                scopes.append({"diagnosis_index": diag_idx, "diagnosis_count": len(diagnoses), "goal_index": None})
+        return scopes
+
+    def _fan_out_event_fields(self, sub_request_index: int, scope: Dict[str, Any]) -> Dict[str, Any]:
+        return {"sub_request_index": sub_request_index, "diagnosis_index": scope["diagnosis_index"], "goal_index": scope["goal_index"]}
 
+    def _extract_fan_out_result(self, stage_name: str, scopes: List[Dict[str, Any]], sub_responses: List[Optional[StageResponseParser]],
+                                current_care_plan: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Fan-out counterpart of _extract_stage_result. Each sub-request answers with a single diagnosis (or goal),
+        which is put back at its index; entries without a result stay {} so merging them changes nothing.
+        """
+        assembled_diagnoses: List[Dict[str, Any]] = [{} for _ in current_care_plan["nursingDiagnoses"]]
+        reasoning_sections = []
+        for scope, sub_response in zip(scopes, sub_responses):
+            if sub_response is None:
+                continue
+            section_title = f"Nursing Diagnosis {scope['diagnosis_index'] + 1}"
+            if scope["goal_index"] is not None:
+                section_title += f", Goal {scope['goal_index'] + 1}"
+            markdown_reasoning = self._format_reasoning_as_markdown(sub_response.reasoning)
+            if markdown_reasoning:
+                reasoning_sections.append(f"### {section_title}\n\n{markdown_reasoning}")
+
+            returned_diagnoses = sub_response.json_output.get("nursingDiagnoses")
+            if not isinstance(returned_diagnoses, list) or not returned_diagnoses or not isinstance(returned_diagnoses[0], dict):
+                logger.warning(f"No usable JSON output for {stage_name} ({section_title}). Full response: {sub_response.text[:500]}")
+                metrics.JSON_EXTRACTION_FAILURES.inc(stage=stage_name)
+                continue
+
+            diag_idx = scope["diagnosis_index"]
+            if scope["goal_index"] is None:
+                assembled_diagnoses[diag_idx] = returned_diagnoses[0]
+            else:
+                returned_goals = returned_diagnoses[0].get("goals")
+                if isinstance(returned_goals, list) and returned_goals and isinstance(returned_goals[0], dict):
+                    goals = assembled_diagnoses[diag_idx].setdefault("goals", [{} for _ in range(scope["goal_count"])])
+                    goals[scope["goal_index"]] = returned_goals[0]
+
+        stage_json_output = {"nursingDiagnoses": assembled_diagnoses}
+        markdown_reasoning = "\n\n".join(reasoning_sections)
+        logger.info(f"Reassembled {stage_name} from {len(scopes)} sub-requests (reasoning len: {len(markdown_reasoning)})")
+        events = [
+            {"type": "stage_reasoning_complete", "stage_name": stage_name, "reasoning_markdown": markdown_reasoning}
+        ]
+        return events, stage_json_output
+
+    def _partial_json_events(self, stage_name: str, stage_response: StageResponseParser, event_fields: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        stage_json_partial events for the values stage_response completed since the last call. A fan-out
+        sub-response only describes nursingDiagnoses[0](.goals[0]), so its paths are moved to the
+        sub-request's diagnosis (and goal) and anything outside that scope is dropped; the paths of a
+        repair answer start at the path its keys point to.
+        """
+        events = []
+        for path, value in stage_response.drain_partials():
+            if "repair_index" in event_fields:
+                # A repair answer holds each value under the JSON Pointer of its path in the stage output
+                if not isinstance(path[0], str) or not path[0].startswith("/"):
+                    continue
+                path = list(parse_json_pointer(path[0])) + path[1:]
+            elif "diagnosis_index" in event_fields:
+                scope_path = ["nursingDiagnoses", 0] if event_fields["goal_index"] is None else ["nursingDiagnoses", 0, "goals", 0]
+                if path[:len(scope_path)] != scope_path:
+                    continue
+                path[1] = event_fields["diagnosis_index"]
+                if event_fields["goal_index"] is not None:
+                    path[3] = event_fields["goal_index"]
+            events.append({"type": "stage_json_partial", "stage_name": stage_name, "path": path, "value": value, **event_fields})
+        return events
+
+    def _new_reasoning_streams(self) -> Tuple[ReasoningCoalescer, Optional[ReasoningMarkdownStream]]:
+        """The per-call state of _reasoning_events: a delta coalescer and, if stream_reasoning_markdown is on, a Markdown stream."""
+        coalescer = ReasoningCoalescer(self.reasoning_coalesce_ms / 1000, self.reasoning_coalesce_chars)
+        return coalescer, ReasoningMarkdownStream() if self.stream_reasoning_markdown else None
+
+    def _reasoning_events(self, stage_name: str, reasoning_delta: str, coalescer: ReasoningCoalescer,
+                          markdown_stream: Optional[ReasoningMarkdownStream], event_fields: Dict[str, Any],
+                          final: bool = False) -> List[Dict[str, Any]]:
+        """
+        reasoning_text_chunk event for the reasoning coalescer lets through with this delta, plus a
+        reasoning_markdown_chunk event when markdown_stream completed paragraphs with it. final flushes both.
+        """
+        events = []
+        reasoning_text = coalescer.add(reasoning_delta)
+        if final:
+            reasoning_text += coalescer.flush()
+        if reasoning_text:
+            events.append({"type": "reasoning_text_chunk", "stage_name": stage_name, "content": reasoning_text, **event_fields})
+        if markdown_stream is not None:
+            markdown = markdown_stream.feed(reasoning_text)
+            if final:
+                markdown += markdown_stream.close()
+            if markdown:
+                events.append({"type": "reasoning_markdown_chunk", "stage_name": stage_name, "content": markdown, **event_fields})
+        return events
+
+    def _replay_cached_response(self, response_text: str, stage_name: str, event_fields: Dict[str, Any],
+                                stage_response: StageResponseParser) -> List[Dict[str, Any]]:
+        """
+        Feeds a cached response through stage_response in chunks, returning reasoning and partial JSON
+        events shaped like a live stream's so clients cannot tell the difference.
+        """
+        events = []
+        coalescer, markdown_stream = self._new_reasoning_streams()
+        for start in range(0, len(response_text), CACHE_REPLAY_CHUNK_CHARS):
+            reasoning_delta = stage_response.feed(response_text[start:start + CACHE_REPLAY_CHUNK_CHARS])
+            events.extend(self._reasoning_events(stage_name, reasoning_delta, coalescer, markdown_stream, event_fields))
+            events.extend(self._partial_json_events(stage_name, stage_response, event_fields))
+        stage_response.close()
+        events.extend(self._reasoning_events(stage_name, "", coalescer, markdown_stream, event_fields, final=True))
+        events.extend(self._partial_json_events(stage_name, stage_response, event_fields))
+        return events
+
+    def _stream_completion(self, payload: Dict[str, Any], stage_name: str, event_fields: Optional[Dict[str, Any]] = None,
+                           cancel_token: Optional[CancellationToken] = None) -> Generator[Dict[str, Any], None, Optional[StageResponseParser]]:
+        """
+        Makes one streamed upstream call, yielding its reasoning, partial JSON and error events (tagged with event_fields).
+        Returns the parsed response, or None if the call failed or cancel_token was cancelled, in which case the
+        response is closed at the next streamed line. Identical calls are served from the response cache when one is configured.
+        """
+        event_fields = event_fields or {}
+        stage_response = StageResponseParser(emit_partials=self.partial_json_events)
+        coalescer, markdown_stream = self._new_reasoning_streams()
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = self.response_cache.make_key(payload)
+            cached_response_text = self.response_cache.get(cache_key)
+            if cached_response_text is not None:
+                logger.info(f"Response cache hit for {stage_name} ({cache_key[:12]})")
+                metrics.RESPONSE_CACHE_HITS.inc(stage=stage_name)
+                for event in self._replay_cached_response(cached_response_text, stage_name, event_fields, stage_response):
+                    yield event
+                return stage_response
+
+        sub_schema_for_stage = payload["response_format"]["json_schema"]["schema"]
+        stream_done = False
+        call_metrics = metrics.UpstreamCallMetrics(stage_name)
+        
+        try:
+            logger.info(f"Requesting Perplexity for {stage_name}. Sub-schema properties: {list(sub_schema_for_stage.get('properties', {}).keys())}")
+            # The upstream slot is held for the whole streamed response, which is what upstream concurrency limits count
+            with self._open_upstream_stream(payload, stage_name, cancel_token) as response:
+                call_metrics.response_started()
                 if response.status_code != 200:
                     error_msg = f"Perplexity API Error for {stage_name}: {response.status_code} - {response.text}"
                     logger.error(error_msg)
-                    yield {"type": "error", "stage_name": stage_name, "content": error_msg}
-                    continue
+                    call_metrics.failed("http_status")
+                    yield {"type": "error", "stage_name": stage_name, "content": error_msg, **event_fields}
+                    return None
 
+                # Read the body to the end rather than breaking out at [DONE]: only a fully
+                # consumed response hands its keep-alive connection back to the pool.
                 for line in response.iter_lines():
-                    if line:
-                        line_text = line.decode('utf-8')
-                        if line_text.startswith('data: '):
-                            json_str = line_text[len('data: '):]
-                            if json_str == "[DONE]": break
-                            try:
-                                chunk = json.loads(json_str)
-                                delta_content = chunk.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                                if delta_content:
-                                    stage_full_response_text += delta_content
-                                    
-                                    current_think_content = ""
-                                    if "<think>" in delta_content:
-                                        in_think_block_for_streaming = True
-                                        # Content after <think> in this chunk
-                                        temp_content = delta_content.split("<think>", 1)[1]
-                                        if "</think>" in temp_content: # <think>...</think> in same chunk
-                                            current_think_content = temp_content.split("</think>", 1)[0]
-                                            in_think_block_for_streaming = False
-                                        else: # Just <think>...
-                                            current_think_content = temp_content
-                                    elif in_think_block_for_streaming:
-                                        if "</think>" in delta_content: # ...</think>
-                                            current_think_content = delta_content.split("</think>", 1)[0]
-                                            in_think_block_for_streaming = False
-                                        else: # ...middle of think block...
-                                            current_think_content = delta_content
-                                    
-                                    if current_think_content:
-                                        yield {"type": "reasoning_text_chunk", "stage_name": stage_name, "content": current_think_content}
-                                            
-                            except json.JSONDecodeError:
-                                logger.warning(f"Skipping non-JSON line in stream for {stage_name}: {json_str}")
-                
-                logger.info(f"Stream complete for {stage_name}. Accumulated response length: {len(stage_full_response_text)}")
-            except requests.RequestException as e:
-                error_msg = f"RequestException during {stage_name}: {str(e)}"
-                logger.error(error_msg)
-                yield {"type": "error", "stage_name": stage_name, "content": error_msg}
-                continue
-            except Exception as e_generic:
-                error_msg = f"Generic Exception during {stage_name} API call: {str(e_generic)}"
-                logger.exception(f"Generic exception in {stage_name}:")
-                yield {"type": "error", "stage_name": stage_name, "content": error_msg}
+                    call_metrics.response_bytes += len(line)
+                    check_cancelled(cancel_token)
+                    if not line or stream_done:
+                        continue
+                    parse_started = time.perf_counter()
+                    delta_content = self._parse_stream_line(line.decode('utf-8'), stage_name)
+                    if delta_content is None:
+                        stream_done = True
+                        continue
+                    if delta_content:
+                        reasoning_delta = stage_response.feed(delta_content)
+                        reasoning_events = self._reasoning_events(stage_name, reasoning_delta, coalescer, markdown_stream, event_fields)
+                        partial_events = self._partial_json_events(stage_name, stage_response, event_fields)
+                        call_metrics.delta_parsed(parse_started, reasoning_delta, stage_response.json_started)
+                        for event in reasoning_events + partial_events:
+                            yield event
+            stage_response.close()
+            for event in self._reasoning_events(stage_name, "", coalescer, markdown_stream, event_fields, final=True):
+                yield event
+            for event in self._partial_json_events(stage_name, stage_response, event_fields):
+                yield event
+
+            call_metrics.finished()
+            logger.info(f"Stream complete for {stage_name}. Accumulated response length: {len(stage_response.text)}")
+        except GenerationCancelled:
+            logger.info(f"Cancelled the upstream call of {stage_name}")
+            call_metrics.failed("cancelled")
+            return None
+        except requests.RequestException as e:
+            error_msg = f"RequestException during {stage_name}: {str(e)}"
+            logger.error(error_msg)
+            call_metrics.failed("connection")
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_failure()
+            # Reasoning that arrived before the failure is still sent
+            for event in self._reasoning_events(stage_name, "", coalescer, markdown_stream, event_fields, final=True):
+                yield event
+            yield {"type": "error", "stage_name": stage_name, "content": error_msg, **event_fields}
+            return None
+        except Exception as e_generic:
+            error_msg = f"Generic Exception during {stage_name} API call: {str(e_generic)}"
+            logger.exception(f"Generic exception in {stage_name}:")
+            call_metrics.failed("exception")
+            for event in self._reasoning_events(stage_name, "", coalescer, markdown_stream, event_fields, final=True):
+                yield event
+            yield {"type": "error", "stage_name": stage_name, "content": error_msg, **event_fields}
+            return None
+
+        # Never cache a response we could not use; it would be replayed forever
+        if cache_key is not None and stream_done and stage_response.json_output:
+            self.response_cache.set(cache_key, stage_response.text)
+        return stage_response
+
+    def _plan_repair(self, stage_config: Dict[str, Any], patient_form_data: Dict[str, Any], care_environment: str,
+                     focus_areas: List[str], current_care_plan: Dict[str, Any], stage_json_output: Dict[str, Any]) -> StageRepair:
+        """Validates the stage output and plans the repair requests for the gaps it left."""
+        stage_name = stage_config["name"]
+        return StageRepair(
+            stage_name, stage_json_output, self._stage_validators[stage_name], self.merge_engine,
+            functools.partial(self._build_repair_payload, stage_config, patient_form_data, care_environment, focus_areas, current_care_plan, stage_json_output),
+            self.repair_max_paths, self.repair_max_requests
+        )
+
+    def _build_repair_payload(self, stage_config: Dict[str, Any], patient_form_data: Dict[str, Any], care_environment: str,
+                              focus_areas: List[str], current_care_plan: Dict[str, Any], stage_json_output: Dict[str, Any],
+                              paths: List[Path]) -> Dict[str, Any]:
+        """A request for just the values at paths of the stage output, answered as an object keyed by their JSON Pointers."""
+        system_prompt = (
+            "You are an expert clinical AI completing a care plan section that was generated with some values missing or invalid. "
+            "The section's task was to: {focus_template}. The user message holds the patient context, the care plan so far and the "
+            "section as generated (stageOutput). Return ONLY the values for these JSON Pointer locations in stageOutput (array indices "
+            "start at 0), each under its pointer as the key, as specified by the JSON schema: {pointers}. Keep them consistent with the "
+            "rest of the care plan."
+        ).format(focus_template=stage_config["system_prompt_focus_template"], pointers=", ".join(json_pointer(path) for path in paths))
+        user_message_content = {
+            "patientFormData": patient_form_data,
+            "careEnvironment": care_environment,
+            "focusAreas": focus_areas,
+            "currentCarePlanContext": current_care_plan,
+            "stageOutput": stage_json_output
+        }
+        user_prompt = f"Patient and Care Plan Context:\n{self._serialize_context(stage_config, user_message_content)}"
+        repair_schema = self._stage_validators[stage_config["name"]].repair_schema(paths)
+        return {
+            "model": "sonar-reasoning-pro",
+            "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
+            "max_tokens": 8000, "stream": True, "temperature": 0.2,
+            "response_format": {"type": "json_schema", "json_schema": {"schema": repair_schema}}
+        }
+
+    def _stage_flow(self, stage_idx: int, stage_config: Dict[str, Any], patient_form_data: Dict[str, Any],
+                    care_environment: str, focus_areas: List[str], current_care_plan: Dict[str, Any],
+                    cancel_token: Optional[CancellationToken] = None) -> Generator[Union[Dict[str, Any], CompletionCall, CallBatch], Optional[StageResponseParser], Optional[Dict[str, Any]]]:
+        """
+        Runs one stage without making any upstream call itself, so the sync and async clients share it. Yields the
+        stage's events and, between them, the calls it needs: a CompletionCall is sent back its parsed response
+        (None if it failed), a CallBatch has run once the flow resumes. Returns the stage JSON ({} if none could be
+        extracted), or None if the upstream call failed. With schema_repair, the values the stage left missing or
+        invalid are requested again before its stage_json_chunk is sent.
+        """
+        stage_name = stage_config["name"]
+        accordion_title = stage_config["accordion_title"]
+        logger.info(f"Starting {stage_name} ({accordion_title})")
+        yield {"type": "stage_start", "stage_name": stage_name, "accordion_title": accordion_title, "stage_index": stage_idx}
+        stage_started = time.perf_counter()
+        stage_json_output = None
+        try:
+            scopes = self._plan_fan_out(stage_config, current_care_plan)
+            if scopes:
+                logger.info(f"Fanning out {stage_name} into {len(scopes)} sub-requests ({self.fan_out_mode} mode)")
+                call_batch = CallBatch([
+                    CompletionCall(self._build_stage_payload(stage_idx, stage_config, patient_form_data, care_environment, focus_areas, current_care_plan, scope),
+                                   stage_name, self._fan_out_event_fields(sub_request_index, scope))
+                    for sub_request_index, scope in enumerate(scopes)
+                ], self.fan_out_concurrency)
+                yield call_batch
+                if any(sub_response is not None for sub_response in call_batch.responses):
+                    stage_events, stage_json_output = self._extract_fan_out_result(stage_name, scopes, call_batch.responses, current_care_plan)
+                    for event in stage_events:
+                        yield event
+            else:
+                payload = self._build_stage_payload(stage_idx, stage_config, patient_form_data, care_environment, focus_areas, current_care_plan)
+                stage_response = yield CompletionCall(payload, stage_name, {})
+                if stage_response is not None:
+                    stage_events, stage_json_output = self._extract_stage_result(stage_name, stage_response)
+                    for event in stage_events:
+                        yield event
+            if stage_json_output is None:
+                return None
+
+            if self.schema_repair:
+                stage_repair = self._plan_repair(stage_config, patient_form_data, care_environment, focus_areas, current_care_plan, stage_json_output)
+                for request in stage_repair.requests():
+                    if is_cancelled(cancel_token):
+                        break
+                    yield request.start_event(stage_name)
+                    stage_response = yield CompletionCall(request.payload, stage_name, request.event_fields)
+                    yield stage_repair.apply(request, stage_response)
+                stage_json_output = stage_repair.finish()
+            yield self._stage_json_event(stage_name, stage_json_output)
+            return stage_json_output
+        finally:
+            metrics.observe_stage(stage_name, time.perf_counter() - stage_started, stage_json_output)
+
+    def _stream_stage(self, stage_idx: int, stage_config: Dict[str, Any], patient_form_data: Dict[str, Any],
+                      care_environment: str, focus_areas: List[str], current_care_plan: Dict[str, Any],
+                      cancel_token: Optional[CancellationToken] = None) -> Generator[Dict[str, Any], None, Optional[Dict[str, Any]]]:
+        """Streams one stage, making the upstream calls its _stage_flow asks for. Returns what the flow returns."""
+        with contextlib.closing(self._stage_flow(stage_idx, stage_config, patient_form_data, care_environment, focus_areas, current_care_plan, cancel_token)) as flow:
+            reply = None
+            while True:
+                try:
+                    item = flow.send(reply)
+                except StopIteration as stop:
+                    return stop.value
+                reply = None
+                if isinstance(item, CompletionCall):
+                    reply = yield from self._stream_completion(item.payload, item.stage_name, item.event_fields, cancel_token)
+                elif isinstance(item, CallBatch):
+                    def stream_call(call: CompletionCall) -> Generator[Dict[str, Any], None, Optional[StageResponseParser]]:
+                        return self._stream_completion(call.payload, call.stage_name, call.event_fields, cancel_token)
+                    for kind, value in self._run_concurrently(item, stream_call, "careplan-fan-out"):
+                        if kind == "event":
+                            yield value
+                        else:
+                            item.finish(*value)
+                else:
+                    yield item
+
+    def _run_concurrently(self, work: Union[StageScheduler, CallBatch], make_stream: Callable[[Any], Generator[Dict[str, Any], None, Any]],
+                          thread_name_prefix: str) -> Generator[Tuple[str, Any], None, None]:
+        """
+        Runs the streams made by make_stream(job) for the jobs work.start() hands out in a thread pool, at most
+        work.max_concurrency at once. Yields ("event", event) as each event arrives and ("done", (key, value))
+        as each stream returns its value (None if it raised, after work.error_event). work.start() is asked for
+        more jobs once the caller has handled each ("done", ...); the run ends when none is running or handed out.
+        """
+        stream_queue: "queue.Queue[Tuple[str, Any]]" = queue.Queue()
+
+        def run_stream(key: Any, job: Any) -> None:
+            value = None
+            try:
+                stream = make_stream(job)
+                while True:
+                    try:
+                        stream_queue.put(("event", next(stream)))
+                    except StopIteration as stop:
+                        value = stop.value
+                        break
+            except Exception as e:
+                stream_queue.put(("event", work.error_event(key, e)))
+            finally:
+                stream_queue.put(("done", (key, value)))
+
+        running = 0
+        executor = ThreadPoolExecutor(max_workers=work.max_concurrency, thread_name_prefix=thread_name_prefix)
+        try:
+            while True:
+                for key, job in work.start():
+                    executor.submit(run_stream, key, job)
+                    running += 1
+                if not running:
+                    return
+                kind, item = stream_queue.get()
+                if kind == "done":
+                    running -= 1
+                yield kind, item
+        finally:
+            executor.shutdown(wait=False)
+
+    def stream_full_care_plan(self, patient_form_data: Dict[str, Any], care_environment: str, focus_areas: List[str],
+                              stage_outputs: Optional[Dict[str, Dict[str, Any]]] = None, stages_to_run: Optional[List[str]] = None,
+                              on_stage_finished: Optional[StageFinishedCallback] = None,
+                              cancel_token: Optional[CancellationToken] = None) -> Generator[Dict[str, Any], None, None]:
+        """
+        Streams a full care plan, running independent stages concurrently unless parallel_stages is off (see
+        _schedule_stages). Events of concurrent stages are interleaved; each carries its stage_name.
+        To resume from a checkpoint, pass the outputs of earlier stages as stage_outputs and the stages to
+        (re)generate as stages_to_run. on_stage_finished is called as each stage finishes. Once cancel_token
+        is cancelled, in-flight upstream calls are closed, no further stage starts and the stream ends with
+        a generation_cancelled event instead of full_care_plan_complete.
+        """
+        stage_scheduler = self._schedule_stages(stage_outputs, stages_to_run, cancel_token)
+        yield {"type": "overall_generation_start"}
+
+        def stream_stage(job: StageJob) -> Generator[Dict[str, Any], None, Optional[Dict[str, Any]]]:
+            return self._stream_stage(job.stage_idx, job.stage_config, patient_form_data, care_environment, focus_areas, job.current_care_plan, cancel_token)
+
+        for kind, item in self._run_concurrently(stage_scheduler, stream_stage, "careplan-stage"):
+            if kind == "event":
+                yield item
                 continue
-            
-            raw_reasoning = self._extract_reasoning_from_think_tags(stage_full_response_text)
-            markdown_reasoning = self._format_reasoning_as_markdown(raw_reasoning)
-            stage_json_output = self._extract_json_from_response(stage_full_response_text)
-
-            logger.info(f"Extracted reasoning for {stage_name} (len: {len(markdown_reasoning)}). JSON extracted: {'Yes' if stage_json_output else 'No'}")
-            if not stage_json_output:
-                 logger.warning(f"No JSON output extracted for {stage_name}. Full response: {stage_full_response_text[:500]}")
-
-            yield {"type": "stage_reasoning_complete", "stage_name": stage_name, "reasoning_markdown": markdown_reasoning}
-            yield {"type": "stage_json_chunk", "stage_name": stage_name, "json_data": stage_json_output if stage_json_output else {}}
-
-            if stage_json_output:
-                # Special handling for merging nursingDiagnoses parts (goals, interventions, evaluations)
-                if stage_name in ["stage_2_diagnosis_goals", "stage_3_interventions", "stage_4_evaluation_criteria"] and \
-                   "nursingDiagnoses" in stage_json_output and \
-                   "nursingDiagnoses" in current_care_plan and \
-                   isinstance(current_care_plan.get("nursingDiagnoses"), list) and \
-                   isinstance(stage_json_output.get("nursingDiagnoses"), list):
-
-                    current_diagnoses_list = current_care_plan["nursingDiagnoses"]
-                    updated_diagnoses_list_from_stage = stage_json_output["nursingDiagnoses"]
-
-                    for diag_idx, current_diag_obj in enumerate(current_diagnoses_list):
-                        if diag_idx < len(updated_diagnoses_list_from_stage) and isinstance(updated_diagnoses_list_from_stage[diag_idx], dict):
-                            stage_diag_data = updated_diagnoses_list_from_stage[diag_idx]
-                            
-                            # Merge diagnosis-level fields for Stage 2
-                            if stage_name == "stage_2_diagnosis_goals":
-                                if "diagnosis_evidence" in stage_diag_data:
-                                    current_diag_obj["diagnosis_evidence"] = stage_diag_data["diagnosis_evidence"]
-                                if "diagnosis_risk_factors" in stage_diag_data:
-                                    current_diag_obj["diagnosis_risk_factors"] = stage_diag_data["diagnosis_risk_factors"]
-                                # Goals themselves are also part of stage_diag_data for Stage 2
-                                if "goals" in stage_diag_data and isinstance(stage_diag_data["goals"], list):
-                                     current_diag_obj["goals"] = stage_diag_data["goals"] # Assume full replacement of goals array for simplicity
-
-                            # Merge goal-level fields (interventions for Stage 3, evaluation for Stage 4)
-                            if "goals" in stage_diag_data and isinstance(stage_diag_data["goals"], list) and \
-                               "goals" in current_diag_obj and isinstance(current_diag_obj["goals"], list):
-                                
-                                current_goals_list = current_diag_obj["goals"]
-                                updated_goals_list_from_stage = stage_diag_data["goals"]
-
-                                for goal_idx, current_goal_obj in enumerate(current_goals_list):
-                                    if goal_idx < len(updated_goals_list_from_stage) and isinstance(updated_goals_list_from_stage[goal_idx], dict):
-                                        stage_goal_data = updated_goals_list_from_stage[goal_idx]
-
-                                        if stage_name == "stage_3_interventions":
-                                            if "interventions" in stage_goal_data:
-                                                current_goal_obj["interventions"] = stage_goal_data["interventions"]
-                                        elif stage_name == "stage_4_evaluation_criteria":
-                                            if "evaluation" in stage_goal_data:
-                                                current_goal_obj["evaluation"] = stage_goal_data["evaluation"]
-                    
-                    # Remove nursingDiagnoses from stage_json_output to prevent deep_merge from overwriting the manual merge
-                    del stage_json_output["nursingDiagnoses"]
-
-                current_care_plan = deep_merge(stage_json_output, current_care_plan)
-            
-            logger.info(f"Care plan after {stage_name} (keys: {list(current_care_plan.keys())})")
+            stage_name, stage_json_output = item
+            status = stage_scheduler.finish(stage_name, stage_json_output)
+            if on_stage_finished is not None:
+                on_stage_finished(stage_name, status, stage_json_output or None)
+        yield stage_scheduler.final_event()
+
+    def select_stages_to_rerun(self, stage_status: Dict[str, str], selected: Optional[List[str]] = None) -> List[str]:
+        """
+        Returns the stages to run again for a checkpoint, in STAGES_CONFIG order: the selected ones, or by default
+        every stage that did not complete together with the stages that depend on it. Raises ValueError for
+        unknown stage names.
+        """
+        stage_order = [stage_config["name"] for stage_config in self.STAGES_CONFIG]
+        if selected is not None:
+            unknown_stages = set(selected) - set(stage_order)
+            if unknown_stages:
+                raise ValueError(f"Unknown stages: {sorted(unknown_stages)}")
+            return [stage_name for stage_name in stage_order if stage_name in selected]
+
+        dependencies = self._stage_dependencies()
+        failed_stages = {stage_name for stage_name in stage_order if stage_status.get(stage_name) != STAGE_STATUS_COMPLETED}
+        return [stage_name for stage_name in stage_order
+                if stage_name in failed_stages or failed_stages.intersection(dependencies[stage_name])]
 
-        yield {"type": "full_care_plan_complete", "care_plan": current_care_plan}
-        logger.info("All stages complete. Final care plan generated.")
+    def _schedule_stages(self, stage_outputs: Optional[Dict[str, Dict[str, Any]]], stages_to_run: Optional[List[str]],
+                         cancel_token: Optional[CancellationToken] = None) -> StageScheduler:
+        """
+        With parallel_stages, every stage runs as soon as the stages in its depends_on have finished, up to
+        max_parallel_stages at once, and sees only the merged output of its own dependencies. Otherwise stages
+        run one at a time in STAGES_CONFIG order, each seeing the merged output of every stage before it.
+        The final plan is merged in STAGES_CONFIG order, so it does not depend on which stage finishes first.
+        """
+        if self.parallel_stages:
+            return StageScheduler(self.STAGES_CONFIG, self._stage_dependencies(), self.max_parallel_stages,
+                                  stage_outputs, stages_to_run, self._assemble_care_plan, cancel_token)
+        stage_order = [stage_config["name"] for stage_config in self.STAGES_CONFIG]
+        earlier_stages = {stage_name: stage_order[:stage_idx] for stage_idx, stage_name in enumerate(stage_order)}
+        return StageScheduler(self.STAGES_CONFIG, earlier_stages, 1, stage_outputs, stages_to_run, self._assemble_care_plan, cancel_token)
 
     def _extract_reasoning_from_think_tags(self, response_text: str) -> str:
-        pattern = r'<think>(.*?)</think>'
-        matches = re.findall(pattern, response_text, re.DOTALL)
-        return '\n\n'.join(matches) if matches else ""
+        return StageResponseParser.parse(response_text).reasoning
     
     def _extract_json_from_response(self, response_text: str) -> Dict[str, Any]:
-        json_obj = None
-        # Remove the <think> block before trying to parse JSON
-        cleaned_response_text = re.sub(r'<think>.*?</think>', '', response_text, flags=re.DOTALL).strip()
-        
-        start_index = cleaned_response_text.find('{')
-        if start_index != -1:
-            brace_level = 0
-            for i, char in enumerate(cleaned_response_text[start_index:]):
-                if char == '{': brace_level += 1
-                elif char == '}': brace_level -= 1
-                if brace_level == 0:
-                    potential_json_str = cleaned_response_text[start_index : start_index + i + 1]
-                    try:
-                        json_obj = json.loads(potential_json_str)
-                        break 
-                    except json.JSONDecodeError:
-                        logger.warning(f"Found a '{{...}}' block but it wasn't valid JSON: {potential_json_str[:100]}...")
-                        # Continue searching if this block is invalid, in case of malformed prefix
-                        start_index = cleaned_response_text.find('{', start_index + i + 1)
-                        if start_index == -1: break # No more opening braces
-                        brace_level = 0 # Reset for next potential JSON object
-                        continue # Restart search from new start_index
+        json_obj = StageResponseParser.parse(response_text).json_output
         if not json_obj:
-            logger.warning(f"Could not find or parse a valid JSON object in the cleaned response text. Cleaned text: {cleaned_response_text[:500]}")
-            return {}
+            logger.warning(f"Could not find or parse a valid JSON object in the response text: {response_text[:500]}")
         return json_obj
 
+PerplexityClient._compile_stage_schemas()
+
+_client_lock = threading.Lock()
+
 def get_perplexity_client() -> PerplexityClient:
     if not hasattr(get_perplexity_client, 'instance'):
-        get_perplexity_client.instance = PerplexityClient()
+        with _client_lock:
+            if not hasattr(get_perplexity_client, 'instance'):
+                get_perplexity_client.instance = PerplexityClient()
     return get_perplexity_client.instance
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Rate Limiter Module
+------------------
+Admission control for the upstream Sonar calls made by Perplexity clients. Calls wait for a
+concurrency slot and for request and token budgets instead of being sent all at once, and
+the concurrency limit adapts to the 429/5xx answers the API gives back (AIMD: halved on
+overload, raised by one per window of successful calls).
+"""
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Iterator, AsyncIterator, Optional
+from cancellation import CancellationToken, check_cancelled, on_cancel, asleep
+
+logger = logging.getLogger(__name__)
+
+# Shared upstream limits of a process (0 disables a per-minute budget)
+PERPLEXITY_MAX_CONCURRENT_REQUESTS = int(os.environ.get('PERPLEXITY_MAX_CONCURRENT_REQUESTS', 16))
+PERPLEXITY_REQUESTS_PER_MINUTE = float(os.environ.get('PERPLEXITY_REQUESTS_PER_MINUTE', 0))
+PERPLEXITY_TOKENS_PER_MINUTE = float(os.environ.get('PERPLEXITY_TOKENS_PER_MINUTE', 0))
+PERPLEXITY_ADAPTIVE_CONCURRENCY = os.environ.get('PERPLEXITY_ADAPTIVE_CONCURRENCY', '1') not in ('0', 'false', 'False')
+
+# Answers meaning the API is overloaded or rate limiting us; calls getting them are retried
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+# Pause of new calls after an overload answer without Retry-After
+OVERLOAD_PAUSE_SECONDS = 1.0
+# Concurrent answers to one burst only halve the limit once
+DECREASE_COOLDOWN_SECONDS = 1.0
+# How often coroutines waiting for a slot look again
+ASYNC_POLL_SECONDS = 0.05
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait given a Retry-After header (delay seconds or an HTTP date), None if absent or invalid."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """
+    Budget refilled continuously at rate_per_minute, holding at most burst_seconds worth of it.
+    A reservation is granted once the bucket holds the amount (or is full, for amounts larger than it)
+    and may overdraw it, so later reservations wait for the debt to be repaid.
+    """
+
+    def __init__(self, rate_per_minute: float, burst_seconds: float = 1.0):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self._balance = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Takes amount from the bucket and returns how many seconds the caller must wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._balance = min(self.capacity, self._balance + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            wait = max(0.0, min(amount, self.capacity) - self._balance) / self.rate
+            self._balance -= amount
+        return wait
+
+class UpstreamLimiter:
+    """
+    Allows at most limit upstream calls in flight, where limit starts at max_concurrent and, with adaptive
+    on, moves between min_concurrent and max_concurrent as record_response() reports answers. Calls also
+    reserve from the requests_per_minute and tokens_per_minute buckets (0 means no budget). Safe to share
+    between threads, coroutines and clients.
+
+    With a parent, this is a sub-limit of it: a call takes a slot here and then one from the parent, and
+    every answer is reported to the parent too, so an overload seen by either backs off both.
+    """
+
+    def __init__(self, max_concurrent: int, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 adaptive: bool = False, min_concurrent: int = 1, parent: Optional["UpstreamLimiter"] = None):
+        self.max_concurrent = max(1, max_concurrent)
+        self.min_concurrent = max(1, min(min_concurrent, self.max_concurrent))
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.adaptive = adaptive
+        self.parent = parent
+        self._request_bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self._token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self._limit = float(self.max_concurrent)
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        """Current concurrency limit."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _try_enter(self) -> Optional[float]:
+        """
+        Takes a slot if one is free and new calls are not paused; returns None then. Otherwise returns the
+        seconds until the pause ends, or 0 if the caller must wait for a slot to be released.
+        """
+        # Caller holds the lock
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._in_flight >= int(self._limit):
+            return 0.0
+        self._in_flight += 1
+        return None
+
+    def _leave(self) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _budget_wait(self, tokens: int) -> float:
+        wait = 0.0
+        if self._request_bucket is not None:
+            wait = self._request_bucket.reserve(1)
+        if self._token_bucket is not None and tokens > 0:
+            wait = max(wait, self._token_bucket.reserve(tokens))
+        return wait
+
+    def _wake_waiters(self) -> None:
+        with self._condition:
+            self._condition.notify_all()
+
+    @contextmanager
+    def acquire(self, tokens: int = 0, cancel_token: Optional[CancellationToken] = None) -> Iterator[None]:
+        """
+        Blocks until a call estimated at tokens tokens may start and holds its slot until the block exits.
+        Raises GenerationCancelled if cancel_token is cancelled while waiting.
+        """
+        with on_cancel(cancel_token, self._wake_waiters), self._condition:
+            check_cancelled(cancel_token)
+            wait = self._try_enter()
+            while wait is not None:
+                self._condition.wait(wait or None)
+                check_cancelled(cancel_token)
+                wait = self._try_enter()
+        try:
+            budget_wait = self._budget_wait(tokens)
+            if budget_wait > 0:
+                if cancel_token is not None:
+                    cancel_token.sleep(budget_wait)
+                else:
+                    time.sleep(budget_wait)
+            if self.parent is None:
+                yield
+            else:
+                with self.parent.acquire(tokens, cancel_token):
+                    yield
+        finally:
+            self._leave()
+
+    @asynccontextmanager
+    async def aacquire(self, tokens: int = 0, cancel_token: Optional[CancellationToken] = None) -> AsyncIterator[None]:
+        """Async counterpart of acquire(); waits without blocking the event loop."""
+        while True:
+            with self._condition:
+                wait = self._try_enter()
+            if wait is None:
+                break
+            await asleep(cancel_token, wait or ASYNC_POLL_SECONDS)
+        try:
+            budget_wait = self._budget_wait(tokens)
+            if budget_wait > 0:
+                await asleep(cancel_token, budget_wait)
+            if self.parent is None:
+                yield
+            else:
+                async with self.parent.aacquire(tokens, cancel_token):
+                    yield
+        finally:
+            self._leave()
+
+    def record_response(self, status_code: int, retry_after: Optional[float] = None) -> None:
+        """
+        Adapts to the status of an upstream answer. Overload answers halve the limit and pause new calls
+        for retry_after seconds (or OVERLOAD_PAUSE_SECONDS); successful ones raise it by 1/limit.
+        """
+        if self.parent is not None:
+            self.parent.record_response(status_code, retry_after)
+        with self._condition:
+            now = time.monotonic()
+            if status_code in RETRYABLE_STATUS_CODES:
+                pause = retry_after if retry_after is not None else OVERLOAD_PAUSE_SECONDS
+                self._paused_until = max(self._paused_until, now + pause)
+                if self.adaptive and now - self._last_decrease >= DECREASE_COOLDOWN_SECONDS:
+                    self._limit = max(float(self.min_concurrent), self._limit / 2)
+                    self._last_decrease = now
+                    logger.warning(f"Upstream answered {status_code}, concurrency limit lowered to {self.limit}, pausing {pause:.1f}s")
+            elif status_code < 400 and self.adaptive and self._limit < self.max_concurrent:
+                self._limit = min(float(self.max_concurrent), self._limit + 1 / self._limit)
+                self._condition.notify_all()
+
+_default_limiter_lock = threading.Lock()
+
+def get_default_upstream_limiter() -> Optional[UpstreamLimiter]:
+    """
+    Returns the limiter configured by the PERPLEXITY_* limit variables, shared by every client of the process
+    so all stages and requests draw from one budget; None if PERPLEXITY_MAX_CONCURRENT_REQUESTS is 0.
+    """
+    if PERPLEXITY_MAX_CONCURRENT_REQUESTS <= 0:
+        return None
+    if not hasattr(get_default_upstream_limiter, 'instance'):
+        with _default_limiter_lock:
+            if not hasattr(get_default_upstream_limiter, 'instance'):
+                get_default_upstream_limiter.instance = UpstreamLimiter(
+                    PERPLEXITY_MAX_CONCURRENT_REQUESTS, PERPLEXITY_REQUESTS_PER_MINUTE,
+                    PERPLEXITY_TOKENS_PER_MINUTE, PERPLEXITY_ADAPTIVE_CONCURRENCY
+                )
+    return get_default_upstream_limiter.instance
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Reasoning Formatter Module
+-------------------------
+Turns a stage's <think> reasoning into the Markdown sent in stage_reasoning_complete events:
+section headings, bold clinical keywords, italic citations, normalised list markers and
+paragraphs joined onto one line. All patterns are compiled once; headings, inline markup and
+list markers each take a single pass over the text. ReasoningMarkdownStream applies the same
+formatting to reasoning as it streams, a paragraph at a time.
+"""
+
+import re
+from typing import List, Match
+
+KEYWORDS_TO_BOLD = [
+    'ADPIE', 'NANDA', 'CHF', 'Congestive Heart Failure', 'Hypertension', 'Diabetes',
+    'Assessment', 'Diagnosis', 'Planning', 'Implementation', 'Evaluation',
+    'Goal', 'Outcome', 'Intervention', 'Rationale', 'Evidence', 'Risk for', 'Related to', 'As evidenced by'
+]
+
+def _alternation(words: List[str]) -> str:
+    # Longest first, so no keyword is cut short by one of its prefixes
+    return "|".join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+_KEYWORDS = _alternation(KEYWORDS_TO_BOLD)
+_SINGLE_WORD_KEYWORDS = _alternation([keyword for keyword in KEYWORDS_TO_BOLD if " " not in keyword])
+
+# Whole-line section headings: "Assessment:" -> "## Assessment:", "Step 2:" -> "### Step 2:", "Rationale:" -> "#### Rationale:"
+_HEADING_PATTERN = re.compile(
+    r'^(?:(?P<section>(?:Assessment|Diagnosis|Planning|Implementation|Evaluation|Conclusion|Summary):$)'
+    r'|(?P<step>Step\s*\d+):'
+    r'|(?P<detail>(?:Rationale|Evidence|Considerations):$))',
+    re.MULTILINE
+)
+
+# Citations like [1], [S2] or [web] in italics and keywords in bold, in one pass. A bracket holding
+# nothing but a keyword gets the keyword bolded rather than the bracket italicised.
+_INLINE_PATTERN = re.compile(
+    r'(?P<citation>\[\s*(?:S\d+|\d+|(?!(?i:' + _SINGLE_WORD_KEYWORDS + r')\s*\])[A-Za-z]+)\s*\])'
+    r'|\b(?P<keyword>(?i:' + _KEYWORDS + r'))\b'
+)
+
+# List markers and quotes at the start of a line, with the blank lines and indentation before them removed
+_LIST_MARKER_PATTERN = re.compile(r'^\s*(?:(?P<bullet>[-*])\s+|(?P<number>\d+\.)\s+|(?P<quote>>)\s*)(?P<rest>.*)', re.MULTILINE)
+_BULLET_PATTERNS = [
+    (re.compile(r'^\s*-\s+(.*)', re.MULTILINE), r'* \1'),
+    (re.compile(r'^\s*\*\s+(.*)', re.MULTILINE), r'* \1'),
+    (re.compile(r'^\s*(\d+\.)\s+(.*)', re.MULTILINE), r'\1 \2'),
+    (re.compile(r'^\s*>\s*(.*)', re.MULTILINE), r'> \1'),
+]
+# A marker alone on its line takes the next line as its text. When that line has a marker of its
+# own, the result depends on the order markers are rewritten in, so such text keeps the one-rule-
+# per-pass order of _BULLET_PATTERNS.
+_LONE_MARKER_PATTERN = re.compile(r'^\s*(?:[-*>]|\d+\.)[^\S\n]*$', re.MULTILINE)
+
+_NUMBERED_BLOCK_PATTERN = re.compile(r'\d+\.\s')
+
+# Paragraph boundaries at which streamed reasoning can be formatted up to: an even run of newlines
+# (so split('\n\n') pairs them the same way as in the full text) followed by text no rule joins
+# back onto the previous paragraph, i.e. not a list marker, quote or step number
+_STREAM_BOUNDARY_PATTERN = re.compile(r'(?<!\n)(?:\n\n)+(?=[^\s\-*>\d])')
+_OPEN_CITATION_PATTERN = re.compile(r'\[\s*(?:S\d+|\d+|[A-Za-z]+)?\s*\Z')
+_LONE_MARKER_LINE_PATTERN = re.compile(r'(?:[-*>]|\d+\.)')
+
+def _replace_heading(match: Match) -> str:
+    if match.group('section'):
+        return "## " + match.group('section')
+    if match.group('step'):
+        return "### " + match.group('step') + ":"
+    return "#### " + match.group('detail')
+
+def _replace_inline(match: Match) -> str:
+    if match.group('citation'):
+        return "*" + match.group('citation') + "*"
+    return "**" + match.group('keyword') + "**"
+
+def _replace_list_marker(match: Match) -> str:
+    if match.group('bullet'):
+        return "* " + match.group('rest')
+    if match.group('number'):
+        return match.group('number') + " " + match.group('rest')
+    return "> " + match.group('rest')
+
+def _markdown_blocks(reasoning_text: str) -> List[str]:
+    """The formatted paragraphs of reasoning_text, before they are joined with blank lines."""
+    markdown = reasoning_text.replace('\r\n', '\n')
+    markdown = _HEADING_PATTERN.sub(_replace_heading, markdown)
+    markdown = _INLINE_PATTERN.sub(_replace_inline, markdown)
+    if _LONE_MARKER_PATTERN.search(markdown):
+        for pattern, replacement in _BULLET_PATTERNS:
+            markdown = pattern.sub(replacement, markdown)
+    else:
+        markdown = _LIST_MARKER_PATTERN.sub(_replace_list_marker, markdown)
+
+    blocks = []
+    for block in markdown.split('\n\n'):
+        if not (block.startswith(('* ', '#', '>')) or _NUMBERED_BLOCK_PATTERN.match(block)):
+            block = block.replace('\n', ' ')
+        blocks.append(block.strip())
+    return blocks
+
+def format_reasoning_markdown(reasoning_text: str) -> str:
+    """Formats a complete reasoning text as Markdown."""
+    if not reasoning_text:
+        return ""
+    return '\n\n'.join(_markdown_blocks(reasoning_text)).strip()
+
+class ReasoningMarkdownStream:
+    """
+    Formats reasoning incrementally. feed() takes each reasoning delta and returns the Markdown of the
+    paragraphs completed so far (often ""), close() returns the rest; concatenated, the pieces equal
+    format_reasoning_markdown() of the whole text. Text is held back until a paragraph boundary that no
+    formatting rule reaches across, so a single paragraph is only formatted once.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._scan_from = 0
+        self._emitted = False
+        self._skipped_blank_blocks = 0
+
+    def feed(self, text: str) -> str:
+        if not text:
+            return ""
+        if self._buffer.endswith('\r') and text.startswith('\n'):
+            self._buffer = self._buffer[:-1]
+        self._buffer += text.replace('\r\n', '\n')
+
+        boundary_end = None
+        for match in _STREAM_BOUNDARY_PATTERN.finditer(self._buffer, self._scan_from):
+            segment_end = match.end() - 2
+            if not self._can_split_after(self._buffer[:segment_end]):
+                continue
+            boundary_end = match.end()
+        markdown = ""
+        if boundary_end is not None:
+            markdown = self._emit(_markdown_blocks(self._buffer[:boundary_end - 2]))
+            self._buffer = self._buffer[boundary_end:]
+        # A boundary is only known once the character after it arrived, so the next scan starts at the last non-blank one
+        self._scan_from = max(0, len(self._buffer.rstrip()) - 1)
+        return markdown
+
+    def close(self) -> str:
+        """Formats whatever reasoning is still held back."""
+        segment, self._buffer = self._buffer, ""
+        return self._emit(_markdown_blocks(segment)) if segment else ""
+
+    def _can_split_after(self, segment: str) -> bool:
+        # Citations and list markers with nothing after them on their line take in the next paragraph
+        last_line = segment.rstrip().rsplit('\n', 1)[-1].strip()
+        if _LONE_MARKER_LINE_PATTERN.fullmatch(last_line):
+            return False
+        return not _OPEN_CITATION_PATTERN.search(segment, max(0, segment.rfind('[')))
+
+    def _emit(self, blocks: List[str]) -> str:
+        pieces = []
+        for block in blocks:
+            if not block:
+                # Blank blocks only count between paragraphs; leading and trailing ones are stripped
+                if self._emitted:
+                    self._skipped_blank_blocks += 1
+                continue
+            if self._emitted:
+                pieces.append('\n\n' * (self._skipped_blank_blocks + 1))
+            pieces.append(block)
+            self._emitted = True
+            self._skipped_blank_blocks = 0
+        return "".join(pieces)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Response Cache Module
+--------------------
+Content-addressed cache of raw stage responses for the Perplexity client. Entries are keyed
+by a hash of everything that determines a stage's output (model, prompts and sub-schema) and
+live in an in-memory LRU tier, optionally backed by a SQLite file shared between workers.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Cache configuration
+PERPLEXITY_CACHE_ENABLED = os.environ.get('PERPLEXITY_CACHE_ENABLED', '0') not in ('0', 'false', 'False')
+PERPLEXITY_CACHE_TTL = float(os.environ.get('PERPLEXITY_CACHE_TTL', 24 * 60 * 60))
+PERPLEXITY_CACHE_MEMORY_ENTRIES = int(os.environ.get('PERPLEXITY_CACHE_MEMORY_ENTRIES', 256))
+PERPLEXITY_CACHE_SQLITE_PATH = os.environ.get('PERPLEXITY_CACHE_SQLITE_PATH', '')
+PERPLEXITY_CACHE_MAX_DISK_MB = float(os.environ.get('PERPLEXITY_CACHE_MAX_DISK_MB', 256))
+
+class ResponseCache:
+    """
+    Two-tier cache of raw upstream response texts (reasoning and JSON as streamed).
+    Memory entries are evicted least-recently-used beyond max_memory_entries; disk entries are
+    evicted least-recently-used once their total size exceeds max_disk_bytes. Both tiers expire
+    entries ttl_seconds after they were stored. Safe to use from multiple threads.
+    """
+
+    def __init__(self, ttl_seconds: float = PERPLEXITY_CACHE_TTL,
+                 max_memory_entries: int = PERPLEXITY_CACHE_MEMORY_ENTRIES,
+                 sqlite_path: Optional[str] = PERPLEXITY_CACHE_SQLITE_PATH or None,
+                 max_disk_bytes: int = int(PERPLEXITY_CACHE_MAX_DISK_MB * 1024 * 1024)):
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_entries = max_memory_entries
+        self.sqlite_path = sqlite_path
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: OrderedDict = OrderedDict() # key -> (created_at, response_text)
+        self._lock = threading.Lock()
+        if self.sqlite_path:
+            with self._connect() as connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS response_cache ("
+                    "key TEXT PRIMARY KEY, response_text TEXT NOT NULL, size INTEGER NOT NULL, "
+                    "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                connection.execute("CREATE INDEX IF NOT EXISTS response_cache_accessed_at ON response_cache (accessed_at)")
+
+    @staticmethod
+    def make_key(payload: Dict[str, Any]) -> str:
+        """Stable hash of the model, system prompt, user prompt and response schema of a chat payload."""
+        messages = {message["role"]: message["content"] for message in payload.get("messages", [])}
+        key_material = {
+            "model": payload.get("model"),
+            "system": messages.get("system"),
+            "user": messages.get("user"),
+            "schema": payload.get("response_format", {}).get("json_schema", {}).get("schema"),
+        }
+        serialized = json.dumps(key_material, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per operation keeps the cache usable from any thread or process
+        connection = sqlite3.connect(self.sqlite_path, timeout=5)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, response_text = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    return response_text
+                del self._memory[key]
+
+        if not self.sqlite_path:
+            return None
+        try:
+            with self._connect() as connection:
+                row = connection.execute(
+                    "SELECT response_text, created_at FROM response_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                response_text, created_at = row
+                if now - created_at > self.ttl_seconds:
+                    connection.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                    return None
+                connection.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache read failed: {str(e)}")
+            return None
+
+        self._remember(key, created_at, response_text)
+        return response_text
+
+    def set(self, key: str, response_text: str) -> None:
+        now = time.time()
+        self._remember(key, now, response_text)
+        if not self.sqlite_path:
+            return
+        size = len(response_text.encode('utf-8'))
+        try:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, response_text, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, response_text, size, now, now)
+                )
+                self._evict_disk(connection, now)
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache write failed: {str(e)}")
+
+    def _remember(self, key: str, created_at: float, response_text: str) -> None:
+        with self._lock:
+            self._memory[key] = (created_at, response_text)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def _evict_disk(self, connection: sqlite3.Connection, now: float) -> None:
+        connection.execute("DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+        if total_size <= self.max_disk_bytes:
+            return
+        evicted = 0
+        for key, size in connection.execute("SELECT key, size FROM response_cache ORDER BY accessed_at").fetchall():
+            if total_size <= self.max_disk_bytes:
+                break
+            connection.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            total_size -= size
+            evicted += 1
+        logger.info(f"Evicted {evicted} entries from the on-disk response cache")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        if self.sqlite_path:
+            with self._connect() as connection:
+                connection.execute("DELETE FROM response_cache")
+
+_default_cache_lock = threading.Lock()
+
+def get_default_response_cache() -> Optional[ResponseCache]:
+    """
+    Returns the cache configured by the PERPLEXITY_CACHE_* environment variables, shared by every client of
+    the process so they share its memory tier too; None if disabled.
+    """
+    if not PERPLEXITY_CACHE_ENABLED:
+        return None
+    if not hasattr(get_default_response_cache, 'instance'):
+        with _default_cache_lock:
+            if not hasattr(get_default_response_cache, 'instance'):
+                get_default_response_cache.instance = ResponseCache()
+    return get_default_response_cache.instance
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Schema Repair Module
+-------------------
+Plans the repair of one stage's output: the paths its validator finds missing or invalid are
+split into repair requests, and the values the answers hold are merged into a repaired copy of
+the output. The planner makes no upstream calls itself, so the sync and async clients share it
+and only stream the requests.
+"""
+
+import logging
+from typing import Dict, List, Any, Callable, Iterator, NamedTuple, Optional
+
+from merge_engine import MergeEngine, CarePlanBuilder
+from schema_validator import StageSchemaValidator, Path, json_pointer
+from stream_parser import StageResponseParser
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class RepairRequest(NamedTuple):
+    repair_index: int
+    paths: List[Path]
+    payload: Dict[str, Any]
+
+    @property
+    def event_fields(self) -> Dict[str, Any]:
+        """Fields tagging the events streamed by the request."""
+        return {"repair_index": self.repair_index}
+
+    def start_event(self, stage_name: str) -> Dict[str, Any]:
+        return {"type": "stage_repair_start", "stage_name": stage_name, "repair_index": self.repair_index,
+                "paths": [json_pointer(path) for path in self.paths]}
+
+class StageRepair:
+    """
+    The repair of stage_json_output. requests() yields one RepairRequest per batch of at most max_paths gaps,
+    at most max_requests of them, with its payload built by build_payload(paths). Each answer is passed to
+    apply(), and finish() returns the repaired output. The output itself is never modified.
+    """
+
+    def __init__(self, stage_name: str, stage_json_output: Dict[str, Any], validator: StageSchemaValidator,
+                 merge_engine: MergeEngine, build_payload: Callable[[List[Path]], Dict[str, Any]],
+                 max_paths: int, max_requests: int):
+        self.stage_name = stage_name
+        self.stage_json_output = stage_json_output
+        self.validator = validator
+        self.merge_engine = merge_engine
+        self.build_payload = build_payload
+        self.gaps = validator.find_gaps(stage_json_output)
+        self.batches = [self.gaps[start:start + max_paths] for start in range(0, len(self.gaps), max_paths)]
+        if self.gaps:
+            metrics.SCHEMA_GAPS.inc(len(self.gaps), stage=stage_name)
+            logger.info(f"{stage_name} left {len(self.gaps)} schema gaps: {[json_pointer(path) for path in self.gaps]}")
+        if len(self.batches) > max_requests:
+            logger.warning(f"{stage_name} left {len(self.gaps)} schema gaps, only the first {max_requests * max_paths} are repaired")
+            self.batches = self.batches[:max_requests]
+        self._builder: Optional[CarePlanBuilder] = None
+
+    def requests(self) -> Iterator[RepairRequest]:
+        for repair_index, paths in enumerate(self.batches):
+            yield RepairRequest(repair_index, paths, self.build_payload(paths))
+
+    def apply(self, request: RepairRequest, stage_response: Optional[StageResponseParser]) -> Dict[str, Any]:
+        """Merges the values a repair answer (None if the call failed) holds; returns the stage_repair_complete event."""
+        if self._builder is None:
+            # Merging rebuilds the objects and arrays it passes through, so the output is left untouched
+            self._builder = self.merge_engine.new_care_plan()
+            self._builder.merge(self.stage_name, self.stage_json_output)
+        repair_output = stage_response.json_output if stage_response is not None else None
+        repaired = []
+        for path in request.paths:
+            value = repair_output.get(json_pointer(path)) if isinstance(repair_output, dict) else None
+            if value is not None:
+                self._builder.merge_partial(self.stage_name, path, value)
+                repaired.append(path)
+        metrics.SCHEMA_REPAIRED_PATHS.inc(len(repaired), stage=self.stage_name)
+        return {"type": "stage_repair_complete", "stage_name": self.stage_name, "repair_index": request.repair_index,
+                "paths": [json_pointer(path) for path in repaired]}
+
+    def finish(self) -> Dict[str, Any]:
+        """The stage output with every repaired value merged in."""
+        if self._builder is None:
+            return self.stage_json_output
+        remaining_gaps = self.validator.find_gaps(self._builder.care_plan)
+        if remaining_gaps:
+            logger.warning(f"{self.stage_name} still has {len(remaining_gaps)} schema gaps after repair: {[json_pointer(path) for path in remaining_gaps]}")
+        return self._builder.care_plan
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Schema Validator Module
+----------------------
+Checks the part of a care plan one stage is responsible for against ADPIE_SCHEMA and reports
+the paths it left missing or invalid, e.g. ("nursingDiagnoses", 1, "goals", 2, "evaluation").
+Each stage's checks are compiled once into nested closures, so validating a plan is a single
+walk over the stage's properties with no schema lookups. Properties that another stage generates
+(e.g. the interventions inside the goals of stage 2) are left to that stage's validator.
+"""
+
+from typing import Dict, List, Any, Callable, Optional, Sequence, Tuple, Union
+
+PathStep = Union[str, int]
+Path = Tuple[PathStep, ...]
+# Appends the paths of the gaps found in value (found at path) to gaps
+_Check = Callable[[Any, Path, List[Path]], None]
+
+_JSON_TYPES = {
+    "string": (str,), "number": (int, float), "integer": (int,), "boolean": (bool,),
+    "array": (list,), "object": (dict,), "null": (type(None),),
+}
+
+def json_pointer(path: Sequence[PathStep]) -> str:
+    """The RFC 6901 JSON Pointer of a path, e.g. "/nursingDiagnoses/1/goals/2/evaluation"."""
+    return "".join("/" + str(step).replace('~', '~0').replace('/', '~1') for step in path)
+
+def parse_json_pointer(pointer: str) -> Path:
+    """The path of a JSON Pointer; tokens made of digits are array indices (no schema property is)."""
+    steps: List[PathStep] = []
+    for token in pointer.split('/')[1:]:
+        token = token.replace('~1', '/').replace('~0', '~')
+        steps.append(int(token) if token.isdigit() else token)
+    return tuple(steps)
+
+def _path_trie(paths: List[str]) -> Dict[str, Any]:
+    """Dotted paths as nested dicts, True marking where a path ends (anything below it is covered by it)."""
+    trie: Dict[str, Any] = {}
+    for path in paths:
+        node = trie
+        steps = path.split('.')
+        for step in steps[:-1]:
+            child = node.setdefault(step, {})
+            if child is True:
+                break
+            node = child
+        else:
+            node[steps[-1]] = True
+    return trie
+
+def _subtrie(trie: Any, step: str) -> Any:
+    return trie.get(step, {}) if isinstance(trie, dict) else {}
+
+def _child_schema(schema_node: Dict[str, Any], step: str) -> Dict[str, Any]:
+    if step == "*":
+        return schema_node.get("items", {})
+    return schema_node.get("properties", {}).get(step, {})
+
+def _compile_type_check(schema_node: Dict[str, Any]) -> Optional[Callable[[Any], bool]]:
+    type_names = schema_node.get("type")
+    if type_names is None:
+        return None
+    if isinstance(type_names, str):
+        type_names = [type_names]
+    python_types = tuple(python_type for type_name in type_names for python_type in _JSON_TYPES.get(type_name, ()))
+    allows_boolean = "boolean" in type_names
+    # bool is a subclass of int, but true and false are not JSON numbers
+    return lambda value: isinstance(value, python_types) and (allows_boolean or not isinstance(value, bool))
+
+def _compile_value(schema_node: Dict[str, Any], excluded: Any) -> _Check:
+    """Checks a whole value: its type, enum, required properties and, recursively, its properties and items."""
+    type_check = _compile_type_check(schema_node)
+    enum = schema_node.get("enum")
+    properties = {
+        key: _compile_value(child_schema, _subtrie(excluded, key))
+        for key, child_schema in schema_node.get("properties", {}).items() if _subtrie(excluded, key) is not True
+    }
+    required = [key for key in schema_node.get("required", []) if _subtrie(excluded, key) is not True]
+    items = schema_node.get("items")
+    items_check = _compile_value(items, _subtrie(excluded, "*")) if isinstance(items, dict) else None
+
+    def check(value: Any, path: Path, gaps: List[Path]) -> None:
+        if (type_check is not None and not type_check(value)) or (enum is not None and value not in enum):
+            gaps.append(path)
+            return
+        if isinstance(value, dict):
+            for key in required:
+                if key not in value:
+                    gaps.append(path + (key,))
+            for key, property_check in properties.items():
+                if key in value:
+                    property_check(value[key], path + (key,), gaps)
+        elif isinstance(value, list) and items_check is not None:
+            for index, element in enumerate(value):
+                items_check(element, path + (index,), gaps)
+    return check
+
+def _compile_targets(schema_node: Dict[str, Any], targets: Dict[str, Any], excluded: Any, required: List[str]) -> _Check:
+    """Follows the target paths through a value, checking only that the steps along them exist where required."""
+    type_check = _compile_type_check(schema_node)
+    children = {}
+    for step, subtargets in targets.items():
+        child_schema = _child_schema(schema_node, step)
+        if subtargets is True:
+            children[step] = _compile_value(child_schema, _subtrie(excluded, step))
+        else:
+            children[step] = _compile_targets(child_schema, subtargets, _subtrie(excluded, step), child_schema.get("required", []))
+
+    def check(value: Any, path: Path, gaps: List[Path]) -> None:
+        if type_check is not None and not type_check(value):
+            gaps.append(path)
+            return
+        for step, child_check in children.items():
+            if step == "*":
+                if isinstance(value, list):
+                    for index, element in enumerate(value):
+                        child_check(element, path + (index,), gaps)
+            elif isinstance(value, dict):
+                if step in value:
+                    child_check(value[step], path + (step,), gaps)
+                elif step in required:
+                    gaps.append(path + (step,))
+    return check
+
+def _prune(schema_node: Dict[str, Any], excluded: Any) -> Dict[str, Any]:
+    """schema_node without the excluded properties (which are dropped from required too)."""
+    if not isinstance(excluded, dict) or not excluded:
+        return schema_node
+    pruned = dict(schema_node)
+    if isinstance(schema_node.get("properties"), dict):
+        pruned["properties"] = {
+            key: _prune(child_schema, _subtrie(excluded, key))
+            for key, child_schema in schema_node["properties"].items() if _subtrie(excluded, key) is not True
+        }
+        if "required" in schema_node:
+            pruned["required"] = [key for key in schema_node["required"] if key in pruned["properties"]]
+    if isinstance(schema_node.get("items"), dict):
+        pruned["items"] = _prune(schema_node["items"], _subtrie(excluded, "*"))
+    return pruned
+
+class StageSchemaValidator:
+    """
+    The checks of one stage: the values at its target paths (dotted, '*' for every array element) are
+    validated in full except for the excluded paths, and the steps leading to them only need to exist
+    where the schema requires them; at the top level, the stage's own required properties are used.
+    response_schema is the schema the stage asks the model to answer with, from which repair requests
+    take the schema of each gap.
+    """
+
+    def __init__(self, schema: Dict[str, Any], response_schema: Dict[str, Any], targets: List[str],
+                 required: List[str], excluded: List[str]):
+        self.response_schema = response_schema
+        self._excluded = _path_trie(excluded)
+        top_level_required = sorted({path.split('.')[0] for path in required})
+        self._check = _compile_targets(schema, _path_trie(targets), self._excluded, top_level_required)
+
+    def find_gaps(self, care_plan: Dict[str, Any]) -> List[Path]:
+        """The paths of care_plan the stage left missing or invalid, in document order."""
+        gaps: List[Path] = []
+        self._check(care_plan, (), gaps)
+        return gaps
+
+    def gap_schema(self, path: Path) -> Dict[str, Any]:
+        """The schema of the value the stage should have generated at path."""
+        schema_node, excluded = self.response_schema, self._excluded
+        for step in path:
+            step = "*" if isinstance(step, int) else step
+            schema_node, excluded = _child_schema(schema_node, step), _subtrie(excluded, step)
+        return _prune(schema_node, excluded)
+
+    def repair_schema(self, paths: List[Path]) -> Dict[str, Any]:
+        """Schema of a repair answer: an object with the value of each path under the path's JSON Pointer."""
+        pointers = [json_pointer(path) for path in paths]
+        return {
+            "type": "object",
+            "properties": {pointer: self.gap_schema(path) for pointer, path in zip(pointers, paths)},
+            "required": pointers
+        }
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Serialization Module
+-------------------
+JSON encoding and decoding for the hot paths of the backend: SSE event payloads, stage prompts,
+upstream request bodies and the deltas of upstream streams. orjson is used when it is installed
+(and CARE_PLAN_FAST_JSON is not turned off), the standard library otherwise. Both produce the same
+JSON values; only insignificant formatting differs (e.g. orjson writes non-ASCII text unescaped).
+"""
+
+import os
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - the standard library is used instead
+    orjson = None
+
+CARE_PLAN_FAST_JSON = os.environ.get('CARE_PLAN_FAST_JSON', '1') not in ('0', 'false', 'False')
+
+_orjson = orjson if CARE_PLAN_FAST_JSON else None
+JSON_BACKEND = "orjson" if _orjson is not None else "json"
+
+# Raised by loads() for invalid JSON; orjson's error is a subclass of it
+JSONDecodeError = json.JSONDecodeError
+
+def dumps_bytes(value: Any) -> bytes:
+    """value as compact UTF-8 JSON."""
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(value, option=_orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass # e.g. integers beyond 64 bits, which the standard library still handles
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def dumps(value: Any, indent: bool = False) -> str:
+    """value as JSON text, compact or indented by two spaces."""
+    if not indent:
+        return dumps_bytes(value).decode('utf-8')
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(value, option=_orjson.OPT_NON_STR_KEYS | _orjson.OPT_INDENT_2).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(value, indent=2)
+
+def loads(data: Union[str, bytes]) -> Any:
+    """Parses JSON text or UTF-8 bytes; raises JSONDecodeError if it is not valid JSON."""
+    if _orjson is not None:
+        return _orjson.loads(data)
+    return json.loads(data)
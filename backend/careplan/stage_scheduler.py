@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Stage Scheduler Module
+---------------------
+Plans the concurrent work of a generation: which stages may start once others have finished,
+and which upstream calls a fan-out stage runs side by side. Like the schema repair planner, the
+work items make no upstream calls themselves, so the sync and async clients share them and only
+run the streams, in threads or in tasks.
+"""
+
+import logging
+from typing import Dict, List, Any, Callable, NamedTuple, Optional, Set, Tuple
+
+from stream_parser import StageResponseParser
+from cancellation import CancellationToken, is_cancelled
+
+logger = logging.getLogger(__name__)
+
+# Outcome of a stage, as reported to on_stage_finished callbacks
+STAGE_STATUS_COMPLETED = "completed"
+STAGE_STATUS_FAILED = "failed" # The upstream call failed or returned no usable JSON
+
+class CompletionCall(NamedTuple):
+    """One streamed upstream call, whose events are tagged with event_fields."""
+    payload: Dict[str, Any]
+    stage_name: str
+    event_fields: Dict[str, Any]
+
+class StageJob(NamedTuple):
+    """A stage to run, with the merged output of the stages it depends on as its context."""
+    stage_idx: int
+    stage_config: Dict[str, Any]
+    current_care_plan: Dict[str, Any]
+
+class CallBatch:
+    """
+    Upstream calls that run concurrently, at most max_concurrency at once. start() hands out every call,
+    keyed by its index, and finish() stores its parsed response (None if it failed) in responses.
+    """
+
+    def __init__(self, calls: List[CompletionCall], max_concurrency: int):
+        self.calls = calls
+        self.max_concurrency = max_concurrency
+        self.responses: List[Optional[StageResponseParser]] = [None] * len(calls)
+        self._started = False
+
+    def start(self) -> List[Tuple[int, CompletionCall]]:
+        if self._started:
+            return []
+        self._started = True
+        return list(enumerate(self.calls))
+
+    def finish(self, call_index: int, stage_response: Optional[StageResponseParser]) -> None:
+        self.responses[call_index] = stage_response
+
+    def error_event(self, call_index: int, error: Exception) -> Dict[str, Any]:
+        """Logs a call that raised instead of streaming and returns the error event for it."""
+        call = self.calls[call_index]
+        logger.exception(f"Unexpected error in {call.stage_name} call {call_index}:")
+        return {"type": "error", "stage_name": call.stage_name, "content": str(error), **call.event_fields}
+
+class StageScheduler:
+    """
+    The stages of one generation. start() hands out, keyed by name, every stage whose dependencies have all
+    finished, with their merged output as its context, and finish() records the stage JSON it produced.
+    Stages not in stages_to_run count as finished, with their checkpointed output in stage_outputs (copied,
+    the run adds to it). Once cancel_token is cancelled no further stage is handed out. final_event() is the
+    event ending the generation.
+    """
+
+    def __init__(self, stages_config: List[Dict[str, Any]], dependencies: Dict[str, List[str]], max_concurrency: int,
+                 stage_outputs: Optional[Dict[str, Dict[str, Any]]], stages_to_run: Optional[List[str]],
+                 assemble_care_plan: Callable[[Dict[str, Dict[str, Any]], List[str]], Dict[str, Any]],
+                 cancel_token: Optional[CancellationToken] = None):
+        self.dependencies = dependencies
+        self.max_concurrency = max_concurrency
+        self.stage_outputs = dict(stage_outputs or {})
+        self.assemble_care_plan = assemble_care_plan
+        self.cancel_token = cancel_token
+        self.stage_count = len(stages_config)
+        run_names = {stage_config["name"] for stage_config in stages_config} if stages_to_run is None else set(stages_to_run)
+        self.finished: Set[str] = {stage_config["name"] for stage_config in stages_config if stage_config["name"] not in run_names}
+        self.waiting = [(stage_idx, stage_config) for stage_idx, stage_config in enumerate(stages_config) if stage_config["name"] in run_names]
+
+    def start(self) -> List[Tuple[str, StageJob]]:
+        if is_cancelled(self.cancel_token):
+            # Stages not started yet are dropped; running ones stop at their next streamed line
+            self.waiting = []
+            return []
+        ready = []
+        for stage_idx, stage_config in list(self.waiting):
+            stage_dependencies = self.dependencies[stage_config["name"]]
+            if all(dependency in self.finished for dependency in stage_dependencies):
+                self.waiting.remove((stage_idx, stage_config))
+                ready.append((stage_config["name"], StageJob(stage_idx, stage_config, self.assemble_care_plan(self.stage_outputs, stage_dependencies))))
+        return ready
+
+    def finish(self, stage_name: str, stage_json_output: Optional[Dict[str, Any]]) -> str:
+        """Stores a finished stage's JSON and returns its status. A failed rerun keeps the stage's previous output."""
+        self.finished.add(stage_name)
+        status = STAGE_STATUS_FAILED
+        if stage_json_output:
+            self.stage_outputs[stage_name] = stage_json_output
+            status = STAGE_STATUS_COMPLETED
+        logger.info(f"Finished {stage_name} ({status}, {len(self.finished)}/{self.stage_count} stages)")
+        return status
+
+    def error_event(self, stage_name: str, error: Exception) -> Dict[str, Any]:
+        """Logs a stage that raised instead of streaming and returns the error event for it."""
+        logger.exception(f"Unexpected error running {stage_name}:")
+        return {"type": "error", "stage_name": stage_name, "content": str(error)}
+
+    def final_event(self) -> Dict[str, Any]:
+        """generation_cancelled if cancel_token was cancelled, otherwise full_care_plan_complete with every stage merged."""
+        if is_cancelled(self.cancel_token):
+            logger.info(f"Generation cancelled ({self.cancel_token.reason or 'no reason given'}), remaining stages skipped")
+            return {"type": "generation_cancelled", "content": self.cancel_token.reason or "Generation cancelled"}
+        if self.waiting:
+            # Only reachable with a dependency cycle
+            logger.error(f"Unschedulable stages: {[stage_config['name'] for _, stage_config in self.waiting]}")
+        care_plan = self.assemble_care_plan(self.stage_outputs, list(self.stage_outputs.keys()))
+        logger.info(f"All stages complete. Final care plan generated (keys: {list(care_plan.keys())})")
+        return {"type": "full_care_plan_complete", "care_plan": care_plan}
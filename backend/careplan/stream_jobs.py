@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Stream Jobs Module
+-----------------
+Runs each care plan generation as a background job, decoupled from the HTTP request that
+started it. Jobs write their SSE payloads to a ring buffer under increasing event IDs, so a
+client that reconnects with Last-Event-ID resumes from the buffer instead of starting the
+upstream calls over. Clients accepting gzip can have their stream compressed, flushed after
+every message so each one still arrives on its own.
+"""
+
+import os
+import time
+import zlib
+import asyncio
+import logging
+import threading
+from collections import deque
+from itertools import islice
+from typing import Dict, List, Any, Optional, Tuple, Callable, Iterable, Iterator, AsyncIterable
+from serialization import dumps_bytes
+from cancellation import CancellationToken
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Job configuration
+CARE_PLAN_STREAM_BUFFER_EVENTS = int(os.environ.get('CARE_PLAN_STREAM_BUFFER_EVENTS', 20000))
+CARE_PLAN_STREAM_RESUME_TTL = float(os.environ.get('CARE_PLAN_STREAM_RESUME_TTL', 120))
+# Seconds a generation keeps running without any connected client before it is cancelled (0 never cancels)
+CARE_PLAN_STREAM_DISCONNECT_GRACE = float(os.environ.get('CARE_PLAN_STREAM_DISCONNECT_GRACE', 30))
+# Compress streams with gzip (Content-Encoding) for clients whose Accept-Encoding allows it
+CARE_PLAN_STREAM_GZIP = os.environ.get('CARE_PLAN_STREAM_GZIP', '0') not in ('0', 'false', 'False')
+CARE_PLAN_STREAM_GZIP_LEVEL = int(os.environ.get('CARE_PLAN_STREAM_GZIP_LEVEL', 6))
+
+# (event ID, encoded SSE data payload); events without an ID are never buffered
+StreamEvent = Tuple[Optional[int], bytes]
+
+# Payloads are buffered already encoded, so framing one is a few byte concatenations
+_SSE_ID_PREFIX = b"id: "
+_SSE_DATA_PREFIX = b"data: "
+_SSE_ID_DATA_SEPARATOR = b"\n" + _SSE_DATA_PREFIX
+_SSE_EVENT_END = b"\n\n"
+
+def format_sse_event(event_id: Optional[int], payload: bytes) -> bytes:
+    """Frames one payload as an SSE message."""
+    if event_id is None:
+        return _SSE_DATA_PREFIX + payload + _SSE_EVENT_END
+    return _SSE_ID_PREFIX + str(event_id).encode('ascii') + _SSE_ID_DATA_SEPARATOR + payload + _SSE_EVENT_END
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """Whether an Accept-Encoding header allows gzip (explicitly or through *) with a non-zero q-value."""
+    for coding in (accept_encoding or "").split(","):
+        name, _, parameters = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        quality = parameters.strip().lower()
+        if quality.startswith("q="):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+class SSEGzipEncoder:
+    """Compresses the SSE messages of one response into a gzip stream, flushed after each message."""
+
+    def __init__(self, level: int = CARE_PLAN_STREAM_GZIP_LEVEL):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def encode(self, message: bytes) -> bytes:
+        return self._compressor.compress(message) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self) -> bytes:
+        """The end of the gzip stream (its trailer)."""
+        return self._compressor.flush(zlib.Z_FINISH)
+
+def gzip_sse_messages(messages: Iterator[bytes], level: int = CARE_PLAN_STREAM_GZIP_LEVEL) -> Iterator[bytes]:
+    """Compresses a response of SSE messages; closing it closes messages."""
+    encoder = SSEGzipEncoder(level)
+    try:
+        for message in messages:
+            yield encoder.encode(message)
+        yield encoder.close()
+    finally:
+        close = getattr(messages, "close", None)
+        if close is not None:
+            close()
+
+def parse_last_event_id(value: Optional[str]) -> int:
+    """The event ID a reconnecting client last saw, or 0 to start from the beginning."""
+    try:
+        return max(0, int(value)) if value else 0
+    except ValueError:
+        return 0
+
+class StreamEventBuffer:
+    """
+    Ring buffer of the last max_events payloads of one stream, numbered from 1. Readers block
+    (threads) or await (coroutines) until events after the ID they have seen arrive.
+    """
+
+    def __init__(self, max_events: int = CARE_PLAN_STREAM_BUFFER_EVENTS):
+        self._events: "deque[Tuple[int, bytes]]" = deque(maxlen=max_events)
+        self._next_id = 1
+        self._finished = False
+        self._condition = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, "asyncio.Future[None]"]] = []
+
+    def append(self, payload: bytes) -> None:
+        with self._condition:
+            self._events.append((self._next_id, payload))
+            self._next_id += 1
+            self._notify()
+
+    def finish(self) -> None:
+        with self._condition:
+            self._finished = True
+            self._notify()
+
+    @property
+    def finished(self) -> bool:
+        return self._finished
+
+    def _notify(self) -> None:
+        self._condition.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake_waiter, waiter)
+
+    def _collect(self, after_id: int) -> Tuple[List[StreamEvent], bool]:
+        # Caller holds the lock
+        if not self._events or self._events[-1][0] <= after_id:
+            return [], self._finished
+        first_id = self._events[0][0]
+        events: List[StreamEvent] = []
+        if after_id + 1 < first_id:
+            gap = {"type": "replay_gap", "content": f"Events {after_id + 1} to {first_id - 1} are no longer buffered"}
+            events.append((None, dumps_bytes(gap)))
+        events.extend(islice(self._events, max(0, after_id + 1 - first_id), None))
+        return events, self._finished
+
+    def read(self, after_id: int) -> Tuple[List[StreamEvent], bool]:
+        """Blocks until there are events after after_id or the stream finished. Returns them and whether it finished."""
+        with self._condition:
+            events, finished = self._collect(after_id)
+            while not events and not finished:
+                self._condition.wait()
+                events, finished = self._collect(after_id)
+        return events, finished
+
+    async def aread(self, after_id: int) -> Tuple[List[StreamEvent], bool]:
+        """Async counterpart of read()."""
+        while True:
+            with self._condition:
+                events, finished = self._collect(after_id)
+                if events or finished:
+                    return events, finished
+                waiter = asyncio.get_running_loop().create_future()
+                self._async_waiters.append((asyncio.get_running_loop(), waiter))
+            await waiter
+
+    def follow(self, after_id: int = 0) -> Iterator[StreamEvent]:
+        """Yields every event after after_id, live, until the stream finishes."""
+        while True:
+            events, finished = self.read(after_id)
+            for event_id, payload in events:
+                if event_id is not None:
+                    after_id = event_id
+                yield event_id, payload
+            if finished and not events:
+                return
+
+    async def afollow(self, after_id: int = 0):
+        """Async counterpart of follow()."""
+        while True:
+            events, finished = await self.aread(after_id)
+            for event_id, payload in events:
+                if event_id is not None:
+                    after_id = event_id
+                yield event_id, payload
+            if finished and not events:
+                return
+
+def _wake_waiter(waiter: "asyncio.Future[None]") -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+class GenerationJob:
+    """
+    One care plan generation, producing into its own event buffer. Stream requests attach() while they
+    follow it; once the last one detached, the job's cancel_token is cancelled unless another attaches
+    within disconnect_grace seconds (time enough to reconnect with Last-Event-ID).
+    """
+
+    def __init__(self, stream_id: str, buffer_events: int = CARE_PLAN_STREAM_BUFFER_EVENTS,
+                 disconnect_grace: float = CARE_PLAN_STREAM_DISCONNECT_GRACE):
+        self.stream_id = stream_id
+        self.buffer = StreamEventBuffer(buffer_events)
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional["asyncio.Task[None]"] = None # Set for jobs running on an event loop
+        self.cancel_token = CancellationToken()
+        self.disconnect_grace = disconnect_grace
+        self._subscribers = 0
+        self._detached_count = 0 # Tells a grace timer whether a client came and went again since it started
+        self._subscribers_lock = threading.Lock()
+
+    def attach(self) -> None:
+        with self._subscribers_lock:
+            self._subscribers += 1
+
+    def detach(self) -> None:
+        with self._subscribers_lock:
+            self._subscribers -= 1
+            if self._subscribers or self.finished_at is not None or self.disconnect_grace <= 0:
+                return
+            self._detached_count += 1
+            timer = threading.Timer(self.disconnect_grace, self._cancel_if_abandoned, args=(self._detached_count,))
+        timer.daemon = True
+        timer.start()
+
+    def _cancel_if_abandoned(self, detached_count: int) -> None:
+        with self._subscribers_lock:
+            if self._subscribers or detached_count != self._detached_count or self.finished_at is not None:
+                return
+            cancelled = self.cancel_token.cancel(f"No client connected for {self.disconnect_grace:g}s")
+        if cancelled:
+            logger.info(f"Cancelling generation job {self.stream_id}: no client connected for {self.disconnect_grace:g}s")
+            metrics.GENERATIONS_CANCELLED.inc()
+
+    def run(self, payloads: Iterable[bytes], on_finish: Callable[[], None]) -> None:
+        """Thread target: buffers every payload, then calls on_finish."""
+        try:
+            for payload in payloads:
+                self.buffer.append(payload)
+        except Exception:
+            logger.exception(f"Generation job {self.stream_id} failed:")
+        finally:
+            self._finish()
+            on_finish()
+
+    async def arun(self, payloads: AsyncIterable[bytes], on_finish: Callable[[], None]) -> None:
+        """Coroutine counterpart of run(); on_finish runs in a worker thread since it may block."""
+        try:
+            async for payload in payloads:
+                self.buffer.append(payload)
+        except Exception:
+            logger.exception(f"Generation job {self.stream_id} failed:")
+        finally:
+            self._finish()
+            await asyncio.to_thread(on_finish)
+
+    def _finish(self) -> None:
+        self.finished_at = time.time()
+        self.buffer.finish()
+        logger.info(f"Generation job {self.stream_id} finished in {self.finished_at - self.started_at:.1f}s")
+
+class GenerationJobRegistry:
+    """
+    The jobs of this process by stream ID. A finished job is kept for resume_ttl seconds so late
+    reconnects can still replay its tail.
+    """
+
+    def __init__(self, resume_ttl: float = CARE_PLAN_STREAM_RESUME_TTL,
+                 buffer_events: int = CARE_PLAN_STREAM_BUFFER_EVENTS,
+                 disconnect_grace: float = CARE_PLAN_STREAM_DISCONNECT_GRACE):
+        self.resume_ttl = resume_ttl
+        self.buffer_events = buffer_events
+        self.disconnect_grace = disconnect_grace
+        self._jobs: Dict[str, GenerationJob] = {}
+        self._lock = threading.Lock()
+
+    def _purge_finished(self, now: float) -> None:
+        expired = [stream_id for stream_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.resume_ttl]
+        for stream_id in expired:
+            del self._jobs[stream_id]
+
+    def get_or_start(self, stream_id: str, claim: Callable[[str], Optional[Dict[str, Any]]],
+                     launch: Callable[[GenerationJob, Dict[str, Any]], None]) -> Optional[GenerationJob]:
+        """
+        Returns the job of stream_id. On the first request the session is claimed and launch starts
+        producing into a new job; returns None if the session cannot be claimed.
+        """
+        with self._lock:
+            self._purge_finished(time.time())
+            job = self._jobs.get(stream_id)
+            if job is None:
+                patient_data = claim(stream_id)
+                if patient_data is None:
+                    return None
+                job = GenerationJob(stream_id, self.buffer_events, self.disconnect_grace)
+                self._jobs[stream_id] = job
+                launch(job, patient_data)
+            return job
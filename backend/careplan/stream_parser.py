@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Stream Parser Module
+-------------------
+Incremental, single-pass parser for a stage's streamed Sonar response. Separates <think>
+reasoning from the answer as deltas arrive and tracks JSON brace/string state over the
+answer, so the stage JSON is ready as soon as the stream ends. Optionally reports each
+top-level field and each object in an array as soon as it is complete.
+"""
+
+import re
+import logging
+import serialization
+from typing import Dict, List, Any, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+THINK_OPEN_TAG = "<think>"
+THINK_CLOSE_TAG = "</think>"
+
+# The only characters that change JSON scanning state
+JSON_STRUCTURAL_CHARS = re.compile(r'[{}\[\]",:\\]')
+
+# A completed partial value: its path from the root of the stage JSON, and the value itself
+PartialValue = Tuple[List[Union[str, int]], Any]
+
+def _partial_tag_length(text: str, tag: str) -> int:
+    """Length of the longest suffix of text that is a proper prefix of tag (a tag split across deltas)."""
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+class _Container:
+    """An object or array that is open at the current scan position."""
+    __slots__ = ("is_object", "start", "key", "index", "expecting_key", "value_start")
+
+    def __init__(self, is_object: bool, start: int):
+        self.is_object = is_object
+        self.start = start # Candidate offset of the opening bracket
+        self.key: Optional[str] = None # Object: key of the member being read
+        self.index = 0 # Array: index of the element being read
+        self.expecting_key = is_object
+        self.value_start = start + 1 # Candidate offset where the current member's value starts
+
+class StageResponseParser:
+    """
+    Consumes a response delta by delta. Each delta is looked at once:
+    - text inside <think>...</think> is collected as reasoning, and returned from feed() so it can be
+      streamed; tags split across deltas are held back until they can be recognised,
+    - everything else is scanned for the first top-level JSON object, tracking nesting depth and
+      whether we are inside a string, so braces within string values do not confuse the scan.
+    A balanced object that fails to parse is skipped and the scan resumes after it.
+
+    With emit_partials, values of the JSON object are also decoded as soon as they close: every
+    top-level field (except arrays of objects, whose elements are reported instead) and every object
+    that is an element of an array, at any depth. Collect them with drain_partials().
+    """
+
+    def __init__(self, emit_partials: bool = False):
+        self.emit_partials = emit_partials
+        self._parts: List[str] = []
+        self._pending = ""
+        self._in_think = False
+        self._reasoning_blocks: List[str] = []
+        self._current_reasoning: List[str] = []
+        self._answer_chars = 0
+
+        self._json_stack: List[_Container] = []
+        self._json_in_string = False
+        self._json_string_start = 0
+        self._json_escape = False
+        self._json_candidate: List[str] = []
+        self._json_candidate_length = 0
+        self._json_output: Optional[Dict[str, Any]] = None
+        self._partials: List[PartialValue] = []
+
+    @classmethod
+    def parse(cls, response_text: str) -> "StageResponseParser":
+        """Parses a complete response in one go."""
+        parser = cls()
+        parser.feed(response_text)
+        parser.close()
+        return parser
+
+    def feed(self, delta: str) -> str:
+        """Consumes one delta and returns the reasoning text it contained (possibly "")."""
+        self._parts.append(delta)
+        buffer = self._pending + delta
+        self._pending = ""
+        reasoning_out: List[str] = []
+
+        while buffer:
+            if self._in_think:
+                close_index = buffer.find(THINK_CLOSE_TAG)
+                if close_index != -1:
+                    reasoning_out.append(buffer[:close_index])
+                    self._current_reasoning.append(buffer[:close_index])
+                    self._end_think_block()
+                    buffer = buffer[close_index + len(THINK_CLOSE_TAG):]
+                    continue
+                held_back = _partial_tag_length(buffer, THINK_CLOSE_TAG)
+                content = buffer[:len(buffer) - held_back]
+                reasoning_out.append(content)
+                self._current_reasoning.append(content)
+                self._pending = buffer[len(buffer) - held_back:]
+                break
+            else:
+                open_index = buffer.find(THINK_OPEN_TAG)
+                if open_index != -1:
+                    self._scan_answer(buffer[:open_index])
+                    self._in_think = True
+                    buffer = buffer[open_index + len(THINK_OPEN_TAG):]
+                    continue
+                held_back = _partial_tag_length(buffer, THINK_OPEN_TAG)
+                self._scan_answer(buffer[:len(buffer) - held_back])
+                self._pending = buffer[len(buffer) - held_back:]
+                break
+
+        return "".join(reasoning_out)
+
+    def close(self) -> None:
+        """Flushes text held back as a possible partial tag. Call once the stream has ended."""
+        pending, self._pending = self._pending, ""
+        if self._in_think:
+            self._current_reasoning.append(pending)
+            self._end_think_block()
+        else:
+            self._scan_answer(pending)
+
+    def _end_think_block(self) -> None:
+        self._reasoning_blocks.append("".join(self._current_reasoning))
+        self._current_reasoning = []
+        self._in_think = False
+
+    def _scan_answer(self, text: str) -> None:
+        if not text:
+            return
+        self._answer_chars += len(text)
+        if self._json_output is not None:
+            return
+
+        position = 0
+        if self._json_escape:
+            # An escape that ended the previous delta covers this delta's first character
+            self._json_escape = False
+            position = 1
+        elif not self._json_stack:
+            position = text.find('{')
+            if position == -1:
+                return
+
+        # text[segment_start:] is the part of this delta that belongs to the candidate; it
+        # starts at candidate offset base
+        segment_start = 0
+        base = self._json_candidate_length
+        skip_index = -1
+        for match in JSON_STRUCTURAL_CHARS.finditer(text, position):
+            index = match.start()
+            if index == skip_index:
+                continue
+            char = match.group()
+            if self._json_in_string:
+                if char == '\\':
+                    skip_index = index + 1
+                    if skip_index == len(text):
+                        self._json_escape = True
+                elif char == '"':
+                    self._json_in_string = False
+                    container = self._json_stack[-1]
+                    if self.emit_partials and container.is_object and container.expecting_key:
+                        end = base + index - segment_start + 1
+                        container.key = self._decode(self._candidate_slice(self._json_string_start, end, text, segment_start, base))
+                continue
+            if not self._json_stack:
+                if char != '{':
+                    continue # Stray characters between a rejected candidate and the next object
+                segment_start = index
+                base = self._json_candidate_length
+                self._json_stack.append(_Container(True, base))
+                continue
+
+            offset = base + index - segment_start
+            container = self._json_stack[-1]
+            if char == '"':
+                self._json_in_string = True
+                self._json_string_start = offset
+            elif char == '{' or char == '[':
+                self._json_stack.append(_Container(char == '{', offset))
+            elif char == ':':
+                container.expecting_key = False
+                container.value_start = offset + 1
+            elif char == ',':
+                if self.emit_partials and len(self._json_stack) == 1:
+                    self._complete_top_level_field(offset, text, segment_start, base)
+                if container.is_object:
+                    container.expecting_key = True
+                    container.key = None
+                else:
+                    container.index += 1
+            elif len(self._json_stack) > 1:
+                closed = self._json_stack.pop()
+                if self.emit_partials and closed.is_object and not self._json_stack[-1].is_object:
+                    element = self._decode(self._candidate_slice(closed.start, offset + 1, text, segment_start, base))
+                    if isinstance(element, dict):
+                        self._partials.append(([c.key if c.is_object else c.index for c in self._json_stack], element))
+            else:
+                if self.emit_partials:
+                    self._complete_top_level_field(offset, text, segment_start, base)
+                self._json_stack.pop()
+                self._json_candidate.append(text[segment_start:index + 1])
+                if self._try_complete_candidate():
+                    return
+        if self._json_stack:
+            self._json_candidate.append(text[segment_start:])
+            self._json_candidate_length += len(text) - segment_start
+
+    def _candidate_slice(self, start: int, end: int, text: str, segment_start: int, base: int) -> str:
+        """Candidate text between two offsets, where end lies in the delta being scanned."""
+        if start >= base:
+            return text[segment_start + start - base:segment_start + end - base]
+        head = "".join(self._json_candidate)
+        self._json_candidate = [head]
+        return head[start:] + text[segment_start:segment_start + end - base]
+
+    def _complete_top_level_field(self, end: int, text: str, segment_start: int, base: int) -> None:
+        container = self._json_stack[0]
+        if container.key is None or container.expecting_key:
+            return
+        value = self._decode(self._candidate_slice(container.value_start, end, text, segment_start, base))
+        if isinstance(value, list) and any(isinstance(element, dict) for element in value):
+            return # Already reported element by element
+        if value is not None:
+            self._partials.append(([container.key], value))
+
+    def _decode(self, fragment: str) -> Any:
+        try:
+            return serialization.loads(fragment)
+        except serialization.JSONDecodeError:
+            return None
+
+    def _try_complete_candidate(self) -> bool:
+        candidate = "".join(self._json_candidate)
+        self._json_candidate = []
+        self._json_candidate_length = 0
+        try:
+            parsed = serialization.loads(candidate)
+        except serialization.JSONDecodeError:
+            logger.warning(f"Found a '{{...}}' block but it wasn't valid JSON: {candidate[:100]}...")
+            return False
+        if not isinstance(parsed, dict) or not parsed:
+            return False
+        self._json_output = parsed
+        return True
+
+    def drain_partials(self) -> List[PartialValue]:
+        """Returns the partial values completed since the last call (always [] without emit_partials)."""
+        partials, self._partials = self._partials, []
+        return partials
+
+    @property
+    def text(self) -> str:
+        """The full raw response."""
+        return "".join(self._parts)
+
+    @property
+    def reasoning(self) -> str:
+        """All <think> blocks seen so far, separated by blank lines."""
+        blocks = self._reasoning_blocks + (["".join(self._current_reasoning)] if self._in_think else [])
+        return "\n\n".join(blocks)
+
+    @property
+    def json_started(self) -> bool:
+        """Whether the answer's JSON object has begun."""
+        return bool(self._json_stack) or self._json_output is not None
+
+    @property
+    def json_output(self) -> Dict[str, Any]:
+        """The first valid JSON object outside <think> blocks, or {} if there is none (yet)."""
+        return self._json_output or {}
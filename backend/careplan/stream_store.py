@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Stream Store Module
+------------------
+Registry of streaming sessions created by /api/careplan/initiate-stream and consumed by
+/api/careplan/stream. Sessions expire if nobody streams them, the number of sessions in
+flight is bounded, and the registry can live outside the process (SQLite or Redis) so the
+two calls may be served by different gunicorn workers. Identical requests made while a
+generation for them is in flight share its session (see generation_key), as long as every
+stream request for a session reaches the worker running its generation.
+"""
+
+import os
+import json
+import time
+import hashlib
+import socket
+import uuid
+import sqlite3
+import tempfile
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Tuple, List
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - only needed for the redis backend
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Stream store configuration
+CARE_PLAN_STREAM_STORE = os.environ.get('CARE_PLAN_STREAM_STORE', 'memory')
+CARE_PLAN_STREAM_SQLITE_PATH = os.environ.get('CARE_PLAN_STREAM_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'careplan_streams.db'))
+CARE_PLAN_STREAM_REDIS_URL = os.environ.get('CARE_PLAN_STREAM_REDIS_URL', 'redis://localhost:6379/0')
+CARE_PLAN_STREAM_PENDING_TTL = float(os.environ.get('CARE_PLAN_STREAM_PENDING_TTL', 300))
+CARE_PLAN_STREAM_GENERATION_TTL = float(os.environ.get('CARE_PLAN_STREAM_GENERATION_TTL', 1800))
+CARE_PLAN_MAX_CONCURRENT_GENERATIONS = int(os.environ.get('CARE_PLAN_MAX_CONCURRENT_GENERATIONS', 20))
+CARE_PLAN_STREAM_RETRY_AFTER = int(os.environ.get('CARE_PLAN_STREAM_RETRY_AFTER', 15))
+CARE_PLAN_STREAM_DEDUP = os.environ.get('CARE_PLAN_STREAM_DEDUP', '1') not in ('0', 'false', 'False')
+# Set once the proxy routes /api/careplan/stream by streamId, so a stream always reaches the worker generating it
+CARE_PLAN_STREAM_STICKY_ROUTING = os.environ.get('CARE_PLAN_STREAM_STICKY_ROUTING', '0') not in ('0', 'false', 'False')
+STREAM_STORE_BACKENDS = ("memory", "sqlite", "redis")
+
+STATE_PENDING = "pending"
+STATE_GENERATING = "generating"
+
+# The inputs a care plan is generated from; requests agreeing on them get the same care plan
+GENERATION_INPUTS = ("patient_form_data", "care_environment", "focus_areas")
+
+def worker_id() -> str:
+    """Identifies this process; read on every call, as workers forked from a preloaded app share the import."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def generation_key(patient_data: Dict[str, Any]) -> Optional[str]:
+    """
+    Stable hash of the generation inputs of an initiate-stream request, or None if it must not share a
+    session with others (deduplication turned off, or a re-run of some stages of an earlier stream).
+    """
+    if not CARE_PLAN_STREAM_DEDUP or patient_data.get("rerun_of") or patient_data.get("stages_to_run"):
+        return None
+    key_material = {name: patient_data.get(name) for name in GENERATION_INPUTS}
+    # Streams sharing a generation also share its events, so they must ask for the same event mode
+    key_material["event_mode"] = patient_data.get("event_mode")
+    serialized = json.dumps(key_material, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+class StreamCapacityError(Exception):
+    """Raised when a new stream would exceed the concurrent generation limit."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Too many care plan generations in progress, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class StreamStore(ABC):
+    """
+    A stream session goes through two states:
+    - pending: created by initiate-stream, expires after pending_ttl if nobody streams it,
+    - generating: claimed by exactly one stream request, expires after generation_ttl so a worker that
+      died mid-generation does not hold its slot forever.
+    Both states count against max_concurrent, and a generating session records the worker_id() that
+    claimed it. release() ends the session. A session created with a dedup_key is returned again, without
+    taking another slot, to every create() with the same key until it ends or expires; all of them then
+    stream the one generation.
+
+    Only the claiming worker can serve a generation's events, so a store shared by several workers
+    (shared) ignores dedup_keys unless sticky_routing says stream requests reach that worker.
+    """
+
+    shared = False
+
+    def __init__(self, pending_ttl: float = CARE_PLAN_STREAM_PENDING_TTL,
+                 generation_ttl: float = CARE_PLAN_STREAM_GENERATION_TTL,
+                 max_concurrent: int = CARE_PLAN_MAX_CONCURRENT_GENERATIONS,
+                 retry_after: int = CARE_PLAN_STREAM_RETRY_AFTER,
+                 sticky_routing: bool = CARE_PLAN_STREAM_STICKY_ROUTING):
+        self.pending_ttl = pending_ttl
+        self.generation_ttl = generation_ttl
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.sticky_routing = sticky_routing
+
+    @property
+    def deduplicates(self) -> bool:
+        """Whether create() shares sessions by dedup_key."""
+        return not self.shared or self.sticky_routing
+
+    @abstractmethod
+    def create(self, patient_data: Dict[str, Any], dedup_key: Optional[str] = None) -> str:
+        """
+        Registers a pending session and returns its stream ID, or the ID of the live session created with
+        the same dedup_key. Raises StreamCapacityError when full.
+        """
+
+    @abstractmethod
+    def claim(self, stream_id: str) -> Optional[Dict[str, Any]]:
+        """Moves a pending session to generating and returns its patient data; None if unknown, expired or already claimed."""
+
+    @abstractmethod
+    def claimed_by(self, stream_id: str) -> Optional[str]:
+        """The worker_id() generating the session; None if it is unknown, expired or still pending."""
+
+    @abstractmethod
+    def release(self, stream_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def count_active(self) -> int:
+        ...
+
+class MemoryStreamStore(StreamStore):
+    """Process-local store. initiate-stream and stream must reach the same process."""
+
+    def __init__(self, **options: Any):
+        super().__init__(**options)
+        # stream_id -> (state, expires_at, patient_data, dedup_key, claiming worker)
+        self._sessions: Dict[str, Tuple[str, float, Dict[str, Any], Optional[str], Optional[str]]] = {}
+        self._dedup_index: Dict[str, str] = {} # dedup_key -> stream_id
+        self._lock = threading.Lock()
+
+    def _purge_expired(self, now: float) -> None:
+        expired = [stream_id for stream_id, session in self._sessions.items() if session[1] < now]
+        for stream_id in expired:
+            self._remove(stream_id)
+        if expired:
+            logger.info(f"Expired {len(expired)} stream sessions")
+
+    def _remove(self, stream_id: str) -> None:
+        session = self._sessions.pop(stream_id, None)
+        if session is not None and session[3] is not None and self._dedup_index.get(session[3]) == stream_id:
+            del self._dedup_index[session[3]]
+
+    def create(self, patient_data: Dict[str, Any], dedup_key: Optional[str] = None) -> str:
+        now = time.time()
+        dedup_key = dedup_key if self.deduplicates else None
+        with self._lock:
+            self._purge_expired(now)
+            if dedup_key is not None and dedup_key in self._dedup_index:
+                stream_id = self._dedup_index[dedup_key]
+                logger.info(f"Joined stream {stream_id} generating the same care plan")
+                return stream_id
+            if len(self._sessions) >= self.max_concurrent:
+                raise StreamCapacityError(self.retry_after)
+            stream_id = str(uuid.uuid4())
+            self._sessions[stream_id] = (STATE_PENDING, now + self.pending_ttl, patient_data, dedup_key, None)
+            if dedup_key is not None:
+                self._dedup_index[dedup_key] = stream_id
+        return stream_id
+
+    def claim(self, stream_id: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(stream_id)
+            if session is None or session[0] != STATE_PENDING or session[1] < now:
+                return None
+            self._sessions[stream_id] = (STATE_GENERATING, now + self.generation_ttl, session[2], session[3], worker_id())
+            return session[2]
+
+    def claimed_by(self, stream_id: str) -> Optional[str]:
+        with self._lock:
+            session = self._sessions.get(stream_id)
+            return session[4] if session is not None and session[1] >= time.time() else None
+
+    def release(self, stream_id: str) -> None:
+        with self._lock:
+            self._remove(stream_id)
+
+    def count_active(self) -> int:
+        with self._lock:
+            self._purge_expired(time.time())
+            return len(self._sessions)
+
+class SQLiteStreamStore(StreamStore):
+    """Store in a SQLite file, shared by every worker on the host."""
+
+    shared = True
+
+    def __init__(self, sqlite_path: str = CARE_PLAN_STREAM_SQLITE_PATH, **options: Any):
+        super().__init__(**options)
+        self.sqlite_path = sqlite_path
+        # The journal mode cannot change inside the transaction _connect opens
+        connection = sqlite3.connect(self.sqlite_path, timeout=5)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+        finally:
+            connection.close()
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS stream_sessions ("
+                "stream_id TEXT PRIMARY KEY, patient_data TEXT NOT NULL, state TEXT NOT NULL, expires_at REAL NOT NULL, dedup_key TEXT, worker TEXT)"
+            )
+            # Files created by earlier versions lack the columns added since
+            columns: List[str] = [row[1] for row in connection.execute("PRAGMA table_info(stream_sessions)")]
+            for column in ("dedup_key", "worker"):
+                if column not in columns:
+                    connection.execute(f"ALTER TABLE stream_sessions ADD COLUMN {column} TEXT")
+            connection.execute("CREATE INDEX IF NOT EXISTS stream_sessions_dedup_key ON stream_sessions (dedup_key)")
+
+    @contextmanager
+    def _connect(self):
+        # isolation_level=None plus an explicit BEGIN IMMEDIATE makes check-then-insert atomic across processes
+        connection = sqlite3.connect(self.sqlite_path, timeout=5, isolation_level=None)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        finally:
+            connection.close()
+
+    def create(self, patient_data: Dict[str, Any], dedup_key: Optional[str] = None) -> str:
+        now = time.time()
+        dedup_key = dedup_key if self.deduplicates else None
+        with self._connect() as connection:
+            purged = connection.execute("DELETE FROM stream_sessions WHERE expires_at < ?", (now,)).rowcount
+            if purged:
+                logger.info(f"Expired {purged} stream sessions")
+            if dedup_key is not None:
+                row = connection.execute("SELECT stream_id FROM stream_sessions WHERE dedup_key = ? LIMIT 1", (dedup_key,)).fetchone()
+                if row is not None:
+                    logger.info(f"Joined stream {row[0]} generating the same care plan")
+                    return row[0]
+            active = connection.execute("SELECT COUNT(*) FROM stream_sessions").fetchone()[0]
+            if active >= self.max_concurrent:
+                raise StreamCapacityError(self.retry_after)
+            stream_id = str(uuid.uuid4())
+            connection.execute(
+                "INSERT INTO stream_sessions (stream_id, patient_data, state, expires_at, dedup_key) VALUES (?, ?, ?, ?, ?)",
+                (stream_id, json.dumps(patient_data), STATE_PENDING, now + self.pending_ttl, dedup_key)
+            )
+        return stream_id
+
+    def claim(self, stream_id: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT patient_data FROM stream_sessions WHERE stream_id = ? AND state = ? AND expires_at >= ?",
+                (stream_id, STATE_PENDING, now)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE stream_sessions SET state = ?, expires_at = ?, worker = ? WHERE stream_id = ?",
+                (STATE_GENERATING, now + self.generation_ttl, worker_id(), stream_id)
+            )
+        return json.loads(row[0])
+
+    def claimed_by(self, stream_id: str) -> Optional[str]:
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT worker FROM stream_sessions WHERE stream_id = ? AND expires_at >= ?", (stream_id, time.time())
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def release(self, stream_id: str) -> None:
+        with self._connect() as connection:
+            connection.execute("DELETE FROM stream_sessions WHERE stream_id = ?", (stream_id,))
+
+    def count_active(self) -> int:
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM stream_sessions WHERE expires_at >= ?", (time.time(),)).fetchone()[0]
+
+class RedisStreamStore(StreamStore):
+    """
+    Store in Redis (or any server speaking its protocol), shared by workers on every host.
+    Each session is a key with a TTL; a sorted set of stream IDs scored by expiry time is used
+    to count the sessions in flight. A deduplicated session also has a key from its dedup_key
+    to its stream ID, which only counts while the session key itself exists.
+    """
+
+    ACTIVE_KEY = "careplan:streams:active"
+    SESSION_KEY_PREFIX = "careplan:stream:"
+    DEDUP_KEY_PREFIX = "careplan:stream:dedup:"
+
+    shared = True
+
+    def __init__(self, redis_url: str = CARE_PLAN_STREAM_REDIS_URL, **options: Any):
+        if redis is None:
+            raise ImportError("The redis stream store requires the 'redis' package")
+        super().__init__(**options)
+        self._redis = redis.Redis.from_url(redis_url)
+
+    def create(self, patient_data: Dict[str, Any], dedup_key: Optional[str] = None) -> str:
+        stream_id = str(uuid.uuid4())
+        dedup_key = dedup_key if self.deduplicates else None
+        session = json.dumps({"state": STATE_PENDING, "patient_data": patient_data, "dedup_key": dedup_key})
+        dedup_key_name = self.DEDUP_KEY_PREFIX + dedup_key if dedup_key is not None else None
+        reserved: Dict[str, str] = {}
+
+        def reserve(pipe) -> None:
+            reserved["stream_id"] = stream_id # Rerun from scratch if a watched key changed before EXEC
+            if dedup_key_name is not None:
+                existing = pipe.get(dedup_key_name)
+                if existing is not None and pipe.exists(self.SESSION_KEY_PREFIX + existing.decode()):
+                    reserved["stream_id"] = existing.decode()
+                    return
+            now = time.time()
+            pipe.zremrangebyscore(self.ACTIVE_KEY, 0, now)
+            if pipe.zcard(self.ACTIVE_KEY) >= self.max_concurrent:
+                raise StreamCapacityError(self.retry_after)
+            pipe.multi()
+            pipe.zadd(self.ACTIVE_KEY, {stream_id: now + self.pending_ttl})
+            pipe.set(self.SESSION_KEY_PREFIX + stream_id, session, px=int(self.pending_ttl * 1000))
+            if dedup_key_name is not None:
+                pipe.set(dedup_key_name, stream_id, px=int(self.pending_ttl * 1000))
+
+        # Retried by redis-py if another worker changes the active set or the dedup key in between
+        watched = (self.ACTIVE_KEY, dedup_key_name) if dedup_key_name is not None else (self.ACTIVE_KEY,)
+        self._redis.transaction(reserve, *watched)
+        if reserved["stream_id"] != stream_id:
+            logger.info(f"Joined stream {reserved['stream_id']} generating the same care plan")
+        return reserved["stream_id"]
+
+    def claim(self, stream_id: str) -> Optional[Dict[str, Any]]:
+        session_key = self.SESSION_KEY_PREFIX + stream_id
+        claimed: Dict[str, Any] = {}
+
+        def move_to_generating(pipe) -> None:
+            claimed.clear() # Rerun from scratch if the key changed before EXEC
+            raw_session = pipe.get(session_key)
+            if raw_session is None:
+                return
+            session = json.loads(raw_session)
+            if session["state"] != STATE_PENDING:
+                return
+            session["state"] = STATE_GENERATING
+            session["worker"] = worker_id()
+            pipe.multi()
+            pipe.set(session_key, json.dumps(session), px=int(self.generation_ttl * 1000))
+            pipe.zadd(self.ACTIVE_KEY, {stream_id: time.time() + self.generation_ttl})
+            if session.get("dedup_key") is not None:
+                # Joinable for as long as it generates; a stale mapping is ignored once the session key is gone
+                pipe.set(self.DEDUP_KEY_PREFIX + session["dedup_key"], stream_id, px=int(self.generation_ttl * 1000))
+            claimed["patient_data"] = session["patient_data"]
+
+        self._redis.transaction(move_to_generating, session_key)
+        return claimed.get("patient_data")
+
+    def claimed_by(self, stream_id: str) -> Optional[str]:
+        raw_session = self._redis.get(self.SESSION_KEY_PREFIX + stream_id)
+        return json.loads(raw_session).get("worker") if raw_session is not None else None
+
+    def release(self, stream_id: str) -> None:
+        pipe = self._redis.pipeline()
+        pipe.delete(self.SESSION_KEY_PREFIX + stream_id)
+        pipe.zrem(self.ACTIVE_KEY, stream_id)
+        pipe.execute()
+
+    def count_active(self) -> int:
+        return self._redis.zcount(self.ACTIVE_KEY, time.time(), "+inf")
+
+def get_stream_store(backend: str = CARE_PLAN_STREAM_STORE) -> StreamStore:
+    """Returns a stream store of the backend configured by CARE_PLAN_STREAM_STORE."""
+    if backend == "memory":
+        return MemoryStreamStore()
+    if backend == "sqlite":
+        store: StreamStore = SQLiteStreamStore()
+    elif backend == "redis":
+        store = RedisStreamStore()
+    else:
+        raise ValueError(f"Invalid stream store '{backend}', expected one of {STREAM_STORE_BACKENDS}")
+    if CARE_PLAN_STREAM_DEDUP and not store.deduplicates:
+        logger.info(f"Identical streams are not shared: the {backend} stream store needs CARE_PLAN_STREAM_STICKY_ROUTING")
+    return store
@@ -0,0 +1,132 @@
+import copy
+
+import pytest
+
+from care_plan_patch import CarePlanPatchEncoder, canonical_json, care_plan_checksum, make_patch, resolve_event_mode
+from merge_engine import MergeEngine
+from test_merge_engine import SCHEMA, STAGES_CONFIG, STAGE_OUTPUTS, EXPECTED
+
+def _unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+def apply_patch(document, patch):
+    """A minimal RFC 6902 add/remove/replace, as a client applies the care_plan_patch events."""
+    document = copy.deepcopy(document)
+    for operation in patch:
+        if operation["path"] == "":
+            document = copy.deepcopy(operation["value"])
+            continue
+        *parents, last = [_unescape(token) for token in operation["path"].split('/')[1:]]
+        container = document
+        for token in parents:
+            container = container[int(token)] if isinstance(container, list) else container[token]
+        if isinstance(container, list):
+            index = len(container) if last == "-" else int(last)
+            if operation["op"] == "add":
+                container.insert(index, copy.deepcopy(operation["value"]))
+            elif operation["op"] == "remove":
+                del container[index]
+            else:
+                container[index] = copy.deepcopy(operation["value"])
+        elif operation["op"] == "remove":
+            del container[last]
+        else:
+            container[last] = copy.deepcopy(operation["value"])
+    return document
+
+@pytest.mark.parametrize("old, new", [
+    ({}, {"a": 1}),
+    ({"a": 1, "b": 2}, {"a": 1}),
+    ({"a": [1, 2, 3, 4]}, {"a": [1, 5]}),
+    ({"a": [1]}, {"a": [1, {"b": [2]}]}),
+    ({"a": 1}, {"a": 1.0}),
+    ({"a": 1}, {"a": True}),
+    ({"a/b": {"c~d": 1}}, {"a/b": {"c~d": 2}}),
+    ({"a": {"b": 1}}, {"a": [1]}),
+    ({"a": "x"}, {"a": "x"}),
+])
+def test_make_patch_turns_old_into_new(old, new):
+    patched = apply_patch(old, make_patch(old, new))
+    assert care_plan_checksum(patched) == care_plan_checksum(new)
+
+def test_no_changes_no_operations():
+    assert make_patch({"a": [1, {"b": 2}]}, {"a": [1, {"b": 2}]}) == []
+
+def test_canonical_json_matches_rfc_8785():
+    # The example of RFC 8785 section 3.2.2
+    value = {
+        "numbers": [333333333.33333329, 1E30, 4.50, 2e-3, 0.000000000000000000000000001],
+        "string": "\u20ac$\u000F\u000aA'\u0042\u0022\u005c\\\"/",
+        "literals": [None, True, False],
+    }
+    assert canonical_json(value) == (
+        '{"literals":[null,true,false],"numbers":[333333333.3333333,1e+30,4.5,0.002,1e-27],'
+        '"string":"\u20ac$\\u000f\\nA\'B\\"\\\\\\\\\\"/"}'
+    )
+
+def test_canonical_json_sorts_keys_by_utf16_code_units():
+    # RFC 8785 section 3.2.3: the emoji (a surrogate pair) sorts before U+FB33
+    keys = ["\u20ac", "\r", "\ufb33", "1", "\U0001f600", "\u0080", "\u00f6"]
+    assert canonical_json({key: 0 for key in keys}) == (
+        '{"\\r":0,"1":0,"\u0080":0,"\u00f6":0,"\u20ac":0,"\U0001f600":0,"\ufb33":0}'
+    )
+
+@pytest.mark.parametrize("value, expected", [
+    (0, "0"), (-0.0, "0"), (1.0, "1"), (-1.5, "-1.5"), (1e20, "100000000000000000000"), (1e21, "1e+21"),
+    (1e-6, "0.000001"), (1e-7, "1e-7"), (5e-324, "5e-324"), (1.7976931348623157e308, "1.7976931348623157e+308"),
+    (0.1 + 0.2, "0.30000000000000004"), (2 ** 53, "9007199254740992"), (2 ** 53 + 1, "9007199254740992"), (2 ** 60, "1152921504606847000"),
+])
+def test_canonical_numbers_match_json_stringify(value, expected):
+    assert canonical_json(value) == expected
+
+def test_canonical_strings_escape_like_json_stringify():
+    assert canonical_json("\x00\x1f\x7f\b\t \"\\/<\u00e9>") == '"\\u0000\\u001f\x7f\\b\\t \\"\\\\/<\u00e9>"'
+    assert canonical_json("a\ud800") == '"a\\ud800"'
+
+def test_canonical_json_rejects_what_json_cannot_hold():
+    with pytest.raises(ValueError):
+        canonical_json(float("nan"))
+    with pytest.raises(TypeError):
+        canonical_json({"a": {1, 2}})
+
+def test_checksum_ignores_how_the_plan_was_written():
+    assert care_plan_checksum({"b": 1, "a": "\u00e9"}) == care_plan_checksum({"a": "\u00e9", "b": 1.0})
+    assert care_plan_checksum({}) == "sha256:44136fa355b3678a1146ad16f7e8649e94fb4fc21fe77e8310c060f61caaff8a"
+
+def test_applying_the_patch_events_reproduces_the_checksum():
+    encoder = CarePlanPatchEncoder(MergeEngine(SCHEMA, STAGES_CONFIG))
+    events = [{"type": "stage_json_chunk", "stage_name": stage_name, "json_data": STAGE_OUTPUTS[stage_name]}
+              for stage_name in ("plan", "assess", "evaluate")]
+    # The final plan differs from the merged stages, e.g. stages kept from a checkpoint on a re-run
+    final_plan = copy.deepcopy(EXPECTED)
+    final_plan["diagnoses"][1]["goals"].append({"text": "Sleep", "evaluation": "Met"})
+    events.append({"type": "full_care_plan_complete", "care_plan": final_plan})
+
+    client_plan, checksum = {}, None
+    for event in events:
+        for encoded in encoder.encode(event):
+            if encoded["type"] == "care_plan_patch":
+                client_plan = apply_patch(client_plan, encoded["patch"])
+            else:
+                assert encoded["type"] == "full_care_plan_complete"
+                assert "care_plan" not in encoded
+                checksum = encoded["checksum"]
+        if event["type"] == "stage_json_chunk" and event["stage_name"] == "evaluate":
+            assert client_plan == EXPECTED
+    assert checksum == care_plan_checksum(client_plan) == care_plan_checksum(final_plan)
+
+def test_unchanged_events_pass_through():
+    encoder = CarePlanPatchEncoder(MergeEngine(SCHEMA, STAGES_CONFIG))
+    assert encoder.encode({"type": "stage_json_chunk", "stage_name": "plan", "json_data": {}}) == []
+    event = {"type": "reasoning_chunk", "content": "..."}
+    assert encoder.encode(event) == [event]
+
+def test_partial_events_are_dropped():
+    encoder = CarePlanPatchEncoder(MergeEngine(SCHEMA, STAGES_CONFIG))
+    event = {"type": "stage_json_partial", "stage_name": "assess", "path": ["summary"], "value": "draft"}
+    assert encoder.encode(event) == []
+
+def test_resolve_event_mode():
+    assert resolve_event_mode("patch") == "patch"
+    with pytest.raises(ValueError):
+        resolve_event_mode("diff")
@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+from health import CircuitBreaker, HealthMonitor, UpstreamProbeError, CIRCUIT_CLOSED, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker(failure_threshold=3, reset_timeout=0.1)
+
+def test_opens_after_consecutive_failures(breaker):
+    for _ in range(2):
+        breaker.record_failure()
+        assert breaker.state == CIRCUIT_CLOSED
+        assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN
+    assert not breaker.allow_request()
+    assert breaker.retry_after() == 1
+
+def test_success_resets_the_failure_count(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_CLOSED
+
+def test_half_open_trial_closes_on_success(breaker):
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.15)
+    assert breaker.allow_request()
+    assert breaker.state == CIRCUIT_HALF_OPEN
+    # Only the one trial goes through until it is reported or reset_timeout passes again
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == CIRCUIT_CLOSED
+    assert breaker.allow_request()
+
+def test_half_open_trial_reopens_on_failure(breaker):
+    for _ in range(3):
+        breaker.record_failure()
+    time.sleep(0.15)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN
+    assert not breaker.allow_request()
+
+def test_record_response_counts_only_upstream_failures(breaker):
+    for status_code in (429, 400, 429, 404):
+        breaker.record_response(status_code)
+    assert breaker.state == CIRCUIT_CLOSED
+    for status_code in (500, 401, 503):
+        breaker.record_response(status_code)
+    assert breaker.state == CIRCUIT_OPEN
+    time.sleep(0.15)
+    breaker.allow_request()
+    breaker.record_response(200)
+    assert breaker.state == CIRCUIT_CLOSED
+
+def test_status_never_waits_for_a_probe(breaker):
+    def slow_probe():
+        time.sleep(0.3)
+        raise RuntimeError("upstream down")
+
+    monitor = HealthMonitor(slow_probe, breaker, probe_interval=0, ttl=60)
+    started = time.monotonic()
+    status = monitor.status()
+    assert time.monotonic() - started < 0.1
+    assert status["healthy"] is None
+    deadline = time.monotonic() + 2
+    while monitor.status()["healthy"] is None and time.monotonic() < deadline:
+        time.sleep(0.02)
+    status = monitor.status()
+    assert status["healthy"] is False
+    assert "upstream down" in status["error"]
+
+def failing_probe(error):
+    def probe():
+        raise error
+    return probe
+
+def test_rate_limited_probes_do_not_open_the_breaker(breaker):
+    monitor = HealthMonitor(failing_probe(UpstreamProbeError("Perplexity API answered 429", 429)), breaker, probe_interval=0)
+    for _ in range(5):
+        status = monitor.refresh()
+    assert status["healthy"] is False
+    assert breaker.state == CIRCUIT_CLOSED
+
+@pytest.mark.parametrize("error", [
+    UpstreamProbeError("Perplexity API answered 503", 503),
+    UpstreamProbeError("Perplexity API unreachable: timed out"),
+    TimeoutError("timed out"),
+])
+def test_failing_probes_open_the_breaker(breaker, error):
+    monitor = HealthMonitor(failing_probe(error), breaker, probe_interval=0)
+    for _ in range(3):
+        monitor.refresh()
+    assert breaker.state == CIRCUIT_OPEN
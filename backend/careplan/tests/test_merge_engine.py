@@ -0,0 +1,96 @@
+import copy
+import itertools
+
+import pytest
+
+from merge_engine import MergeEngine
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "diagnoses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "goals": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {"text": {"type": "string"}, "evaluation": {"type": "string"}},
+                        },
+                    },
+                },
+            },
+        },
+    },
+}
+STAGES_CONFIG = [
+    {"name": "assess", "properties_to_generate_or_update": ["summary", "diagnoses.*.name"]},
+    {"name": "plan", "properties_to_generate_or_update": ["diagnoses.*.goals"]},
+    {"name": "evaluate", "properties_to_generate_or_update": ["summary", "diagnoses.*.goals.*.evaluation"]},
+]
+STAGE_OUTPUTS = {
+    "assess": {"summary": "draft", "diagnoses": [{"name": "Infection"}, {"name": "Pain"}]},
+    "plan": {"diagnoses": [{"goals": [{"text": "Afebrile"}, {"text": "Clean wound"}]}, {"goals": [{"text": "Pain < 3"}]}]},
+    "evaluate": {
+        "summary": "final",
+        "diagnoses": [{"goals": [{"evaluation": "Met"}, {"evaluation": "Ongoing"}, {"evaluation": "Extra"}]}, {"goals": [{"evaluation": "Met"}]}],
+    },
+}
+EXPECTED = {
+    "summary": "final",
+    "diagnoses": [
+        {"name": "Infection", "goals": [{"text": "Afebrile", "evaluation": "Met"}, {"text": "Clean wound", "evaluation": "Ongoing"}]},
+        {"name": "Pain", "goals": [{"text": "Pain < 3", "evaluation": "Met"}]},
+    ],
+}
+
+@pytest.fixture
+def engine():
+    return MergeEngine(SCHEMA, STAGES_CONFIG)
+
+@pytest.mark.parametrize("order", list(itertools.permutations(STAGE_OUTPUTS)))
+def test_merge_order_does_not_change_the_care_plan(engine, order):
+    builder = engine.new_care_plan()
+    for stage_name in order:
+        builder.merge(stage_name, STAGE_OUTPUTS[stage_name])
+    assert builder.care_plan == EXPECTED
+
+@pytest.mark.parametrize("order", list(itertools.permutations(STAGE_OUTPUTS)))
+def test_partial_merges_match_whole_merges(engine, order):
+    builder = engine.new_care_plan()
+    for stage_name in order:
+        output = STAGE_OUTPUTS[stage_name]
+        for key, value in output.items():
+            if key == "diagnoses":
+                for index, diagnosis in enumerate(value):
+                    builder.merge_partial(stage_name, ("diagnoses", index), diagnosis)
+            else:
+                builder.merge_partial(stage_name, (key,), value)
+    assert builder.care_plan == EXPECTED
+
+def test_merging_leaves_stage_outputs_untouched(engine):
+    outputs = copy.deepcopy(STAGE_OUTPUTS)
+    builder = engine.new_care_plan()
+    for stage_name in ("evaluate", "plan", "assess"):
+        builder.merge(stage_name, outputs[stage_name])
+    assert outputs == STAGE_OUTPUTS
+
+def test_properties_outside_the_stage_paths_are_ignored(engine):
+    builder = engine.new_care_plan()
+    builder.merge("plan", {"summary": "not plan's", "diagnoses": [{"name": "Nope", "goals": []}]})
+    assert builder.care_plan == {"diagnoses": [{"goals": []}]}
+
+def test_elements_matched_by_key():
+    engine = MergeEngine(SCHEMA, STAGES_CONFIG, match_keys={"diagnoses": "name"})
+    builder = engine.new_care_plan()
+    builder.merge("assess", {"diagnoses": [{"name": "Pain"}, {"name": "Infection"}]})
+    builder.merge("plan", {"diagnoses": [{"name": " infection ", "goals": [{"text": "Afebrile"}]}, {"name": "Nausea", "goals": []}]})
+    assert builder.care_plan == {"diagnoses": [{"name": "Pain"}, {"name": "Infection", "goals": [{"text": "Afebrile"}]}, {"goals": []}]}
+
+def test_unknown_stage(engine):
+    with pytest.raises(ValueError):
+        engine.new_care_plan().merge("diagnose", {})
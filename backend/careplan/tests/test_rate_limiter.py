@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import rate_limiter
+from cancellation import CancellationToken, GenerationCancelled
+from rate_limiter import UpstreamLimiter, parse_retry_after
+
+@pytest.fixture
+def no_cooldown(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "DECREASE_COOLDOWN_SECONDS", 0.0)
+
+def test_overload_halves_the_limit_down_to_the_minimum(no_cooldown):
+    limiter = UpstreamLimiter(16, adaptive=True, min_concurrent=3)
+    for expected in (8, 4, 3, 3):
+        limiter.record_response(429, retry_after=0)
+        assert limiter.limit == expected
+
+def test_one_burst_of_overloads_halves_once():
+    limiter = UpstreamLimiter(16, adaptive=True)
+    for _ in range(5):
+        limiter.record_response(503, retry_after=0)
+    assert limiter.limit == 8
+
+def test_successes_raise_the_limit_additively(no_cooldown):
+    limiter = UpstreamLimiter(8, adaptive=True)
+    limiter.record_response(429, retry_after=0)
+    assert limiter.limit == 4
+    # Each success adds 1/limit, so about a full window of successes adds one slot
+    for _ in range(4):
+        limiter.record_response(200)
+    assert limiter.limit == 4
+    limiter.record_response(200)
+    assert limiter.limit == 5
+    for _ in range(100):
+        limiter.record_response(200)
+    assert limiter.limit == 8
+
+def test_fixed_limit_without_adaptive():
+    limiter = UpstreamLimiter(4)
+    limiter.record_response(429, retry_after=0)
+    assert limiter.limit == 4
+
+def test_client_errors_leave_the_limit_alone(no_cooldown):
+    limiter = UpstreamLimiter(4, adaptive=True)
+    limiter.record_response(400)
+    limiter.record_response(401)
+    assert limiter.limit == 4
+
+def test_overload_pauses_new_calls():
+    limiter = UpstreamLimiter(4)
+    limiter.record_response(429, retry_after=0.2)
+    started = time.monotonic()
+    with limiter.acquire():
+        pass
+    assert time.monotonic() - started >= 0.15
+
+def test_in_flight_calls_never_exceed_the_limit():
+    limiter = UpstreamLimiter(3)
+    peak, lock = [0], threading.Lock()
+
+    def call():
+        with limiter.acquire():
+            with lock:
+                peak[0] = max(peak[0], limiter.in_flight)
+            time.sleep(0.02)
+
+    threads = [threading.Thread(target=call) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 3
+    assert limiter.in_flight == 0
+
+def test_sub_limit_takes_slots_from_its_parent_and_backs_it_off(no_cooldown):
+    parent = UpstreamLimiter(2, adaptive=True)
+    child = UpstreamLimiter(4, adaptive=True, parent=parent)
+    with child.acquire():
+        with parent.acquire():
+            assert parent.in_flight == 2
+            token = CancellationToken()
+            threading.Timer(0.1, token.cancel).start()
+            with pytest.raises(GenerationCancelled):
+                with child.acquire(cancel_token=token):
+                    pass
+    assert parent.in_flight == child.in_flight == 0
+    child.record_response(429, retry_after=0)
+    assert (child.limit, parent.limit) == (2, 1)
+
+def test_cancel_while_waiting_for_a_slot():
+    limiter = UpstreamLimiter(1)
+    token = CancellationToken()
+    with limiter.acquire():
+        threading.Timer(0.05, token.cancel).start()
+        started = time.monotonic()
+        with pytest.raises(GenerationCancelled):
+            with limiter.acquire(cancel_token=token):
+                pass
+        assert time.monotonic() - started < 1
+    assert limiter.in_flight == 0
+
+def test_async_acquire_waits_for_a_slot():
+    limiter = UpstreamLimiter(2)
+    peak = [0]
+
+    async def call():
+        async with limiter.aacquire():
+            peak[0] = max(peak[0], limiter.in_flight)
+            await asyncio.sleep(0.02)
+
+    async def main():
+        await asyncio.gather(*(call() for _ in range(6)))
+
+    asyncio.run(main())
+    assert peak[0] == 2
+    assert limiter.in_flight == 0
+
+@pytest.mark.parametrize("value, expected", [(None, None), ("3", 3.0), ("-1", 0.0), ("soon", None)])
+def test_parse_retry_after(value, expected):
+    assert parse_retry_after(value) == expected
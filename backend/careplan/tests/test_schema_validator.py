@@ -0,0 +1,118 @@
+import copy
+
+import pytest
+
+from merge_engine import MergeEngine
+from schema_repair import StageRepair
+from schema_validator import StageSchemaValidator, json_pointer, parse_json_pointer
+from stream_parser import StageResponseParser
+
+GOAL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "text": {"type": "string"},
+        "status": {"type": "string", "enum": ["met", "unmet"]},
+        "interventions": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["text", "status", "interventions"],
+}
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "score": {"type": "integer"},
+        "diagnoses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"name": {"type": "string"}, "goals": {"type": "array", "items": GOAL_SCHEMA}},
+                "required": ["name", "goals"],
+            },
+        },
+    },
+}
+STAGES_CONFIG = [
+    {"name": "plan", "properties_to_generate_or_update": ["summary", "score", "diagnoses.*.goals"]},
+    {"name": "implement", "properties_to_generate_or_update": ["diagnoses.*.goals.*.interventions"]},
+]
+
+@pytest.fixture
+def validator():
+    # The plan stage leaves interventions to the implement stage
+    return StageSchemaValidator(SCHEMA, SCHEMA, ["summary", "score", "diagnoses.*.goals"],
+                                ["summary", "diagnoses"], ["diagnoses.*.goals.*.interventions"])
+
+def test_valid_output_has_no_gaps(validator):
+    care_plan = {"summary": "ok", "score": 3, "diagnoses": [{"goals": [{"text": "Afebrile", "status": "met"}]}]}
+    assert validator.find_gaps(care_plan) == []
+
+def test_gaps_in_document_order(validator):
+    care_plan = {
+        "score": True,
+        "diagnoses": [
+            {"goals": [{"text": "Afebrile", "status": "met"}, {"status": "later"}]},
+            {},
+            {"goals": "none"},
+        ],
+    }
+    assert validator.find_gaps(care_plan) == [
+        ("summary",),
+        ("score",),
+        ("diagnoses", 0, "goals", 1, "text"),
+        ("diagnoses", 0, "goals", 1, "status"),
+        ("diagnoses", 1, "goals"),
+        ("diagnoses", 2, "goals"),
+    ]
+
+def test_other_stages_properties_are_not_checked(validator):
+    care_plan = {"summary": "ok", "diagnoses": [{"goals": [{"text": "Afebrile", "status": "met", "interventions": 7}]}]}
+    assert validator.find_gaps(care_plan) == []
+
+def test_repair_schema_asks_for_each_gap_by_pointer(validator):
+    paths = [("summary",), ("diagnoses", 0, "goals", 1)]
+    schema = validator.repair_schema(paths)
+    assert schema["required"] == ["/summary", "/diagnoses/0/goals/1"]
+    assert schema["properties"]["/summary"] == {"type": "string"}
+    goal_schema = schema["properties"]["/diagnoses/0/goals/1"]
+    assert set(goal_schema["properties"]) == {"text", "status"}
+    assert goal_schema["required"] == ["text", "status"]
+
+@pytest.mark.parametrize("path", [("a/b", 0, "c~d"), (), ("diagnoses", 12, "goals")])
+def test_json_pointer_round_trip(path):
+    assert parse_json_pointer(json_pointer(path)) == path
+
+def test_json_pointer_escapes():
+    assert json_pointer(("a/b", "c~d", 3)) == "/a~1b/c~0d/3"
+
+def test_stage_repair_fills_the_gaps_without_touching_the_output(validator):
+    output = {"score": 3, "diagnoses": [{"goals": [{"text": "Afebrile"}, {"status": "met"}]}]}
+    original = copy.deepcopy(output)
+    stage_repair = StageRepair("plan", output, validator, MergeEngine(SCHEMA, STAGES_CONFIG),
+                               validator.repair_schema, max_paths=2, max_requests=5)
+    requests = list(stage_repair.requests())
+    assert [request.paths for request in requests] == [
+        [("summary",), ("diagnoses", 0, "goals", 0, "status")],
+        [("diagnoses", 0, "goals", 1, "text")],
+    ]
+    assert requests[0].payload["required"] == ["/summary", "/diagnoses/0/goals/0/status"]
+
+    answer = StageResponseParser.parse('{"/summary": "Recovering", "/diagnoses/0/goals/0/status": "unmet"}')
+    event = stage_repair.apply(requests[0], answer)
+    assert event == {"type": "stage_repair_complete", "stage_name": "plan", "repair_index": 0,
+                     "paths": ["/summary", "/diagnoses/0/goals/0/status"]}
+    # A failed repair call repairs nothing
+    assert stage_repair.apply(requests[1], None)["paths"] == []
+
+    repaired = stage_repair.finish()
+    assert repaired == {"summary": "Recovering", "score": 3,
+                        "diagnoses": [{"goals": [{"text": "Afebrile", "status": "unmet"}, {"status": "met"}]}]}
+    assert validator.find_gaps(repaired) == [("diagnoses", 0, "goals", 1, "text")]
+    assert output == original
+
+def test_stage_repair_caps_the_requests(validator):
+    output = {"diagnoses": [{"goals": [{}, {}]}]}
+    stage_repair = StageRepair("plan", output, validator, MergeEngine(SCHEMA, STAGES_CONFIG),
+                               validator.repair_schema, max_paths=1, max_requests=2)
+    assert len(stage_repair.gaps) == 5
+    assert len(list(stage_repair.requests())) == 2
+    assert stage_repair.finish() is output
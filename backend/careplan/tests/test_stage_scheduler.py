@@ -0,0 +1,113 @@
+import pytest
+
+from cancellation import CancellationToken
+from stage_scheduler import StageScheduler, CallBatch, CompletionCall, STAGE_STATUS_COMPLETED, STAGE_STATUS_FAILED
+
+STAGES_CONFIG = [
+    {"name": "a"},
+    {"name": "b", "depends_on": ["a"]},
+    {"name": "c", "depends_on": ["a"]},
+    {"name": "d", "depends_on": ["b", "c"]},
+]
+DEPENDENCIES = {"a": [], "b": ["a"], "c": ["a"], "d": ["a", "b", "c"]}
+
+def assemble(stage_outputs, stage_names):
+    # Stands in for the merge engine: records which outputs made up the context
+    return {stage_name: stage_outputs[stage_name] for stage_name in stage_names if stage_name in stage_outputs}
+
+def started_names(scheduler):
+    return [stage_name for stage_name, _ in scheduler.start()]
+
+def test_stages_start_once_their_dependencies_finish():
+    scheduler = StageScheduler(STAGES_CONFIG, DEPENDENCIES, 2, None, None, assemble)
+    assert started_names(scheduler) == ["a"]
+    assert scheduler.start() == []
+    scheduler.finish("a", {"x": 1})
+    ready = scheduler.start()
+    assert [stage_name for stage_name, _ in ready] == ["b", "c"]
+    assert [job.stage_idx for _, job in ready] == [1, 2]
+    assert all(job.current_care_plan == {"a": {"x": 1}} for _, job in ready)
+    scheduler.finish("b", {"y": 2})
+    assert scheduler.start() == []
+    scheduler.finish("c", {"z": 3})
+    (_, job), = scheduler.start()
+    assert job.stage_config["name"] == "d"
+    assert job.current_care_plan == {"a": {"x": 1}, "b": {"y": 2}, "c": {"z": 3}}
+
+def test_earlier_stage_dependencies_run_one_stage_at_a_time():
+    earlier_stages = {"a": [], "b": ["a"], "c": ["a", "b"], "d": ["a", "b", "c"]}
+    scheduler = StageScheduler(STAGES_CONFIG, earlier_stages, 1, None, None, assemble)
+    order = []
+    while True:
+        ready = started_names(scheduler)
+        if not ready:
+            break
+        assert len(ready) == 1
+        order.extend(ready)
+        scheduler.finish(ready[0], {ready[0]: True})
+    assert order == ["a", "b", "c", "d"]
+
+def test_stages_not_run_count_as_finished_with_their_checkpointed_output():
+    checkpoint = {"a": {"x": 1}, "b": {"y": 2}, "c": {"z": 3}}
+    scheduler = StageScheduler(STAGES_CONFIG, DEPENDENCIES, 2, checkpoint, ["c", "d"], assemble)
+    (_, job), = scheduler.start()
+    assert job.stage_config["name"] == "c"
+    assert job.current_care_plan == {"a": {"x": 1}}
+    scheduler.finish("c", {"z": 4})
+    assert started_names(scheduler) == ["d"]
+    assert checkpoint["c"] == {"z": 3}
+
+def test_a_failed_rerun_keeps_the_previous_output():
+    scheduler = StageScheduler(STAGES_CONFIG, DEPENDENCIES, 2, {"a": {"x": 1}}, ["a"], assemble)
+    scheduler.start()
+    assert scheduler.finish("a", None) == STAGE_STATUS_FAILED
+    assert scheduler.stage_outputs == {"a": {"x": 1}}
+    final = scheduler.final_event()
+    assert final == {"type": "full_care_plan_complete", "care_plan": {"a": {"x": 1}}}
+
+def test_failed_stages_still_release_their_dependents():
+    scheduler = StageScheduler(STAGES_CONFIG, DEPENDENCIES, 2, None, None, assemble)
+    scheduler.start()
+    assert scheduler.finish("a", {}) == STAGE_STATUS_FAILED
+    assert started_names(scheduler) == ["b", "c"]
+    assert scheduler.finish("b", {"y": 2}) == STAGE_STATUS_COMPLETED
+
+def test_cancellation_drops_the_stages_not_started():
+    token = CancellationToken()
+    scheduler = StageScheduler(STAGES_CONFIG, DEPENDENCIES, 2, None, None, assemble, token)
+    scheduler.start()
+    token.cancel("client left")
+    scheduler.finish("a", {"x": 1})
+    assert scheduler.start() == []
+    assert scheduler.waiting == []
+    assert scheduler.final_event() == {"type": "generation_cancelled", "content": "client left"}
+
+def test_a_dependency_cycle_leaves_stages_waiting():
+    stages_config = [{"name": "a"}, {"name": "b"}]
+    scheduler = StageScheduler(stages_config, {"a": ["b"], "b": ["a"]}, 2, None, None, assemble)
+    assert scheduler.start() == []
+    assert scheduler.final_event()["type"] == "full_care_plan_complete"
+    assert len(scheduler.waiting) == 2
+
+def test_error_events_carry_the_stage_name():
+    scheduler = StageScheduler(STAGES_CONFIG, DEPENDENCIES, 2, None, None, assemble)
+    assert scheduler.error_event("b", RuntimeError("boom")) == {"type": "error", "stage_name": "b", "content": "boom"}
+
+@pytest.fixture
+def call_batch():
+    calls = [CompletionCall({"n": index}, "stage", {"sub_request_index": index}) for index in range(3)]
+    return CallBatch(calls, 2)
+
+def test_call_batch_hands_out_every_call_once(call_batch):
+    assert [call_index for call_index, _ in call_batch.start()] == [0, 1, 2]
+    assert call_batch.start() == []
+
+def test_call_batch_keeps_responses_in_call_order(call_batch):
+    call_batch.start()
+    call_batch.finish(2, "third")
+    call_batch.finish(0, "first")
+    assert call_batch.responses == ["first", None, "third"]
+
+def test_call_batch_error_events_are_tagged_with_the_call(call_batch):
+    event = call_batch.error_event(1, ValueError("bad payload"))
+    assert event == {"type": "error", "stage_name": "stage", "content": "bad payload", "sub_request_index": 1}
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from stream_parser import StageResponseParser
+
+STAGE_JSON = {
+    "summary": "Fever {spiking} at \"night\", see [notes]",
+    "nursingDiagnoses": [
+        {"diagnosis": "Risk for infection", "goals": [{"goal": "Afebrile \\ 48h"}]},
+        {"diagnosis": "Acute pain", "goals": []},
+    ],
+    "priority": 2,
+}
+RESPONSE = (
+    "<think>Check {the} \"vitals\" first</think>Here is the plan:\n"
+    + json.dumps(STAGE_JSON)
+    + "\n<think>done</think>"
+)
+
+def feed_in_chunks(chunks, emit_partials=False):
+    parser = StageResponseParser(emit_partials=emit_partials)
+    reasoning = "".join(parser.feed(chunk) for chunk in chunks)
+    parser.close()
+    return parser, reasoning
+
+def test_parse_whole_response():
+    parser = StageResponseParser.parse(RESPONSE)
+    assert parser.json_output == STAGE_JSON
+    assert parser.reasoning == "Check {the} \"vitals\" first\n\ndone"
+    assert parser.text == RESPONSE
+
+@pytest.mark.parametrize("split", range(1, len(RESPONSE)))
+def test_every_chunk_boundary_gives_the_same_result(split):
+    parser, reasoning = feed_in_chunks([RESPONSE[:split], RESPONSE[split:]])
+    assert parser.json_output == STAGE_JSON
+    assert parser.reasoning == "Check {the} \"vitals\" first\n\ndone"
+    assert reasoning == "Check {the} \"vitals\" firstdone"
+
+def test_one_character_chunks():
+    parser, reasoning = feed_in_chunks(list(RESPONSE))
+    assert parser.json_output == STAGE_JSON
+    assert reasoning == "Check {the} \"vitals\" firstdone"
+
+def test_tag_split_across_chunks_is_not_streamed_as_reasoning():
+    parser = StageResponseParser()
+    assert parser.feed("<thi") == ""
+    assert parser.feed("nk>abc</th") == "abc"
+    assert parser.feed('ink>{"a": "</think>"}') == ""
+    parser.close()
+    assert parser.reasoning == "abc"
+    assert parser.json_output == {"a": "</think>"}
+
+def test_invalid_object_is_skipped():
+    parser = StageResponseParser.parse('{"a": nope} then {"a": 1}')
+    assert parser.json_output == {"a": 1}
+
+def test_no_json_yet():
+    parser = StageResponseParser()
+    parser.feed("<think>still thinking")
+    assert not parser.json_started
+    assert parser.json_output == {}
+    assert parser.reasoning == "still thinking"
+
+def test_partials_do_not_depend_on_chunking():
+    whole, _ = feed_in_chunks([RESPONSE], emit_partials=True)
+    expected = whole.drain_partials()
+    assert (["summary"], STAGE_JSON["summary"]) in expected
+    assert (["nursingDiagnoses", 0, "goals", 0], {"goal": "Afebrile \\ 48h"}) in expected
+    assert (["nursingDiagnoses", 1], STAGE_JSON["nursingDiagnoses"][1]) in expected
+    assert (["priority"], 2) in expected
+
+    parser = StageResponseParser(emit_partials=True)
+    partials = []
+    for chunk in RESPONSE:
+        parser.feed(chunk)
+        partials.extend(parser.drain_partials())
+    parser.close()
+    partials.extend(parser.drain_partials())
+    assert partials == expected
+
+def test_partials_off_by_default():
+    parser = StageResponseParser.parse(RESPONSE)
+    assert parser.drain_partials() == []
@@ -0,0 +1,77 @@
+import pytest
+
+import stream_store
+from stream_store import MemoryStreamStore, SQLiteStreamStore, StreamCapacityError, generation_key
+
+PATIENT_DATA = {"patient_form_data": {"age": 70}, "care_environment": "home", "focus_areas": [], "event_mode": "full"}
+DEDUP_KEY = generation_key(PATIENT_DATA)
+
+class Worker:
+    """A worker process sharing the SQLite file, identified by its own worker_id()."""
+
+    def __init__(self, monkeypatch, name, sqlite_path, sticky_routing):
+        self.monkeypatch = monkeypatch
+        self.name = name
+        self.store = SQLiteStreamStore(sqlite_path, sticky_routing=sticky_routing)
+
+    def __getattr__(self, method):
+        def call(*args):
+            self.monkeypatch.setattr(stream_store, "worker_id", lambda: self.name)
+            return getattr(self.store, method)(*args)
+        return call
+
+@pytest.fixture
+def workers(monkeypatch, tmp_path):
+    def make(sticky_routing):
+        sqlite_path = str(tmp_path / "streams.db")
+        return (Worker(monkeypatch, "host:1", sqlite_path, sticky_routing),
+                Worker(monkeypatch, "host:2", sqlite_path, sticky_routing))
+    return make
+
+def test_shared_store_does_not_share_streams_without_sticky_routing(workers):
+    worker_a, worker_b = workers(sticky_routing=False)
+    stream_id = worker_a.create(PATIENT_DATA, DEDUP_KEY)
+    assert worker_a.create(PATIENT_DATA, DEDUP_KEY) != stream_id
+    assert worker_a.claim(stream_id) == PATIENT_DATA
+    # A client of worker B must never be handed a stream only worker A can serve
+    assert worker_b.create(PATIENT_DATA, DEDUP_KEY) != stream_id
+
+def test_stream_claimed_by_another_worker(workers):
+    worker_a, worker_b = workers(sticky_routing=False)
+    stream_id = worker_a.create(PATIENT_DATA, DEDUP_KEY)
+    assert worker_b.claimed_by(stream_id) is None
+    assert worker_a.claim(stream_id) == PATIENT_DATA
+    # A reconnect reaching worker B cannot claim it again, and learns which worker generates it
+    assert worker_b.claim(stream_id) is None
+    assert worker_b.claimed_by(stream_id) == "host:1"
+    worker_a.release(stream_id)
+    assert worker_b.claimed_by(stream_id) is None
+
+def test_sticky_routing_shares_streams_across_workers(workers):
+    worker_a, worker_b = workers(sticky_routing=True)
+    stream_id = worker_a.create(PATIENT_DATA, DEDUP_KEY)
+    assert worker_b.create(PATIENT_DATA, DEDUP_KEY) == stream_id
+    assert worker_b.claim(stream_id) == PATIENT_DATA
+    assert worker_a.create(PATIENT_DATA, DEDUP_KEY) == stream_id
+    assert worker_a.claimed_by(stream_id) == "host:2"
+    worker_b.release(stream_id)
+    assert worker_a.create(PATIENT_DATA, DEDUP_KEY) != stream_id
+
+def test_memory_store_shares_streams():
+    store = MemoryStreamStore()
+    stream_id = store.create(PATIENT_DATA, DEDUP_KEY)
+    assert store.claim(stream_id) == PATIENT_DATA
+    assert store.create(PATIENT_DATA, DEDUP_KEY) == stream_id
+    assert store.claimed_by(stream_id) == stream_store.worker_id()
+    assert store.claim(stream_id) is None
+
+def test_generation_key_ignores_reruns():
+    assert generation_key(dict(PATIENT_DATA, rerun_of="abc")) is None
+    assert generation_key(dict(PATIENT_DATA, event_mode="patch")) != DEDUP_KEY
+
+def test_capacity(tmp_path):
+    store = SQLiteStreamStore(str(tmp_path / "streams.db"), max_concurrent=1, retry_after=7)
+    store.create(PATIENT_DATA)
+    with pytest.raises(StreamCapacityError) as error:
+        store.create(PATIENT_DATA)
+    assert error.value.retry_after == 7